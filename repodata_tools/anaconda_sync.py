@@ -2,10 +2,14 @@ import os
 import tempfile
 import subprocess
 import time
-import hmac
 import copy
 import random
 import functools
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor
 
 from git import Repo
 import tenacity
@@ -14,22 +18,22 @@ import rapidjson as json
 import requests
 import tqdm
 import github
-import joblib
 from github import RateLimitExceededException
 
 from .utils import (
     chunk_iterable,
-    compute_md5,
     split_pkg,
     print_github_api_limits,
     compute_subdir_pkg_index,
 )
 from .shards import (
+    can_index_remote_package,
     make_repodata_shard_noretry,
     get_old_shard_path,
     get_shard_path,
     read_subdir_shards,
 )
+from .fetch import download_package
 from .releases import (
     get_or_make_release,
     upload_asset
@@ -38,8 +42,20 @@ from .metadata import (
     CONDA_FORGE_SUBIDRS, UNDISTRIBUTABLE, UNINDEXABLE
 )
 
+# estimate of the memory used by a shard building process on top of the package
+SHARD_JOB_BASE_MEM = 250 * 1000**2
 
-def _build_shard(subdir, pkg, label):
+# if True, shards of .conda packages are built from their metadata only
+# without downloading the packages
+SHARD_METADATA_ONLY = True
+
+# the number of chunks of shards that can wait to be committed and pushed
+COMMIT_QUEUE_SIZE = 2
+# extra time past the time limit we wait for the last commits to be pushed
+COMMIT_FLUSH_GRACE_TIME = 300
+
+
+def _build_shard(subdir, pkg, label, upstream_record):
     try:
         subdir_pkg = os.path.join(subdir, pkg)
         if label == "main":
@@ -63,6 +79,8 @@ def _build_shard(subdir, pkg, label):
                 None,
                 url,
                 tmpdir,
+                upstream_record=upstream_record,
+                metadata_only=SHARD_METADATA_ONLY,
             )
     except Exception as e:
         print("\n\n\nERROR: %s\n\n\n" % subdir_pkg, flush=True)
@@ -71,7 +89,85 @@ def _build_shard(subdir, pkg, label):
     return shard
 
 
+def _get_shard_job_costs(args, size):
+    # each job is a python process that holds the package's info/ files in
+    # memory (or runs conda index as a fallback) and downloads the package
+    # to disk unless only its metadata is read
+    subdir, pkg, _, upstream_record = args
+    if SHARD_METADATA_ONLY and can_index_remote_package(
+        subdir, pkg, upstream_record, None
+    ):
+        return SHARD_JOB_BASE_MEM, 0
+    return SHARD_JOB_BASE_MEM + size, size
+
+
+def _build_shards_with_budget(exec, jobs, n_jobs, max_mem, max_disk):
+    """Build shards in parallel, keeping the estimated memory and disk use of
+    the running jobs under budget.
+
+    Jobs are started in order as long as they fit within the budgets and
+    fewer than `n_jobs` are running. A job that does not fit waits while
+    smaller jobs behind it run. A job that is larger than the budget on its
+    own only runs when nothing else is running, so no more jobs are started
+    once it is the next one in line.
+
+    Parameters
+    ----------
+    exec : concurrent.futures.Executor
+        The executor to run the jobs on.
+    jobs : list of tuples
+        A list of (args to _build_shard, package size in bytes).
+    n_jobs : int
+        The maximum number of jobs to run at once.
+    max_mem : int
+        The memory budget in bytes.
+    max_disk : int
+        The disk budget in bytes.
+
+    Returns
+    -------
+    shards : list of dicts
+        The built shards in the order they finished.
+    """
+    queue = list(jobs)
+    running = {}
+    mem = 0
+    disk = 0
+    shards = []
+    while queue or running:
+        i = 0
+        while i < len(queue) and len(running) < n_jobs:
+            args, size = queue[i]
+            job_mem, job_disk = _get_shard_job_costs(args, size)
+            if not running or (
+                mem + job_mem <= max_mem
+                and disk + job_disk <= max_disk
+            ):
+                running[exec.submit(_build_shard, *args)] = (job_mem, job_disk)
+                mem += job_mem
+                disk += job_disk
+                queue.pop(i)
+            elif i == 0 and (job_mem > max_mem or job_disk > max_disk):
+                # it would never fit next to other jobs, so it would wait
+                # forever if smaller jobs kept being started
+                break
+            else:
+                i += 1
+
+        done, _ = concurrent.futures.wait(
+            running, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for fut in done:
+            job_mem, job_disk = running.pop(fut)
+            mem -= job_mem
+            disk -= job_disk
+            shards.append(fut.result())
+
+    return shards
+
+
 def _write_shards(shards_to_write, all_shards, msg):
+    pths = []
     for subdir_pkg in shards_to_write:
         pth = get_shard_path(*os.path.split(subdir_pkg))
 
@@ -84,7 +180,10 @@ def _write_shards(shards_to_write, all_shards, msg):
                     all_shards[subdir_pkg], fp, sort_keys=True, indent=2
                 )
 
-            subprocess.run(f"git add {pth}", shell=True)
+            pths.append(pth)
+
+    for pth_chunk in chunk_iterable(pths, 256):
+        subprocess.run(["git", "add", "--"] + pth_chunk)
 
     subprocess.run("git status", shell=True)
     subprocess.run(
@@ -104,7 +203,131 @@ def _push_repo():
     subprocess.run("git push", shell=True, check=True)
 
 
-def update_shards(labels, all_shards, rank, n_ranks, start_time, time_limit=3300):
+def _commit_and_push_shards(commit_queue, git_lock, commit_errors):
+    while True:
+        item = commit_queue.get()
+        try:
+            if item is None:
+                return
+
+            # the main thread stops at the next chunk after a failed commit,
+            # so the shards after it are not committed either
+            if commit_errors:
+                continue
+
+            shards, msg = item
+            with git_lock:
+                _write_shards(shards, shards, msg)
+                try:
+                    _push_repo()
+                except Exception:
+                    pass
+        except Exception as e:
+            print("\n\nERROR committing shards: %s\n\n" % repr(e), flush=True)
+            commit_errors.append(e)
+        finally:
+            commit_queue.task_done()
+
+
+def _raise_commit_errors(commit_errors):
+    if commit_errors:
+        raise RuntimeError(
+            "could not commit shards: %s" % repr(commit_errors[0])
+        ) from commit_errors[0]
+
+
+def _queue_shards_for_commit(
+    commit_queue, commit_errors, shards_to_write, all_shards, msg,
+):
+    _raise_commit_errors(commit_errors)
+    # we copy the shards since the main thread keeps updating them
+    shards = {
+        subdir_pkg: copy.deepcopy(all_shards[subdir_pkg])
+        for subdir_pkg in shards_to_write
+        if subdir_pkg in all_shards
+    }
+    commit_queue.put((shards, msg))
+
+
+def update_shards(
+    labels, all_shards, rank, n_ranks, start_time, time_limit=3300,
+    n_jobs=8, max_mem_gb=4.0, max_disk_gb=10.0,
+):
+    """Build and commit the missing shards of a set of labels.
+
+    Returns
+    -------
+    out_of_time : bool
+        True if the time limit was reached before all labels were done.
+
+    Raises
+    ------
+    RuntimeError
+        If the shards could not be committed.
+    """
+    # the workers are forked from a forkserver that is started with exec, so
+    # none of them is forked while the committer thread below runs git or
+    # holds a lock
+    exec = ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+
+    # shards are committed and pushed in a background thread so that we can
+    # build the next chunk while the last one is pushed
+    git_lock = threading.Lock()
+    commit_queue = queue.Queue(maxsize=COMMIT_QUEUE_SIZE)
+    commit_errors = []
+    committer = threading.Thread(
+        target=_commit_and_push_shards,
+        args=(commit_queue, git_lock, commit_errors),
+        daemon=True,
+    )
+    committer.start()
+
+    try:
+        with exec:
+            out_of_time = _update_shards(
+                labels, all_shards, rank, n_ranks, start_time, time_limit,
+                exec, n_jobs, int(max_mem_gb * 1000**3), int(max_disk_gb * 1000**3),
+                commit_queue, commit_errors, git_lock,
+            )
+    finally:
+        deadline = (
+            start_time + max(time_limit, time.time() - start_time)
+            + COMMIT_FLUSH_GRACE_TIME
+        )
+        try:
+            commit_queue.put(None, timeout=max(deadline - time.time(), 0))
+        except queue.Full:
+            pass
+        else:
+            committer.join(timeout=max(deadline - time.time(), 0))
+
+        # the committer may still be running git, so we only push if it is done
+        if committer.is_alive():
+            print(
+                "\n\nERROR: shard commits did not finish before the time limit"
+                " - not pushing\n\n",
+                flush=True,
+            )
+        else:
+            with git_lock:
+                try:
+                    _push_repo()
+                except Exception:
+                    pass
+
+    if committer.is_alive():
+        raise RuntimeError("shard commits did not finish before the time limit")
+    _raise_commit_errors(commit_errors)
+    return out_of_time
+
+
+def _update_shards(
+    labels, all_shards, rank, n_ranks, start_time, time_limit,
+    exec, n_jobs, max_mem, max_disk, commit_queue, commit_errors, git_lock,
+):
     cd = requests.get(
             "https://conda.anaconda.org/conda-forge/channeldata.json"
         ).json()
@@ -148,7 +371,6 @@ def update_shards(labels, all_shards, rank, n_ranks, start_time, time_limit=3300
                 chunk_iterable(all_pkgs, 64)
             ):
                 jobs = []
-                max_bytes = 0
                 for pkg in pkg_chunk:
                     subdir_pkg = os.path.join(subdir, pkg)
 
@@ -164,29 +386,31 @@ def update_shards(labels, all_shards, rank, n_ranks, start_time, time_limit=3300
                                     os.path.dirname(new_shard_pth),
                                     exist_ok=True,
                                 )
-                                subprocess.run(
-                                    "git mv %s %s" % (
-                                        old_shard_pth, get_shard_path(subdir, pkg)
-                                    ),
-                                    shell=True,
-                                    check=True,
-                                )
+                                with git_lock:
+                                    subprocess.run(
+                                        "git mv %s %s" % (
+                                            old_shard_pth, get_shard_path(subdir, pkg)
+                                        ),
+                                        shell=True,
+                                        check=True,
+                                    )
                                 shards_to_write.add(subdir_pkg)
                                 with open(new_shard_pth, "r") as fp:
                                     all_shards[subdir_pkg] = json.load(fp)
                             else:
-                                subprocess.run(
-                                    "git rm -f %s" % old_shard_pth,
-                                    shell=True,
-                                    check=True,
-                                )
+                                with git_lock:
+                                    subprocess.run(
+                                        "git rm -f %s" % old_shard_pth,
+                                        shell=True,
+                                        check=True,
+                                    )
 
                             break
 
                     if subdir_pkg not in all_shards:
-                        max_bytes = max(max_bytes, rd["packages"][pkg]["size"])
-                        jobs.append(joblib.delayed(_build_shard)(
-                            subdir, pkg, label
+                        jobs.append((
+                            (subdir, pkg, label, rd["packages"][pkg]),
+                            rd["packages"][pkg]["size"],
                         ))
                     else:
                         if label not in all_shards[subdir_pkg]["labels"]:
@@ -206,15 +430,27 @@ def update_shards(labels, all_shards, rank, n_ranks, start_time, time_limit=3300
                             shards_to_write.add(subdir_pkg)
 
                 if jobs:
-                    max_gb = max_bytes / 1000**3
-                    n_jobs = min(max(int(1.0 / max_gb), 1), 1)
+                    tot_bytes = sum(size for _, size in jobs)
                     print(
-                        "using %d processes for %d jobs w/ max GB of %s" % (
-                            n_jobs, len(jobs), max_gb
+                        "building %d shards w/ %d processes and budgets of "
+                        "%0.2f GB memory and %0.2f GB disk" % (
+                            len(jobs), n_jobs, max_mem / 1000**3, max_disk / 1000**3
+                        ),
+                        flush=True,
+                    )
+                    build_start_time = time.time()
+                    shards = _build_shards_with_budget(
+                        exec, jobs, n_jobs, max_mem, max_disk
+                    )
+                    dt = max(time.time() - build_start_time, 1e-6)
+                    print(
+                        "built %d shards (%0.2f MB) in %0.2f seconds: "
+                        "%0.2f packages/s, %0.2f MB/s" % (
+                            len(shards), tot_bytes / 1000**2, dt,
+                            len(shards) / dt, tot_bytes / 1000**2 / dt,
                         ),
                         flush=True,
                     )
-                    shards = joblib.Parallel(n_jobs=n_jobs, verbose=0)(jobs)
                     for shard in shards:
                         subdir_pkg = os.path.join(shard["subdir"], shard["package"])
 
@@ -225,7 +461,9 @@ def update_shards(labels, all_shards, rank, n_ranks, start_time, time_limit=3300
                             and shard["package"] in rd["packages"]
                         ):
                             shard["repodata_version"] = rd.get("repodata_version", 1)
-                            shard["repodata"] = copy.deepcopy(rd["packages"][pkg])
+                            shard["repodata"] = copy.deepcopy(
+                                rd["packages"][shard["package"]]
+                            )
 
                         if (
                             shard["channeldata"] is None
@@ -245,33 +483,27 @@ def update_shards(labels, all_shards, rank, n_ranks, start_time, time_limit=3300
                         shards_to_write.add(subdir_pkg)
 
                 if len(shards_to_write) >= 64 or time.time() - start_time > time_limit:
-                    _write_shards(
+                    _queue_shards_for_commit(
+                        commit_queue,
+                        commit_errors,
                         shards_to_write,
                         all_shards,
                         f"chunk {chunk_index + 1} of {total_chunks} {label}/{subdir}",
                     )
                     shards_to_write = set()
 
-                    try:
-                        _push_repo()
-                    except Exception:
-                        pass
-
                 if time.time() - start_time > time_limit:
                     return True
 
     if shards_to_write:
-        _write_shards(
+        _queue_shards_for_commit(
+            commit_queue,
+            commit_errors,
             shards_to_write,
             all_shards,
             f"chunk {chunk_index + 1} of {total_chunks} {label}/{subdir}",
         )
 
-        try:
-            _push_repo()
-        except Exception:
-            pass
-
     return False
 
 
@@ -282,22 +514,10 @@ def update_shards(labels, all_shards, rank, n_ranks, start_time, time_limit=3300
 )
 def _download_package(tmpdir, subdir, pkg, url, md5_checksum):
     os.makedirs(f"{tmpdir}/{subdir}", exist_ok=True)
-    r = requests.head(url)
-    if r.status_code != 200:
-        _, name, ver, _ = split_pkg(os.path.join(subdir, pkg))
-        url = f"https://anaconda.org/conda-forge/{name}/{ver}/download/{subdir}/{pkg}"
-
-    subprocess.run(
-        f"curl --no-progress-meter -L {url} > {tmpdir}/{subdir}/{pkg}",
-        shell=True,
-        check=True,
+    download_package(
+        url, f"{tmpdir}/{subdir}/{pkg}", subdir, pkg, md5_checksum=md5_checksum,
     )
 
-    if md5_checksum is not None:
-        local_md5 = compute_md5(f"{tmpdir}/{subdir}/{pkg}")
-        if not hmac.compare_digest(local_md5, md5_checksum):
-            raise RuntimeError("md5 chechsum is incorrect! exiting!")
-
 
 def _make_release(subdir, pkg, shard, repo, repo_pth):
     # make release and upload if shard does not exist
@@ -469,7 +689,25 @@ def upload_packages(
     type=int,
     help="The maximum time to run in seconds."
 )
-def main(step, rank, n_ranks, time_limit):
+@click.option(
+    "--n-jobs",
+    default=8,
+    type=int,
+    help="The maximum number of shards to build at once."
+)
+@click.option(
+    "--max-mem-gb",
+    default=4.0,
+    type=float,
+    help="The memory budget in GB for building shards."
+)
+@click.option(
+    "--max-disk-gb",
+    default=10.0,
+    type=float,
+    help="The disk budget in GB for building shards."
+)
+def main(step, rank, n_ranks, time_limit, n_jobs, max_mem_gb, max_disk_gb):
     """Sync anaconda repodata shards w/ a local copy and upload packages.
     """
     start_time = time.time()
@@ -480,7 +718,7 @@ def main(step, rank, n_ranks, time_limit):
     print("reading all shards", flush=True)
     for subdir in CONDA_FORGE_SUBIDRS:
         old_len = len(all_shards)
-        read_subdir_shards(".", subdir, all_shards)
+        read_subdir_shards(".", subdir, all_shards, use_pack=True)
         print(
             "found %d repodata shards for subdir %s" % (
                 len(all_shards) - old_len, subdir
@@ -515,14 +753,12 @@ def main(step, rank, n_ranks, time_limit):
             n_ranks,
             start_time,
             time_limit=time_limit,
+            n_jobs=n_jobs,
+            max_mem_gb=max_mem_gb,
+            max_disk_gb=max_disk_gb,
         )
         print(" ", flush=True)
 
-        try:
-            _push_repo()
-        except Exception:
-            pass
-
     elif step == "releases":
         print("uploading releases", flush=True)
 
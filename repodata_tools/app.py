@@ -3,6 +3,7 @@ import gc
 import hmac
 import hashlib
 import datetime
+from collections import OrderedDict
 
 import pytz
 
@@ -10,8 +11,23 @@ from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, Response
 from fastapi.responses import RedirectResponse
 
 from repodata_tools.links import get_latest_links
+from repodata_tools.asset_cache import fetch_url
+from repodata_tools.sharded_repodata import get_shard_index_fn, is_shard_fn
+
+# the number of shard indexes kept in memory
+MAX_SHARD_INDEXES = 64
+
+
+def _get_shards(links):
+    return {
+        index_fn: frozenset(shards)
+        for index_fn, shards in links.get("shard-indexes", {}).items()
+    }
+
 
 LINKS = get_latest_links()
+SHARDS = _get_shards(LINKS)
+SHARD_INDEXES = OrderedDict()
 LAST_UPDATED = LINKS.get(
     "updated_at",
     datetime.datetime.now().astimezone(pytz.UTC).strftime("%Y-%m-%d %H:%M:%S %Z%z")
@@ -23,8 +39,10 @@ app = FastAPI()
 def _replace_links():
     print("**************** UPDATING LINKS ****************", flush=True)
     global LINKS
+    global SHARDS
     new_links = get_latest_links()
     LINKS = new_links
+    SHARDS = _get_shards(new_links)
     gc.collect()
     global LAST_UPDATED
     LAST_UPDATED = LINKS.get(
@@ -68,6 +86,31 @@ async def update_links(
             return {"message": "started link update!"}
 
 
+def _get_shard_index(subdir, label):
+    # the index is served from here and not redirected to the release asset
+    # since clients resolve the relative URLs of the shards and packages in it
+    # against the URL they got it from
+    url = LINKS["serverdata"].get(get_shard_index_fn(subdir, label), [None])[-1]
+    if url is None:
+        return None
+    data = SHARD_INDEXES.get(url)
+    if data is None:
+        data = fetch_url(url)
+        SHARD_INDEXES[url] = data
+        while len(SHARD_INDEXES) > MAX_SHARD_INDEXES:
+            SHARD_INDEXES.popitem(last=False)
+    return Response(content=data, media_type="application/zstd")
+
+
+def _get_shard_url(subdir, label, shard):
+    # only the shards of the index of the subdir and label are served
+    if not is_shard_fn(shard):
+        return None
+    if shard not in SHARDS.get(get_shard_index_fn(subdir, label), ()):
+        return None
+    return LINKS["serverdata"].get(shard, [None])[-1]
+
+
 ################################################################################
 # labels
 ################################################################################
@@ -122,6 +165,52 @@ async def subdir_repodatadatabz2_label(label, subdir):
     return RedirectResponse(url)
 
 
+@app.get("/conda-forge-sparta/label/{label}/{subdir}/repodata.json.zst")
+async def subdir_repodatadatazst_label(label, subdir):
+    fn = f"repodata_{subdir}_{label}.json.zst"
+    url = LINKS["serverdata"].get(fn, [None])[-1]
+    if url is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"label/{label}/{subdir}/repodata.json.zst not found!",
+        )
+    return RedirectResponse(url)
+
+
+@app.get("/conda-forge-sparta/label/{label}/{subdir}/repodata.jlap")
+async def subdir_repodatajlap_label(label, subdir):
+    fn = f"repodata_{subdir}_{label}.jlap"
+    url = LINKS["serverdata"].get(fn, [None])[-1]
+    if url is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"label/{label}/{subdir}/repodata.jlap not found!",
+        )
+    return RedirectResponse(url)
+
+
+@app.get("/conda-forge-sparta/label/{label}/{subdir}/repodata_shards.msgpack.zst")
+def subdir_repodatashards_label(label, subdir):
+    response = _get_shard_index(subdir, label)
+    if response is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"label/{label}/{subdir}/repodata_shards.msgpack.zst not found!",
+        )
+    return response
+
+
+@app.get("/conda-forge-sparta/label/{label}/{subdir}/shards/{shard}")
+async def subdir_shard_label(label, subdir, shard):
+    url = _get_shard_url(subdir, label, shard)
+    if url is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"label/{label}/{subdir}/shards/{shard} not found!",
+        )
+    return RedirectResponse(url)
+
+
 @app.get("/conda-forge-sparta/label/{label}/{subdir}/repodata_from_packages.json")
 async def subdir_repodatadata_pkgs_label(label, subdir):
     fn = f"repodata_from_packages_{subdir}_{label}.json"
@@ -232,6 +321,52 @@ async def subdir_repodatadatabz2(subdir):
     return RedirectResponse(url)
 
 
+@app.get("/conda-forge-sparta/{subdir}/repodata.json.zst")
+async def subdir_repodatadatazst(subdir):
+    fn = f"repodata_{subdir}_main.json.zst"
+    url = LINKS["serverdata"].get(fn, [None])[-1]
+    if url is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"{subdir}/repodata.json.zst not found!",
+        )
+    return RedirectResponse(url)
+
+
+@app.get("/conda-forge-sparta/{subdir}/repodata.jlap")
+async def subdir_repodatajlap(subdir):
+    fn = f"repodata_{subdir}_main.jlap"
+    url = LINKS["serverdata"].get(fn, [None])[-1]
+    if url is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"{subdir}/repodata.jlap not found!",
+        )
+    return RedirectResponse(url)
+
+
+@app.get("/conda-forge-sparta/{subdir}/repodata_shards.msgpack.zst")
+def subdir_repodatashards(subdir):
+    response = _get_shard_index(subdir, "main")
+    if response is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"{subdir}/repodata_shards.msgpack.zst not found!",
+        )
+    return response
+
+
+@app.get("/conda-forge-sparta/{subdir}/shards/{shard}")
+async def subdir_shard(subdir, shard):
+    url = _get_shard_url(subdir, "main", shard)
+    if url is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"{subdir}/shards/{shard} not found!",
+        )
+    return RedirectResponse(url)
+
+
 @app.get("/conda-forge-sparta/{subdir}/repodata_from_packages.json")
 async def subdir_repodatadata_pkgs(subdir):
     fn = f"repodata_from_packages_{subdir}_main.json"
@@ -0,0 +1,201 @@
+"""A persistent on-disk cache of downloaded files keyed by URL.
+
+The assets of our GitHub releases never change once they are uploaded, so
+they are served from the cache without asking the server again. Other URLs
+(e.g., the repodata of a label on anaconda.org) are revalidated with a
+conditional request using the ETag or Last-Modified header of the cached
+copy.
+
+The cache is an LRU bounded by the total size of the cached files. The
+directory is scanned once when the cache is made, using the modification time
+of the files as the time they were last used, and the sizes and order of use
+are then kept in memory. It is safe to share one cache directory between
+processes, though each process only evicts the files it knows about.
+"""
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import rapidjson as json
+
+from .fetch import get_http_session, TIMEOUT
+
+# the default maximum size of the cache
+MAX_CACHE_BYTES = 5 * 1000**3
+
+ASSET_CACHE = None
+
+
+class AssetCache:
+    """A size-bounded LRU cache of downloaded files keyed by URL.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory to keep the files in.
+    max_bytes : int, optional
+        The maximum total size of the cached files.
+
+    Attributes
+    ----------
+    hits : int
+        The number of fetches served from the cache without a request.
+    revalidated : int
+        The number of fetches served from the cache after the server said
+        the cached copy is current.
+    misses : int
+        The number of fetches that downloaded the file.
+    """
+    def __init__(self, cache_dir, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        # path -> size, used the longest time ago first
+        self._entries = OrderedDict()
+        self._total = 0
+        self._scan()
+
+    def _scan(self):
+        entries = []
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith(".tmp") or fn.endswith(".meta.json"):
+                continue
+            pth = os.path.join(self.cache_dir, fn)
+            try:
+                stat = os.stat(pth)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, pth))
+
+        for _, size, pth in sorted(entries):
+            self._entries[pth] = size
+            self._total += size
+
+    def _get_paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        pth = os.path.join(self.cache_dir, key)
+        return pth, pth + ".meta.json"
+
+    def _read(self, pth):
+        try:
+            with open(pth, "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            # another process evicted it
+            with self._lock:
+                self._total -= self._entries.pop(pth, 0)
+            return None
+        # the modification time orders the files when the cache is made again
+        os.utime(pth)
+        with self._lock:
+            self._add(pth, len(data))
+        return data
+
+    def _write(self, pth, data):
+        tmp_pth = f"{pth}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_pth, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_pth, pth)
+
+    def _add(self, pth, size):
+        self._total += size - self._entries.pop(pth, 0)
+        self._entries[pth] = size
+
+    def _trim(self):
+        while self._total > self.max_bytes and self._entries:
+            pth, size = self._entries.popitem(last=False)
+            for _pth in [pth, pth + ".meta.json"]:
+                try:
+                    os.remove(_pth)
+                except FileNotFoundError:
+                    pass
+            self._total -= size
+
+    def fetch(self, url, immutable=True):
+        """Get the contents of a URL, downloading it only if needed.
+
+        Parameters
+        ----------
+        url : str
+            The URL.
+        immutable : bool, optional
+            If True, the contents of the URL never change so a cached copy is
+            used without asking the server.
+
+        Returns
+        -------
+        data : bytes
+            The contents of the URL.
+        """
+        pth, meta_pth = self._get_paths(url)
+
+        headers = {}
+        if os.path.exists(pth):
+            if immutable:
+                data = self._read(pth)
+                if data is not None:
+                    with self._lock:
+                        self.hits += 1
+                    return data
+            elif os.path.exists(meta_pth):
+                with open(meta_pth, "r") as fp:
+                    meta = json.load(fp)
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+
+        r = get_http_session().get(url, headers=headers, timeout=TIMEOUT)
+        if r.status_code == 304:
+            data = self._read(pth)
+            if data is not None:
+                with self._lock:
+                    self.revalidated += 1
+                return data
+            r = get_http_session().get(url, timeout=TIMEOUT)
+        r.raise_for_status()
+
+        self._write(pth, r.content)
+        if not immutable:
+            self._write(
+                meta_pth,
+                json.dumps({
+                    "url": url,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "fetched_at": time.time(),
+                }).encode("utf-8"),
+            )
+        with self._lock:
+            self.misses += 1
+            self._add(pth, len(r.content))
+            self._trim()
+        return r.content
+
+
+def init_asset_cache(cache_dir, max_bytes=MAX_CACHE_BYTES):
+    """Start caching fetched assets on disk in `cache_dir`."""
+    global ASSET_CACHE
+    ASSET_CACHE = AssetCache(cache_dir, max_bytes=max_bytes)
+
+
+def get_asset_cache():
+    return ASSET_CACHE
+
+
+def fetch_url(url, immutable=True):
+    """Get the contents of a URL, using the asset cache if it is enabled.
+
+    See `AssetCache.fetch` for the parameters.
+    """
+    if ASSET_CACHE is not None:
+        return ASSET_CACHE.fetch(url, immutable=immutable)
+    r = get_http_session().get(url, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.content
@@ -0,0 +1,256 @@
+"""A cache of the channeldata entries of the repodata shards.
+
+Building channeldata needs the `channeldata` field of the shard for every
+candidate package. Those shards were already parsed when the repodata was
+built, so we keep their channeldata entries here, keyed by `<subdir>/<fn>`,
+instead of reading the shards again.
+
+Entries are kept in an in-memory LRU. Optionally, entries are also kept in
+an on-disk LRU (a sqlite database) so that they survive restarts and the
+in-memory part can stay small.
+"""
+import os
+import time
+import sqlite3
+import weakref
+import threading
+from collections import OrderedDict
+
+import rapidjson as json
+
+# the default maximum number of entries to keep in memory
+MAX_MEM_ENTRIES = 250_000
+
+# the fraction of the disk cache to clear when it goes over its size limit
+DISK_TRIM_FRACTION = 0.1
+
+# the number of keys looked up in the disk cache in one query (sqlite limits
+# the number of parameters of a query)
+DISK_BATCH_SIZE = 500
+
+CACHES = weakref.WeakSet()
+
+
+def _detach_caches_in_child():
+    for cache in CACHES:
+        cache._detach()
+
+
+os.register_at_fork(after_in_child=_detach_caches_in_child)
+
+
+class ChannelDataCache:
+    """An LRU cache of shard channeldata entries.
+
+    Parameters
+    ----------
+    max_mem_entries : int, optional
+        The maximum number of entries to keep in memory.
+    cache_dir : str, optional
+        If given, entries are also stored in a sqlite database in this
+        directory.
+    max_disk_bytes : int, optional
+        The maximum size of the channeldata in the on-disk cache.
+
+    Attributes
+    ----------
+    hits : int
+        The number of lookups that found an entry.
+    misses : int
+        The number of lookups that did not find an entry.
+    """
+    def __init__(
+        self, max_mem_entries=MAX_MEM_ENTRIES, cache_dir=None, max_disk_bytes=None,
+    ):
+        self.max_mem_entries = max_mem_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._changes = None
+        self._db = None
+        self._parent_db = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._db = sqlite3.connect(
+                os.path.join(cache_dir, "channeldata.sqlite"),
+                check_same_thread=False,
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS channeldata ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)"
+            )
+            self._db.commit()
+        CACHES.add(self)
+
+    def _detach(self):
+        # a forked child must not use the sqlite connection of its parent so
+        # it only keeps entries in memory
+        self._lock = threading.Lock()
+        self._parent_db = self._db
+        self._db = None
+
+    def track_changes(self):
+        """Start recording the changes made to the cache so that they can be
+        sent to another process with `pop_changes`."""
+        with self._lock:
+            self._changes = ({}, set())
+
+    def pop_changes(self):
+        """Return the changes made since `track_changes` was called and stop
+        recording them.
+
+        Returns
+        -------
+        entries : dict
+            The entries that were added or replaced.
+        removed : set of str
+            The keys that were removed.
+        """
+        with self._lock:
+            changes = self._changes
+            self._changes = None
+        if changes is None:
+            return {}, set()
+        entries, removed = changes
+        # entries can fall out of the in-memory LRU, in which case the
+        # receiving process will read them again on a miss
+        return (
+            {k: v for k, v in entries.items() if k in self._mem},
+            removed,
+        )
+
+    def _put_mem(self, key, entry):
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_mem_entries:
+            self._mem.popitem(last=False)
+
+    def _trim_disk(self):
+        if self.max_disk_bytes is None:
+            return
+        size, n_entries = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM channeldata"
+        ).fetchone()
+        while size > self.max_disk_bytes and n_entries > 0:
+            n_delete = max(int(n_entries * DISK_TRIM_FRACTION), 1)
+            self._db.execute(
+                "DELETE FROM channeldata WHERE key IN ("
+                "SELECT key FROM channeldata ORDER BY atime LIMIT ?)",
+                (n_delete,),
+            )
+            size, n_entries = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0), COUNT(*) FROM channeldata"
+            ).fetchone()
+
+    def update(self, entries):
+        """Add or replace entries.
+
+        Parameters
+        ----------
+        entries : dict
+            A dictionary mapping `<subdir>/<fn>` to a tuple of the channeldata
+            entry and the channeldata version.
+        """
+        with self._lock:
+            for key, entry in entries.items():
+                self._put_mem(key, entry)
+            if self._changes is not None:
+                self._changes[0].update(entries)
+                self._changes[1].difference_update(entries)
+
+            if self._db is not None and entries:
+                now = time.time()
+                rows = []
+                for key, entry in entries.items():
+                    value = json.dumps(entry).encode("utf-8")
+                    rows.append((key, value, len(value), now))
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO channeldata VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+                self._trim_disk()
+                self._db.commit()
+
+    def update_from_shards(self, shards):
+        """Add the channeldata entries of a dictionary of shards keyed by
+        `<subdir>/<fn>`."""
+        self.update({
+            key: (shard["channeldata"], shard["channeldata_version"])
+            for key, shard in shards.items()
+        })
+
+    def remove(self, keys):
+        """Remove entries by `<subdir>/<fn>`."""
+        keys = list(keys)
+        with self._lock:
+            for key in keys:
+                self._mem.pop(key, None)
+            if self._changes is not None:
+                for key in keys:
+                    self._changes[0].pop(key, None)
+                self._changes[1].update(keys)
+
+            if self._db is not None and keys:
+                self._db.executemany(
+                    "DELETE FROM channeldata WHERE key = ?",
+                    [(key,) for key in keys],
+                )
+                self._db.commit()
+
+    def get_many(self, keys):
+        """Look up entries by `<subdir>/<fn>`.
+
+        Returns
+        -------
+        entries : dict
+            A dictionary mapping the keys that were found to a tuple of a
+            copy of the channeldata entry and the channeldata version.
+        """
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            disk_keys = []
+            for key in keys:
+                if key in self._mem:
+                    self._mem.move_to_end(key)
+                    found[key] = self._mem[key]
+                else:
+                    disk_keys.append(key)
+
+            if self._db is not None and disk_keys:
+                now = time.time()
+                disk_found = []
+                for i in range(0, len(disk_keys), DISK_BATCH_SIZE):
+                    batch = disk_keys[i:i + DISK_BATCH_SIZE]
+                    disk_found.extend(self._db.execute(
+                        "SELECT key, value FROM channeldata WHERE key IN (%s)"
+                        % ", ".join("?" * len(batch)),
+                        batch,
+                    ))
+                for key, value in disk_found:
+                    data, cdver = json.loads(value)
+                    found[key] = (data, cdver)
+                    self._put_mem(key, found[key])
+                if disk_found:
+                    self._db.executemany(
+                        "UPDATE channeldata SET atime = ? WHERE key = ?",
+                        [(now, key) for key, _ in disk_found],
+                    )
+                    self._db.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        # the entries are updated in place when building channeldata
+        return {
+            key: (dict(data) if data is not None else None, cdver)
+            for key, (data, cdver) in found.items()
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
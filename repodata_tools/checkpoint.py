@@ -0,0 +1,112 @@
+"""Binary checkpoints of the repo worker state for warm restarts.
+
+A checkpoint is a one-line JSON header followed by a zstd-compressed pickle
+of the state,
+
+    {"version": 1, "repodata-shards-sha": ..., "repodata-patches-sha": ...,
+     "updated_at": ...}\\n
+    <zstd frame with a content checksum of the pickled state>
+
+The header records which links the state belongs to so that a checkpoint is
+only used if it matches the links of the latest release. The state is pickled
+in one go so that records shared between its parts stay shared.
+"""
+import os
+import pickle
+
+import zstandard
+import rapidjson as json
+
+CHECKPOINT_VERSION = 1
+
+STATE_KEYS = (
+    "all_repodata",
+    "all_patched_repodata",
+    "all_channeldata",
+    "all_channeldata_fingerprints",
+    "all_links",
+)
+
+
+def _make_header(links):
+    return {
+        "version": CHECKPOINT_VERSION,
+        "repodata-shards-sha": links["current-shas"].get("repodata-shards-sha"),
+        "repodata-patches-sha": links["current-shas"].get("repodata-patches-sha"),
+        "updated_at": links.get("updated_at"),
+    }
+
+
+def write_checkpoint(pth, state):
+    """Write a checkpoint of the worker state.
+
+    Parameters
+    ----------
+    pth : str
+        The path to write the checkpoint to.
+    state : dict
+        The worker state. It must have the keys in `STATE_KEYS`.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(pth)), exist_ok=True)
+    tmp_pth = pth + ".tmp"
+    with open(tmp_pth, "wb") as fp:
+        fp.write(json.dumps(_make_header(state["all_links"])).encode("utf-8"))
+        fp.write(b"\n")
+        cctx = zstandard.ZstdCompressor(level=3, threads=-1, write_checksum=True)
+        with cctx.stream_writer(fp, closefd=False) as writer:
+            pickle.dump(
+                {k: state[k] for k in STATE_KEYS},
+                writer,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    os.replace(tmp_pth, pth)
+
+
+def read_checkpoint(pth, links):
+    """Read a checkpoint of the worker state if it is valid.
+
+    Parameters
+    ----------
+    pth : str
+        The path of the checkpoint.
+    links : dict
+        The links of the latest release. The checkpoint is only used if it
+        was made for the same links.
+
+    Returns
+    -------
+    state : dict or None
+        The worker state with the keys in `STATE_KEYS` or None if there is
+        no valid checkpoint.
+    """
+    if not os.path.exists(pth):
+        return None
+
+    with open(pth, "rb") as fp:
+        try:
+            header = json.loads(fp.readline().decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            print("the checkpoint header is corrupted", flush=True)
+            return None
+
+        expected_header = _make_header(links)
+        if header != expected_header:
+            print(
+                "the checkpoint %r does not match the latest links %r" % (
+                    header, expected_header,
+                ),
+                flush=True,
+            )
+            return None
+
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(fp) as reader:
+                state = pickle.load(reader)
+        except Exception as e:
+            print("the checkpoint is corrupted: %s" % repr(e), flush=True)
+            return None
+
+    if set(state) != set(STATE_KEYS):
+        print("the checkpoint is missing parts of the state", flush=True)
+        return None
+    return state
@@ -0,0 +1,297 @@
+"""In-process compression of repodata products.
+
+bz2 outputs are made by compressing chunks of the data in parallel and
+concatenating the resulting streams. A concatenation of bz2 streams is itself
+a valid bz2 file (this is what pbzip2 does) and is read by `bzip2 -d`,
+python's `bz2` module and conda. Both bz2 and zstd release the GIL, so a
+thread pool is enough to use every core.
+
+When the data comes in segments that are stable from one build to the next
+(see `serialize.JSONFragmentCache.dumps_segments`), the compressed bz2 stream
+of each segment is cached and only new segments are compressed. zstd outputs
+are always written as a single frame since some readers (e.g.,
+`zstandard.ZstdDecompressor().decompress`) stop after the first frame.
+"""
+import os
+import bz2
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import zstandard
+
+# about 4 bzip2 blocks of 900 kB at level 9
+BZ2_CHUNK_SIZE = 4 * 900_000
+BZ2_LEVEL = 9
+ZSTD_LEVEL = 16
+
+# the maximum size of the cached compressed segments over all files
+MAX_SEGMENT_CACHE_BYTES = 500 * 1000**2
+
+# the number of artifacts to compress at once
+N_ARTIFACT_THREADS = 4
+# the number of artifacts that can be waiting to be compressed or being
+# compressed - each one holds all of its data
+MAX_PENDING_ARTIFACTS = 2 * N_ARTIFACT_THREADS
+
+CONTENT_TYPES = {
+    "bz2": "application/x-bzip2",
+    "zst": "application/zstd",
+}
+
+CHUNK_EXECUTOR = None
+ARTIFACT_EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+PENDING_ARTIFACTS = threading.BoundedSemaphore(MAX_PENDING_ARTIFACTS)
+
+
+def _reset_executors_in_child():
+    # the threads of the parent's pools do not exist in a forked child
+    global CHUNK_EXECUTOR, ARTIFACT_EXECUTOR, EXECUTOR_LOCK, PENDING_ARTIFACTS
+    CHUNK_EXECUTOR = None
+    ARTIFACT_EXECUTOR = None
+    EXECUTOR_LOCK = threading.Lock()
+    PENDING_ARTIFACTS = threading.BoundedSemaphore(MAX_PENDING_ARTIFACTS)
+    SEGMENT_CACHE._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_executors_in_child)
+
+
+def _get_chunk_executor():
+    global CHUNK_EXECUTOR
+    with EXECUTOR_LOCK:
+        if CHUNK_EXECUTOR is None:
+            CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+    return CHUNK_EXECUTOR
+
+
+def get_compression_executor():
+    """Get the pool used to compress whole artifacts in the background."""
+    global ARTIFACT_EXECUTOR
+    with EXECUTOR_LOCK:
+        if ARTIFACT_EXECUTOR is None:
+            ARTIFACT_EXECUTOR = ThreadPoolExecutor(max_workers=N_ARTIFACT_THREADS)
+    return ARTIFACT_EXECUTOR
+
+
+def submit_compression(fn, *args, **kwargs):
+    """Run `fn(*args, **kwargs)` in the pool used to compress whole artifacts.
+
+    This blocks while `MAX_PENDING_ARTIFACTS` calls are waiting to run or
+    running so that the data waiting to be compressed stays bounded.
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        The future for the result of the call.
+    """
+    pending = PENDING_ARTIFACTS
+    pending.acquire()
+    try:
+        fut = get_compression_executor().submit(fn, *args, **kwargs)
+    except BaseException:
+        pending.release()
+        raise
+    fut.add_done_callback(lambda _: pending.release())
+    return fut
+
+
+def shutdown_compression_executors():
+    """Stop the threads of the compression pools, e.g., before forking.
+
+    The pools are made again when they are used next.
+    """
+    global CHUNK_EXECUTOR, ARTIFACT_EXECUTOR
+    with EXECUTOR_LOCK:
+        executors = [CHUNK_EXECUTOR, ARTIFACT_EXECUTOR]
+        CHUNK_EXECUTOR = None
+        ARTIFACT_EXECUTOR = None
+    for executor in executors:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def _split(data, chunk_size):
+    view = memoryview(data)
+    return [view[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def bz2_compress(segments, compresslevel=BZ2_LEVEL, chunk_size=BZ2_CHUNK_SIZE):
+    """Compress segments of data to bz2 in parallel.
+
+    Parameters
+    ----------
+    segments : list of bytes
+        The segments of the data.
+    compresslevel : int, optional
+        The bz2 compression level.
+    chunk_size : int, optional
+        Segments bigger than this are split into chunks of this size.
+
+    Returns
+    -------
+    streams : list of bytes
+        The compressed segments. Each one is one or more bz2 streams.
+    """
+    jobs = []
+    for i, segment in enumerate(segments):
+        for chunk in _split(segment, chunk_size):
+            jobs.append((i, chunk))
+
+    streams = [[] for _ in segments]
+    for (i, _), stream in zip(
+        jobs,
+        _get_chunk_executor().map(
+            lambda job: bz2.compress(job[1], compresslevel), jobs
+        ),
+    ):
+        streams[i].append(stream)
+    return [b"".join(stream) for stream in streams]
+
+
+def zstd_compress(segments, level=ZSTD_LEVEL):
+    """Compress segments of data to a single zstd frame using all cores."""
+    cobj = zstandard.ZstdCompressor(level=level, threads=-1).compressobj(
+        size=sum(len(segment) for segment in segments)
+    )
+    compressed = [cobj.compress(segment) for segment in segments]
+    compressed.append(cobj.flush())
+    return b"".join(compressed)
+
+
+class SegmentCache:
+    """An LRU cache of the compressed bz2 streams of the segments of a set of
+    files.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The maximum size of the compressed segments over all files. Files
+        that have not been compressed for the longest time are dropped first.
+
+    Attributes
+    ----------
+    hits : int
+        The number of segments whose compressed stream was reused.
+    misses : int
+        The number of segments that had to be compressed.
+    """
+    def __init__(self, max_bytes=MAX_SEGMENT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _put_file(self, name, streams):
+        with self._lock:
+            self._files.pop(name, None)
+            self._files[name] = streams
+            total = sum(
+                sum(len(v) for v in _streams.values())
+                for _streams in self._files.values()
+            )
+            while total > self.max_bytes and len(self._files) > 1:
+                _, _streams = self._files.popitem(last=False)
+                total -= sum(len(v) for v in _streams.values())
+
+    def get_files(self, names):
+        """Get the cached streams for a set of files so that they can be
+        sent to another process."""
+        with self._lock:
+            return {
+                name: self._files[name]
+                for name in names
+                if name in self._files
+            }
+
+    def update_files(self, files):
+        """Add the output of `get_files` from another process."""
+        for name, streams in files.items():
+            self._put_file(name, streams)
+
+    def bz2_compress(self, name, segments, compresslevel=BZ2_LEVEL):
+        """Compress a list of segments to bz2, reusing the streams of segments
+        that are the same as the last time a file with the same name was
+        compressed.
+
+        Parameters
+        ----------
+        name : str
+            The name of the file, used to find the cached streams.
+        segments : list of bytes
+            The segments of the data.
+        compresslevel : int, optional
+            The bz2 compression level.
+
+        Returns
+        -------
+        compressed : bytes
+            The compressed data, one bz2 stream per segment.
+        """
+        with self._lock:
+            old_streams = self._files.get(name, {})
+
+        keys = [
+            hashlib.blake2b(segment, digest_size=16).digest()
+            for segment in segments
+        ]
+        todo = {}
+        for key, segment in zip(keys, segments):
+            if key not in old_streams:
+                todo[key] = segment
+
+        streams = {key: old_streams[key] for key in keys if key in old_streams}
+        streams.update(zip(
+            todo,
+            bz2_compress(list(todo.values()), compresslevel=compresslevel),
+        ))
+        self.hits += len(segments) - len(todo)
+        self.misses += len(todo)
+
+        self._put_file(name, streams)
+        return b"".join([streams[key] for key in keys])
+
+
+SEGMENT_CACHE = SegmentCache()
+
+
+def get_segment_cache():
+    return SEGMENT_CACHE
+
+
+def compress_to_file(segments, pth, fmt):
+    """Compress data and write it to a file.
+
+    Parameters
+    ----------
+    segments : list of bytes
+        The data to compress, split into segments. For bz2, the streams of
+        segments that are the same as the last time a file with the same name
+        was compressed are reused, so the segments should be stable from one
+        build to the next.
+    pth : str
+        The path to write the compressed data to.
+    fmt : str
+        The compression format, one of "bz2" or "zst".
+
+    Returns
+    -------
+    size : int
+        The size of the compressed data in bytes.
+    sha256 : str
+        The hex sha256 hash of the compressed data.
+    """
+    if fmt == "bz2":
+        compressed = SEGMENT_CACHE.bz2_compress(os.path.basename(pth), segments)
+    elif fmt == "zst":
+        compressed = zstd_compress(segments)
+    else:
+        raise RuntimeError("Compression format %s is not supported!" % fmt)
+    tmp_pth = pth + ".tmp"
+    with open(tmp_pth, "wb") as fp:
+        fp.write(compressed)
+    os.replace(tmp_pth, pth)
+    return len(compressed), hashlib.sha256(compressed).hexdigest()
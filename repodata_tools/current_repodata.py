@@ -0,0 +1,518 @@
+"""Incremental builds of current_repodata.json.
+
+current_repodata.json holds the records of the newest version of every
+package in a repodata file plus the records needed to install them. conda-build
+(`conda_build.index._build_current_repodata`) makes it by loading all of the
+records into conda's solver, which takes seconds for the big subdirs and is
+done again for every label that changed in every update.
+
+A `CurrentRepodataIndex` makes the same file from an index of the records by
+package name that is kept from one update to the next. Only the names whose
+records were added, removed or changed are sorted and matched again, and the
+records each dependency spec pulls in are cached until the records of the
+name it refers to change. The records are selected like conda-build does,
+
+1. for each name, the records with the newest version, i.e., every build of
+   that version (for each python, variant, etc.),
+2. for each dependency of these records that none of them satisfy, the
+   records with the version of the newest record that does,
+3. for each name whose records so far have features, the newest record
+   without features that is not newer than the newest one kept.
+
+Records are ordered by conda's version order, build number, timestamp and
+build string as in conda's solver, and a .tar.bz2 record is ignored if there
+is a .conda record for the same file. Like conda-build, the `legacy_bz2_md5`
+of the .conda records that are kept is set, though only on copies of the
+records in the current repodata. conda-build sets it in the repodata itself,
+which would make the repodata differ from the repodata.json it was written to
+(e.g., the snapshot its .jlap log is diffed against).
+
+Repodata the index cannot handle exactly (e.g., dependency specs with a
+channel or other fields that are not matched by name, version and build)
+raises `UnsupportedRepodataError` so that the caller can use conda-build.
+
+The records are tracked by their identity, so records must not be modified in
+place after a build.
+"""
+import os
+import threading
+from collections import namedtuple
+
+from conda.models.match_spec import MatchSpec
+
+from .records import CompactRecord, compact_record
+from .versions import get_version_key
+
+# the fields of a dependency spec that the index can match records on
+MATCH_FIELDS = frozenset(["name", "version", "build", "build_number"])
+
+# conda restricts a name to the packages of these types if there are any
+UNMANAGEABLE_PACKAGE_TYPES = frozenset([
+    "virtual_python_egg_unmanageable",
+    "virtual_python_egg_link",
+    "virtual_system",
+])
+
+# the parsed specs are kept up to this number
+MAX_MATCH_SPECS = 500_000
+
+_MATCH_SPECS = {}
+
+# the fields of a record used to select it, with the same names as the
+# fields of conda's records so that MatchSpec can match on them
+_Package = namedtuple(
+    "_Package",
+    [
+        "fn",
+        "name",
+        "version",
+        "build",
+        "build_number",
+        "timestamp",
+        "depends",
+        "has_features",
+    ],
+)
+
+
+class UnsupportedRepodataError(Exception):
+    """Raised for repodata the index cannot make current repodata for
+    exactly like conda-build."""
+
+
+def _make_seconds(timestamp):
+    # the same as conda's TimestampField, without rounding
+    if timestamp and timestamp > 253402300799:  # 9999-12-31
+        timestamp /= 1000
+    return timestamp
+
+
+def _has_features(value):
+    # conda splits features on spaces and commas and drops empty ones
+    if not value:
+        return False
+    if isinstance(value, str):
+        value = value.replace(" ", ",").split(",")
+    return any(f.strip() for f in value)
+
+
+def _make_package(fn, record):
+    if record.get("record_version", 0) > 1:
+        # conda ignores these records
+        return None
+    if record.get("package_type") in UNMANAGEABLE_PACKAGE_TYPES:
+        raise UnsupportedRepodataError(
+            "%s has the package type %s" % (fn, record["package_type"])
+        )
+
+    name = record["name"]
+    version = record["version"]
+    depends = tuple(record.get("depends") or ())
+    # conda adds pip to python as a dependency
+    if name == "python" and version.startswith(("2.", "3.")):
+        depends += ("pip",)
+    return _Package(
+        fn,
+        name,
+        version,
+        record.get("build"),
+        record.get("build_number", 0),
+        _make_seconds(record.get("timestamp", 0)),
+        depends,
+        (
+            _has_features(record.get("track_features"))
+            or _has_features(record.get("features"))
+        ),
+    )
+
+
+def _sort_key(package):
+    return (
+        get_version_key(package.version),
+        package.build_number,
+        package.timestamp,
+        package.build,
+    )
+
+
+def _get_match_spec(spec):
+    ms = _MATCH_SPECS.get(spec)
+    if ms is None:
+        ms = MatchSpec(spec)
+        if ms.get_exact_value("name") is None or any(
+            ms.get_raw_value(field) is not None
+            for field in MatchSpec.FIELD_NAMES
+            if field not in MATCH_FIELDS
+        ):
+            raise UnsupportedRepodataError("cannot match the spec %r" % spec)
+        if len(_MATCH_SPECS) >= MAX_MATCH_SPECS:
+            _MATCH_SPECS.clear()
+        _MATCH_SPECS[spec] = ms
+    return ms
+
+
+class CurrentRepodataIndex:
+    """An index of the records of a repodata file for making its current
+    repodata.
+
+    Attributes
+    ----------
+    n_sorted : int
+        The number of names whose records were sorted and matched again in
+        the last update.
+    """
+    def __init__(self):
+        # the records the packages were made from by file name, None for the
+        # records conda ignores
+        self._records = {}
+        self._packages = {}
+        self._packages_by_name = {}
+        # name -> (packages sorted newest first, packages of the newest
+        # version, the dependencies of those)
+        self._groups = {}
+        # the number of names with a dependency on each spec
+        self._spec_counts = {}
+        # spec -> (name, packages the spec pulls in)
+        self._missing = {}
+        self._specs_by_name = {}
+        # name -> file names of the packages kept
+        self._kept = {}
+        self._dirty_specs = set()
+        self._dirty_names = set()
+        # fn -> (record, md5, copy of the record with legacy_bz2_md5 set) for
+        # the .conda records kept in the last build
+        self._current_records = {}
+        self.n_sorted = 0
+
+    def _set_record(self, fn, record, package, changed):
+        self._records[fn] = record
+        old_package = self._packages.get(fn)
+        if package == old_package:
+            self._packages[fn] = package
+            return
+
+        if old_package is not None:
+            packages = self._packages_by_name[old_package.name]
+            del packages[fn]
+            if not packages:
+                del self._packages_by_name[old_package.name]
+            changed.add(old_package.name)
+        self._packages[fn] = package
+        if package is not None:
+            if package.name not in self._packages_by_name:
+                self._packages_by_name[package.name] = {}
+            self._packages_by_name[package.name][fn] = package
+            changed.add(package.name)
+
+    def _remove_record(self, fn, changed):
+        self._set_record(fn, None, None, changed)
+        del self._records[fn]
+        del self._packages[fn]
+
+    def _update_group(self, name):
+        if name in self._groups:
+            for spec in self._groups.pop(name)[2]:
+                self._spec_counts[spec] -= 1
+                if not self._spec_counts[spec]:
+                    self._drop_spec(spec)
+        # the specs that are matched against the records of the name and the
+        # packages kept for it have to be updated
+        self._dirty_specs.update(self._specs_by_name.get(name, ()))
+        self._dirty_names.add(name)
+
+        packages = self._packages_by_name.get(name)
+        if not packages:
+            return
+
+        # ties in the order are broken by file name (conda uses the order of
+        # the records, which is random for .tar.bz2 records)
+        group = sorted(
+            sorted(packages.values(), key=lambda p: p.fn),
+            key=_sort_key,
+            reverse=True,
+        )
+        if len(set((p.version, p.build_number, p.build) for p in group)) < len(group):
+            # conda only keeps one of the records that are the same package
+            raise UnsupportedRepodataError("%s has duplicate packages" % name)
+
+        newest = self._find_version(name, group, group[0].version)
+        depends = set()
+        for package in newest:
+            depends.update(package.depends)
+        for spec in depends:
+            if spec in self._spec_counts:
+                self._spec_counts[spec] += 1
+            else:
+                self._spec_counts[spec] = 1
+                self._dirty_specs.add(spec)
+        self._groups[name] = (group, newest, depends)
+
+    def _drop_spec(self, spec):
+        del self._spec_counts[spec]
+        if spec in self._missing:
+            name, packages = self._missing.pop(spec)
+            self._specs_by_name[name].discard(spec)
+            if not self._specs_by_name[name]:
+                del self._specs_by_name[name]
+            if packages:
+                self._dirty_names.add(name)
+
+    def _find_version(self, name, group, version):
+        ms = _get_match_spec(f"{name}={version}")
+        return tuple(p for p in group if ms.match(p))
+
+    def _find_missing(self, spec):
+        ms = _get_match_spec(spec)
+        name = ms.get_exact_value("name")
+        if name not in self._groups:
+            return (name, ())
+
+        group, newest, _ = self._groups[name]
+        if any(ms.match(p) for p in newest):
+            return (name, ())
+        for package in group:
+            if ms.match(package):
+                return (name, self._find_version(name, group, package.version))
+        return (name, ())
+
+    def _find_kept(self, name):
+        group, newest, _ = self._groups[name]
+        packages = set(newest)
+        for spec in self._specs_by_name.get(name, ()):
+            packages.update(self._missing[spec][1])
+        fns = [p.fn for p in packages]
+
+        if any(p.has_features for p in packages):
+            # keep the newest version without features that is not newer
+            # than the newest one kept
+            latest = get_version_key(max(packages, key=_sort_key).version)
+            for package in group:
+                if (
+                    get_version_key(package.version) <= latest
+                    and not package.has_features
+                ):
+                    fns.append(package.fn)
+                    break
+        return fns
+
+    def update(self, repodata):
+        """Update the index with the records of repodata.
+
+        Returns
+        -------
+        changed : set of str
+            The names whose records changed.
+        """
+        conda_records = repodata.get("packages.conda", {})
+        legacy_records = repodata.get("packages", {})
+
+        changed = set()
+        new_conda_fns = []
+        for fn, record in conda_records.items():
+            if self._records.get(fn) is not record:
+                if not fn.endswith(".conda"):
+                    raise UnsupportedRepodataError("%s is not a .conda file" % fn)
+                if fn not in self._records:
+                    new_conda_fns.append(fn)
+                self._set_record(fn, record, _make_package(fn, record), changed)
+
+        rechecked = set()
+        n_new_legacy = 0
+        for fn, record in legacy_records.items():
+            if self._records.get(fn) is not record:
+                if not fn.endswith(".tar.bz2"):
+                    raise UnsupportedRepodataError("%s is not a .tar.bz2 file" % fn)
+                if fn not in self._records:
+                    n_new_legacy += 1
+                rechecked.add(fn)
+        # conda only uses the .conda file if there are both
+        rechecked.update(
+            fn[:-6] + ".tar.bz2"
+            for fn in new_conda_fns
+            if fn[:-6] + ".tar.bz2" in legacy_records
+        )
+
+        # all of the records we know are still there unless there are more
+        n_known = len(conda_records) + len(legacy_records) - n_new_legacy
+        if len(self._records) > n_known:
+            removed = [
+                fn
+                for fn in self._records
+                if fn not in conda_records and fn not in legacy_records
+            ]
+            for fn in removed:
+                self._remove_record(fn, changed)
+            rechecked.update(
+                fn[:-6] + ".tar.bz2"
+                for fn in removed
+                if fn[:-6] + ".tar.bz2" in legacy_records
+            )
+
+        for fn in rechecked:
+            record = legacy_records[fn]
+            if fn[:-8] + ".conda" in conda_records:
+                package = None
+            else:
+                package = _make_package(fn, record)
+            self._set_record(fn, record, package, changed)
+
+        for name in changed:
+            self._update_group(name)
+        self.n_sorted = len(changed)
+        return changed
+
+    def select(self):
+        """Select the file names of the records in the current repodata."""
+        for spec in self._dirty_specs:
+            if spec not in self._spec_counts:
+                continue
+            result = self._find_missing(spec)
+            old_result = self._missing.get(spec)
+            if old_result != result:
+                self._missing[spec] = result
+                if result[0] not in self._specs_by_name:
+                    self._specs_by_name[result[0]] = set()
+                self._specs_by_name[result[0]].add(spec)
+                if result[1] or (old_result is not None and old_result[1]):
+                    self._dirty_names.add(result[0])
+        self._dirty_specs = set()
+
+        for name in self._dirty_names:
+            if name in self._groups:
+                self._kept[name] = self._find_kept(name)
+            else:
+                self._kept.pop(name, None)
+        self._dirty_names = set()
+
+        fns = set()
+        for kept in self._kept.values():
+            fns.update(kept)
+        return fns
+
+    def build(self, repodata):
+        """Make the current repodata of repodata.
+
+        Parameters
+        ----------
+        repodata : dict
+            The repodata. It is not changed.
+
+        Returns
+        -------
+        current_repodata : dict
+            The current repodata. Its records are the records of `repodata`,
+            except for .conda records with a different `legacy_bz2_md5`,
+            which are copies of them.
+        """
+        self.update(repodata)
+        fns = self.select()
+
+        current_repodata = {
+            k: v
+            for k, v in repodata.items()
+            if k not in ("packages", "packages.conda")
+        }
+        legacy_records = repodata.get("packages", {})
+        conda_records = repodata.get("packages.conda", {})
+        packages = {}
+        conda_packages = {}
+        current_records = {}
+        for fn in sorted(fns):
+            if fn.endswith(".conda"):
+                # we use the md5 of the .tar.bz2 file for the same package so
+                # that the package does not look changed to clients
+                counterpart = fn.replace(".conda", ".tar.bz2")
+                md5 = legacy_records.get(counterpart, {}).get("md5")
+                record = conda_records[fn]
+                if "legacy_bz2_md5" not in record or record["legacy_bz2_md5"] != md5:
+                    # the copy from the last build is reused so that the
+                    # caches of the files it was written to still hit
+                    cached = self._current_records.get(fn)
+                    if cached is not None and cached[0] is record and cached[1] == md5:
+                        current_record = cached[2]
+                    elif isinstance(record, CompactRecord):
+                        new_record = record.to_dict()
+                        new_record["legacy_bz2_md5"] = md5
+                        current_record = compact_record(new_record, base=record)
+                    else:
+                        current_record = dict(record, legacy_bz2_md5=md5)
+                    current_records[fn] = (record, md5, current_record)
+                    record = current_record
+                conda_packages[fn] = record
+            else:
+                packages[fn] = legacy_records[fn]
+        self._current_records = current_records
+        current_repodata["packages"] = packages
+        current_repodata["packages.conda"] = conda_packages
+        return current_repodata
+
+
+class CurrentRepodataStore:
+    """The indexes of a set of current repodata files."""
+    def __init__(self):
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def build(self, name, repodata):
+        """Make current repodata, updating the index of the last build of a
+        file with the same name.
+
+        Parameters
+        ----------
+        name : str
+            The name of the current repodata file.
+        repodata : dict
+            The repodata. See `CurrentRepodataIndex.build`.
+
+        Returns
+        -------
+        current_repodata : dict
+            The current repodata.
+        """
+        with self._lock:
+            index = self._files.pop(name, None)
+        if index is None:
+            index = CurrentRepodataIndex()
+
+        # the index is dropped if the build fails since it is only partly
+        # updated
+        current_repodata = index.build(repodata)
+
+        with self._lock:
+            self._files[name] = index
+        return current_repodata
+
+    def get_files(self, names):
+        """Get the indexes for a set of files so that they can be sent to
+        another process along with the records they refer to."""
+        with self._lock:
+            return {
+                name: self._files[name]
+                for name in names
+                if name in self._files
+            }
+
+    def update_files(self, files):
+        """Add the output of `get_files` from another process."""
+        with self._lock:
+            self._files.update(files)
+
+    def drop_files(self, names):
+        """Drop the indexes for a set of files."""
+        with self._lock:
+            for name in names:
+                self._files.pop(name, None)
+
+
+CURRENT_REPODATA_STORE = CurrentRepodataStore()
+
+
+def _reset_store_lock_in_child():
+    CURRENT_REPODATA_STORE._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_store_lock_in_child)
+
+
+def get_current_repodata_store():
+    return CURRENT_REPODATA_STORE
@@ -0,0 +1,308 @@
+import io
+import os
+import hmac
+import time
+import random
+import hashlib
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .utils import split_pkg
+
+CHUNK_SIZE = 1024 * 1024
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+POOL_SIZE = 32
+MAX_ATTEMPTS = 5
+TIMEOUT = (30, 300)
+MIN_RANGE_SIZE = 64 * 1024
+
+SESSION = None
+SESSION_LOCK = threading.Lock()
+
+
+def get_http_session():
+    """Get the shared HTTP session for this process.
+
+    The session keeps a pool of connections open so that repeated package
+    downloads from the same hosts do not pay for new TCP/TLS handshakes.
+    """
+    global SESSION
+
+    with SESSION_LOCK:
+        if SESSION is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE,
+                pool_maxsize=POOL_SIZE,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            SESSION = session
+
+    return SESSION
+
+
+def _reset_http_session_in_child():
+    # a forked child must not share the pooled connections of its parent
+    global SESSION, SESSION_LOCK
+    SESSION = None
+    SESSION_LOCK = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_http_session_in_child)
+
+
+def get_package_urls(url, subdir, pkg):
+    """Get the list of URLs to try for a package.
+
+    Sometimes the anaconda.org CDN urls fail, so we fall back to the one you
+    get out of the web UI.
+    """
+    _, name, ver, _ = split_pkg(os.path.join(subdir, pkg))
+    return [
+        url,
+        f"https://anaconda.org/conda-forge/{name}/{ver}/download/{subdir}/{pkg}",
+    ]
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """A read-only, seekable file backed by HTTP Range requests.
+
+    Every range that is fetched is kept in memory so that reads which
+    go back over data we already have do not make new requests. The server
+    must honor Range requests.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the file.
+    min_range_size : int, optional
+        The minimum number of bytes to fetch per request.
+
+    Attributes
+    ----------
+    size : int
+        The total size of the file in bytes.
+    n_requests : int
+        The number of requests made so far.
+    bytes_fetched : int
+        The number of bytes fetched so far.
+    """
+    def __init__(self, url, min_range_size=MIN_RANGE_SIZE):
+        super().__init__()
+        self.url = url
+        self.min_range_size = min_range_size
+        self.n_requests = 0
+        self.bytes_fetched = 0
+        self._blocks = []
+        self._pos = 0
+
+        # the tail of the file has the zip central directory so we start
+        # there, which also tells us the size of the file
+        start, data, self.size = self._get_range(f"bytes=-{min_range_size}")
+        self._blocks.append((start, data))
+
+    def _get_range(self, byte_range):
+        r = get_http_session().get(
+            self.url, headers={"Range": byte_range}, timeout=TIMEOUT,
+        )
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise RuntimeError(
+                "server for %s does not support range requests!" % self.url
+            )
+        self.n_requests += 1
+        self.bytes_fetched += len(r.content)
+
+        # Content-Range: bytes <start>-<end>/<size>
+        _range, size = r.headers["Content-Range"].split(" ", 1)[1].split("/")
+        return int(_range.split("-")[0]), r.content, int(size)
+
+    def prefetch(self, start, length):
+        """Fetch `length` bytes starting at `start` with a single request."""
+        end = min(start + max(length, self.min_range_size), self.size) - 1
+        if start <= end:
+            start, data, _ = self._get_range(f"bytes={start}-{end}")
+            self._blocks.append((start, data))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        self._pos = max(self._pos, 0)
+        return self._pos
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self._pos)
+        if n <= 0:
+            return 0
+
+        for start, data in self._blocks:
+            if start <= self._pos < start + len(data):
+                break
+        else:
+            self.prefetch(self._pos, n)
+            start, data = self._blocks[-1]
+
+        offset = self._pos - start
+        chunk = data[offset:offset + n]
+        b[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+
+def _stream_to_file(r, fp, hashers):
+    size = 0
+    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+        if chunk:
+            fp.write(chunk)
+            for hasher in hashers:
+                hasher.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def _get_expected_size(r):
+    if r.status_code == 206:
+        total = r.headers.get("Content-Range", "*").rsplit("/", 1)[-1]
+        if total != "*":
+            return int(total)
+    elif "Content-Length" in r.headers and "Content-Encoding" not in r.headers:
+        return int(r.headers["Content-Length"])
+    return None
+
+
+def download_url(url, pth, max_attempts=MAX_ATTEMPTS):
+    """Download a URL to a path, computing the md5 and sha256 as we go.
+
+    If the connection drops, the download is resumed with a HTTP Range
+    request instead of starting over.
+
+    Parameters
+    ----------
+    url : str
+        The URL to download.
+    pth : str
+        The path to write the data to.
+    max_attempts : int, optional
+        The maximum number of requests to make.
+
+    Returns
+    -------
+    info : dict
+        A dictionary with the keys "md5", "sha256" and "size".
+    """
+    session = get_http_session()
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+    attempt = 0
+
+    with open(pth, "wb", buffering=WRITE_BUFFER_SIZE) as fp:
+        while True:
+            attempt += 1
+            headers = {}
+            if size > 0:
+                headers["Range"] = "bytes=%d-" % size
+
+            try:
+                with session.get(
+                    url, headers=headers, stream=True, timeout=TIMEOUT,
+                ) as r:
+                    r.raise_for_status()
+
+                    if size > 0 and r.status_code != 206:
+                        # the server ignored the range so we start over
+                        fp.seek(0)
+                        fp.truncate()
+                        md5 = hashlib.md5()
+                        sha256 = hashlib.sha256()
+                        size = 0
+
+                    expected_size = _get_expected_size(r)
+                    size += _stream_to_file(r, fp, (md5, sha256))
+
+                    if expected_size is not None and size < expected_size:
+                        raise requests.exceptions.ChunkedEncodingError(
+                            "download of %s ended early" % url
+                        )
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout,
+            ) as e:
+                if attempt >= max_attempts:
+                    raise e
+                fp.flush()
+                time.sleep(random.uniform(0, min(2**attempt, 10)))
+            else:
+                break
+
+    return {"md5": md5.hexdigest(), "sha256": sha256.hexdigest(), "size": size}
+
+
+def download_package(
+    url, pth, subdir, pkg, md5_checksum=None, max_attempts=MAX_ATTEMPTS
+):
+    """Download a package, trying the anaconda.org web UI URL if needed.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the package.
+    pth : str
+        The path to write the package to.
+    subdir : str
+        The subdir of the package.
+    pkg : str
+        The package filename.
+    md5_checksum : str, optional
+        If given, the md5 checksum the downloaded package must have.
+    max_attempts : int, optional
+        The maximum number of requests to make per URL.
+
+    Returns
+    -------
+    info : dict
+        A dictionary with the keys "md5", "sha256", "size" and "url". The
+        URL is the one the package was downloaded from.
+    """
+    urls = get_package_urls(url, subdir, pkg)
+    for i, _url in enumerate(urls):
+        try:
+            info = download_url(_url, pth, max_attempts=max_attempts)
+        except requests.exceptions.RequestException as e:
+            # the next URL is tried whether the server said no or the
+            # connection kept failing
+            if i == len(urls) - 1:
+                raise e
+        else:
+            info["url"] = _url
+            break
+
+    if md5_checksum is not None:
+        if not hmac.compare_digest(info["md5"], md5_checksum):
+            raise RuntimeError(
+                "md5 chechsum is incorrect: "
+                "download=%s sent=%s exiting!" % (
+                    info["md5"], md5_checksum
+                )
+            )
+
+    return info
@@ -0,0 +1,187 @@
+"""Read repodata shards straight from the objects of a git repo.
+
+This lets us read the shards of any commit without checking it out. Blobs are
+streamed through a persistent `git cat-file --batch` process per repo so that
+repeated reads do not start new processes.
+"""
+import os
+import atexit
+import threading
+import subprocess
+
+import rapidjson as json
+
+BLOB_READERS = {}
+BLOB_READERS_LOCK = threading.Lock()
+
+
+class GitBlobReader:
+    """Read objects from a git repo through `git cat-file --batch`.
+
+    Parameters
+    ----------
+    repo_pth : str
+        The path to the git repo.
+    """
+    def __init__(self, repo_pth):
+        self.repo_pth = repo_pth
+        self._lock = threading.Lock()
+        self._proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=repo_pth,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc.stdout.close()
+            self._proc = None
+
+    def _read_response(self):
+        header = self._proc.stdout.readline()
+        if not header:
+            raise RuntimeError(
+                "git cat-file for %s exited unexpectedly!" % self.repo_pth
+            )
+        parts = header.decode("utf-8").split()
+        if parts[-1] == "missing":
+            return None
+        size = int(parts[2])
+        data = self._proc.stdout.read(size + 1)
+        return data[:-1]
+
+    def read_many(self, objs):
+        """Read a list of objects.
+
+        Parameters
+        ----------
+        objs : list of str
+            The objects to read in any form git understands (e.g.,
+            "<sha>:<path>").
+
+        Returns
+        -------
+        data : list
+            The contents of each object as bytes or None if it does not exist.
+        """
+        objs = list(objs)
+        with self._lock:
+            # we write the requests from another thread so that the pipes
+            # cannot fill up and deadlock when asking for many objects
+            def _write():
+                for obj in objs:
+                    self._proc.stdin.write(obj.encode("utf-8") + b"\n")
+                self._proc.stdin.flush()
+
+            writer = threading.Thread(target=_write)
+            writer.start()
+            try:
+                return [self._read_response() for _ in objs]
+            finally:
+                writer.join()
+
+    def read(self, obj):
+        return self.read_many([obj])[0]
+
+
+def _close_blob_readers():
+    with BLOB_READERS_LOCK:
+        for reader in BLOB_READERS.values():
+            reader.close()
+        BLOB_READERS.clear()
+
+
+def _reset_blob_readers_in_child():
+    # a forked child must not share the cat-file pipes of its parent
+    global BLOB_READERS_LOCK
+    BLOB_READERS.clear()
+    BLOB_READERS_LOCK = threading.Lock()
+
+
+atexit.register(_close_blob_readers)
+os.register_at_fork(after_in_child=_reset_blob_readers_in_child)
+
+
+def get_blob_reader(repo_pth):
+    """Get the persistent blob reader for a repo."""
+    repo_pth = os.path.abspath(repo_pth)
+    with BLOB_READERS_LOCK:
+        if repo_pth not in BLOB_READERS:
+            BLOB_READERS[repo_pth] = GitBlobReader(repo_pth)
+        return BLOB_READERS[repo_pth]
+
+
+def get_repo_sha(repo_pth, rev="HEAD"):
+    return subprocess.run(
+        ["git", "rev-parse", "--verify", rev],
+        cwd=repo_pth,
+        check=True,
+        capture_output=True,
+    ).stdout.decode("utf-8").strip()
+
+
+def _split_nul(output):
+    return [p for p in output.decode("utf-8").split("\0") if p]
+
+
+def list_tree_paths(repo_pth, sha, prefix):
+    """List the paths of all files under `prefix` at commit `sha`."""
+    output = subprocess.run(
+        ["git", "ls-tree", "-r", "-z", "--name-only", sha, "--", prefix],
+        cwd=repo_pth,
+        check=True,
+        capture_output=True,
+    ).stdout
+    return _split_nul(output)
+
+
+def diff_tree_paths(repo_pth, old_sha, new_sha, prefix):
+    """Get the paths under `prefix` that changed between two commits.
+
+    Returns
+    -------
+    new_or_modified : list of str
+        The paths that were added or modified.
+    removed : list of str
+        The paths that were removed.
+    """
+    output = subprocess.run(
+        [
+            "git", "diff-tree", "-r", "-z", "--no-renames", "--name-status",
+            old_sha, new_sha, "--", prefix,
+        ],
+        cwd=repo_pth,
+        check=True,
+        capture_output=True,
+    ).stdout
+    parts = _split_nul(output)
+
+    new_or_modified = []
+    removed = []
+    for status, pth in zip(parts[0::2], parts[1::2]):
+        if status == "D":
+            removed.append(pth)
+        else:
+            new_or_modified.append(pth)
+    return new_or_modified, removed
+
+
+def read_json_blobs(repo_pth, sha, paths):
+    """Read and decode JSON files at commit `sha`.
+
+    Returns
+    -------
+    data : list
+        The decoded contents of each path, in the same order.
+    """
+    reader = get_blob_reader(repo_pth)
+    blobs = reader.read_many(f"{sha}:{pth}" for pth in paths)
+    data = []
+    for pth, blob in zip(paths, blobs):
+        if blob is None:
+            raise RuntimeError("Could not find %s at %s!" % (pth, sha))
+        data.append(json.loads(blob))
+    return data
@@ -3,18 +3,35 @@ import io
 import bz2
 import copy
 import time
+import hashlib
+import concurrent.futures
 
 import github
 import tenacity
 import rapidjson as json
-import requests
-from conda_build.conda_interface import VersionOrder
 from conda._vendor.toolz.itertoolz import groupby
 from conda_build.index import _build_current_repodata
 
 from .shards import get_shard_path
+from .git_objects import read_json_blobs
+from .channeldata_cache import ChannelDataCache
 from .tokens import get_github_client_with_app_token
 from .utils import print_github_api_limits
+from .upload_scheduler import UploadScheduler
+from .asset_cache import fetch_url
+from .residency import enforce_label_residency
+from .versions import get_version_key
+from .current_repodata import (
+    get_current_repodata_store,
+    UnsupportedRepodataError,
+)
+from .records import (
+    compact_record,
+    compact_repodata,
+    copy_repodata,
+    has_compact_records,
+    encode_record,
+)
 
 CHANNELDATA_VERSION = 1
 REPODATA_VERSION = 1
@@ -27,6 +44,11 @@ GH = None
 REPODATA = None
 TOKEN_TIME = None
 
+# the tracked releases are listed again from GitHub after this many seconds
+RELEASES_RESYNC_SECONDS = 6 * 3600
+RELEASES_SYNC_TIME = None
+CHANNELDATA_CACHE = ChannelDataCache()
+
 INIT_REPODATA = {
     'info': {},
     'packages': {},
@@ -36,6 +58,19 @@ INIT_REPODATA = {
 }
 
 
+def init_channeldata_cache(cache_dir=None, max_disk_bytes=None):
+    """Replace the channeldata cache, optionally keeping entries on disk."""
+    global CHANNELDATA_CACHE
+    CHANNELDATA_CACHE.close()
+    CHANNELDATA_CACHE = ChannelDataCache(
+        cache_dir=cache_dir, max_disk_bytes=max_disk_bytes,
+    )
+
+
+def get_channeldata_cache():
+    return CHANNELDATA_CACHE
+
+
 def get_repodata():
     return REPODATA
 
@@ -78,40 +113,58 @@ def refresh_github_token_and_client():
     reraise=True,
 )
 def get_broken_packages(subdir):
-    r = requests.get(
+    # the broken label changes so the cached copy is revalidated
+    data = fetch_url(
         "https://conda.anaconda.org/conda-forge/label/broken"
-        f"/{subdir}/repodata.json.bz2"
+        f"/{subdir}/repodata.json.bz2",
+        immutable=False,
     )
     rd_broken = json.load(
-        io.StringIO(bz2.decompress(r.content).decode("utf-8")))
+        io.StringIO(bz2.decompress(data).decode("utf-8")))
     return rd_broken
 
 
-@tenacity.retry(
-    wait=tenacity.wait_random_exponential(multiplier=1, max=10),
-    stop=tenacity.stop_after_attempt(5),
-    reraise=True,
-)
+def get_github_rate_limit():
+    """Get the remaining requests, the request limit and the reset time in
+    seconds since the epoch of the GitHub API as of the last response."""
+    remaining, limit = GH.rate_limiting
+    return remaining, limit, GH.rate_limiting_resettime
+
+
 def upload_repodata_asset(rel, pth, content_type):
-    rel.upload_asset(pth, content_type=content_type)
-    tag = rel.tag_name
+    # retries are handled by the upload scheduler in the repo worker
     fn = os.path.basename(pth)
+    try:
+        rel.upload_asset(pth, content_type=content_type)
+    except github.GithubException as e:
+        # a failed attempt can leave a broken asset behind
+        if e.status != 422:
+            raise
+        for ast in rel.get_assets():
+            if ast.name == fn:
+                ast.delete_asset()
+        rel.upload_asset(pth, content_type=content_type)
+    tag = rel.tag_name
     return (
         fn,
         f"https://github.com/{REPODATA_REPO}/releases/download/{tag}/{fn}",
     )
 
 
-@tenacity.retry(
-    wait=tenacity.wait_random_exponential(multiplier=1, max=10),
-    stop=tenacity.stop_after_attempt(5),
-    reraise=True,
-)
-def _delete_repodata_release(rel):
+def _delete_repodata_release(release_id):
+    # retries are handled by the scheduler running the deletions
+    try:
+        rel = REPODATA.get_release(release_id)
+    except github.UnknownObjectException:
+        # it was deleted already
+        return
     for ast in rel.get_assets():
         ast.delete_asset()
     if not rel.draft:
-        tag = REPODATA.get_git_ref(f"tags/{rel.tag_name}")
+        try:
+            tag = REPODATA.get_git_ref(f"tags/{rel.tag_name}")
+        except github.UnknownObjectException:
+            tag = None
     else:
         tag = None
     rel.delete_release()
@@ -119,28 +172,78 @@ def _delete_repodata_release(rel):
         tag.delete()
 
 
-@tenacity.retry(
-    wait=tenacity.wait_random_exponential(multiplier=1, max=10),
-    stop=tenacity.stop_after_attempt(5),
-    reraise=True,
-)
-def delete_old_repodata_releases(all_links):
-    releases_to_delete = []
-    for rel in REPODATA.get_releases():
-        tag = rel.tag_name
-        has_tag = any(
-            any(tag in url for url in urls)
-            for _, urls in all_links["serverdata"].items()
-        )
-        if not has_tag:
-            releases_to_delete.append(rel)
+def get_release_tag_from_url(url):
+    # https://github.com/<org>/<repo>/releases/download/<tag>/<fn>
+    return url.rsplit("/", 2)[-2]
+
+
+def delete_old_repodata_releases(all_links, keep_tags=(), exec=None):
+    """Delete the releases whose assets are not in the links anymore.
+
+    The releases are tracked in `all_links["releases"]`, a dictionary mapping
+    the tag of each release to its id, so that we do not list every release
+    each time. It is replaced by the list of releases the first time this is
+    called in a process and every `RELEASES_RESYNC_SECONDS` after that, so
+    that releases that are not tracked (e.g., made by a worker that stopped
+    before saving its links) are deleted as well.
+
+    Parameters
+    ----------
+    all_links : dict
+        The links. `all_links["releases"]` is updated in place.
+    keep_tags : iterable of str, optional
+        The tags of releases to keep even if none of their assets are in the
+        links, e.g. the release with the latest links.json.
+    exec : UploadScheduler, optional
+        The scheduler to run the deletions on. If not given, a new one is
+        made.
+
+    Returns
+    -------
+    deleted_tags : list of str
+        The tags of the deleted releases.
+    """
+    global RELEASES_SYNC_TIME
+
+    if (
+        "releases" not in all_links
+        or RELEASES_SYNC_TIME is None
+        or time.time() - RELEASES_SYNC_TIME > RELEASES_RESYNC_SECONDS
+    ):
+        all_links["releases"] = {
+            rel.tag_name: rel.id for rel in REPODATA.get_releases()
+        }
+        RELEASES_SYNC_TIME = time.time()
+
+    live_tags = set(keep_tags)
+    for urls in all_links["serverdata"].values():
+        live_tags.update(get_release_tag_from_url(url) for url in urls)
+    tags_to_delete = sorted(set(all_links["releases"]) - live_tags)
+    if not tags_to_delete:
+        return []
+
+    if exec is None:
+        with UploadScheduler(get_rate_limit=get_github_rate_limit) as _exec:
+            return delete_old_repodata_releases(
+                all_links, keep_tags=keep_tags, exec=_exec,
+            )
 
+    futs = {
+        exec.submit(_delete_repodata_release, all_links["releases"][tag]): tag
+        for tag in tags_to_delete
+    }
     deleted_tags = []
-    for rel in releases_to_delete:
-        deleted_tags.append(rel.tag_name)
-        _delete_repodata_release(rel)
+    for fut in concurrent.futures.as_completed(futs):
+        tag = futs[fut]
+        try:
+            fut.result()
+        except Exception as e:
+            print(f"could not delete release {tag}: {repr(e)}", flush=True)
+        else:
+            deleted_tags.append(tag)
+            del all_links["releases"][tag]
 
-    return deleted_tags
+    return sorted(deleted_tags)
 
 
 def _load_shard_channeldata(subdir, fn, repodata):
@@ -152,6 +255,41 @@ def _load_shard_channeldata(subdir, fn, repodata):
     return shard["channeldata"], shard["channeldata_version"]
 
 
+def _load_shards_channeldata(subdir, fns, repodata, shards_sha=None):
+    keys = [os.path.join(subdir, fn) for fn in fns]
+    found = CHANNELDATA_CACHE.get_many(keys)
+
+    missing = [fn for fn, key in zip(fns, keys) if key not in found]
+    if missing:
+        if shards_sha is None:
+            loaded = [
+                _load_shard_channeldata(subdir, fn, repodata)
+                for fn in missing
+            ]
+        else:
+            shards = read_json_blobs(
+                "repodata-shards",
+                shards_sha,
+                [get_shard_path(subdir, fn) for fn in missing],
+            )
+            loaded = [
+                (shard["channeldata"], shard["channeldata_version"])
+                for shard in shards
+            ]
+
+        CHANNELDATA_CACHE.update({
+            os.path.join(subdir, fn): entry
+            for fn, entry in zip(missing, loaded)
+        })
+        # the entries are updated in place when building channeldata
+        found.update({
+            os.path.join(subdir, fn): (copy.copy(data), cdver)
+            for fn, (data, cdver) in zip(missing, loaded)
+        })
+
+    return [found[key] for key in keys]
+
+
 def _make_seconds(timestamp):
     timestamp = int(timestamp)
     if timestamp > 253402300799:  # 9999-12-31
@@ -160,7 +298,7 @@ def _make_seconds(timestamp):
     return timestamp
 
 
-def build_or_update_channeldata(channel_data, repodata, subdir):
+def build_or_update_channeldata(channel_data, repodata, subdir, shards_sha=None):
     legacy_packages = repodata["packages"]
     conda_packages = repodata["packages.conda"]
 
@@ -169,7 +307,11 @@ def build_or_update_channeldata(channel_data, repodata, subdir):
         - set(k[:-6] + '.tar.bz2' for k in conda_packages.keys())
     )
     all_repodata_packages = conda_packages.copy()
-    all_repodata_packages.update({k: legacy_packages[k] for k in use_these_legacy_keys})
+    # we keep the order of the repodata so that the result does not depend on
+    # the iteration order of the set
+    all_repodata_packages.update({
+        k: v for k, v in legacy_packages.items() if k in use_these_legacy_keys
+    })
     package_data = channel_data.get('packages', {})
 
     for fn, x in all_repodata_packages.items():
@@ -204,15 +346,11 @@ def build_or_update_channeldata(channel_data, repodata, subdir):
             #    are not in the index t all yet similarly, because we can't check
             #    if they have any run_exports
             for vgroup in groupby(lambda x: x[1]['version'], group).values():
-                candidate = next(iter(sorted(
-                    vgroup, key=lambda x: x[1].get('timestamp', 0), reverse=True))
-                )
+                candidate = max(vgroup, key=lambda x: x[1].get('timestamp', 0))
                 _append_group(groups, candidate)
         else:
             # take newest per group
-            candidate = next(iter(sorted(
-                group, key=lambda x: x[1].get('timestamp', 0), reverse=True))
-            )
+            candidate = max(group, key=lambda x: x[1].get('timestamp', 0))
             _append_group(groups, candidate)
 
     def _replace_if_newer_and_present(pd, data, erec, data_newer, k):
@@ -226,8 +364,10 @@ def build_or_update_channeldata(channel_data, repodata, subdir):
     if groups:
         fns, fn_dicts = zip(*groups)
 
-    for fn_dict, fn in zip(fn_dicts, fns):
-        data, _cdver = _load_shard_channeldata(subdir, fn, repodata)
+    shards_channeldata = _load_shards_channeldata(
+        subdir, fns, repodata, shards_sha=shards_sha
+    )
+    for fn_dict, (data, _cdver) in zip(fn_dicts, shards_channeldata):
         assert _cdver == CHANNELDATA_VERSION
         if data:
             data.update(fn_dict)
@@ -236,7 +376,7 @@ def build_or_update_channeldata(channel_data, repodata, subdir):
             erec = package_data.get(name, {})
             data_v = data.get('version', '0')
             erec_v = erec.get('version', '0')
-            data_newer = VersionOrder(data_v) > VersionOrder(erec_v)
+            data_newer = get_version_key(data_v) > get_version_key(erec_v)
 
             package_data[name] = package_data.get(name, {})
             # keep newer value for these
@@ -280,6 +420,133 @@ def build_or_update_channeldata(channel_data, repodata, subdir):
     })
 
 
+def _get_channeldata_fingerprints(repodata, old=None, old_records=None):
+    # this is the set of records build_or_update_channeldata looks at
+    old = old or {}
+    old_records = old_records or {}
+    packages = {}
+    for key in ["packages", "packages.conda"]:
+        for fn, record in repodata[key].items():
+            if fn in old and old_records.get(fn) is record:
+                packages[fn] = old[fn]
+                continue
+            packages[fn] = (
+                record["name"],
+                hashlib.blake2b(
+                    json.dumps(
+                        record, sort_keys=True, default=encode_record
+                    ).encode("utf-8"),
+                    digest_size=16,
+                ).digest(),
+            )
+    return packages
+
+
+def _filter_repodata_by_name(repodata, names):
+    return {
+        key: {
+            fn: record
+            for fn, record in repodata[key].items()
+            if record["name"] in names
+        }
+        for key in ["packages", "packages.conda"]
+    }
+
+
+def update_channeldata(
+    channel_data, fingerprints, all_subdir_repodata, shards_sha=None, records=None,
+):
+    """Update the channeldata of a label, only recomputing the entries for
+    package names whose records changed.
+
+    The channeldata entry for a package name only depends on the records with
+    that name. We keep a fingerprint of every record that went into the
+    channeldata and rebuild the entries for the names of the records that were
+    added, changed or removed since the last call. The output is the same as
+    calling `build_or_update_channeldata` for every subdir on an empty
+    channeldata.
+
+    Parameters
+    ----------
+    channel_data : dict
+        The channeldata to update in place. Pass an empty dict to build it
+        from scratch.
+    fingerprints : dict
+        The fingerprints of the records used for `channel_data` so far. This
+        dictionary is updated in place and should be passed back in on the
+        next call for the same label. Pass an empty dict when `channel_data`
+        is empty.
+    all_subdir_repodata : dict
+        A dictionary mapping each subdir to the patched repodata for the
+        label, in the order the subdirs should be processed.
+    shards_sha : str, optional
+        If given, the commit of the shards repo to read the channeldata from.
+    records : dict, optional
+        If given, a dictionary mapping each subdir to the records the
+        fingerprints were made from, updated in place. Records that are the
+        same objects as on the last call are not fingerprinted again, so
+        records must be replaced instead of changed in place. Subdirs can be
+        removed from it, e.g., when their repodata is moved out of memory.
+        Unlike `fingerprints`, it refers to the records and is not meant to
+        be saved.
+
+    Returns
+    -------
+    touched_names : set of str
+        The package names whose channeldata entries were recomputed.
+    """
+    touched_names = set()
+    new_fingerprints = {}
+    for subdir, repodata in all_subdir_repodata.items():
+        old = fingerprints.get(subdir, {})
+        new = _get_channeldata_fingerprints(
+            repodata,
+            old=old,
+            old_records=records.get(subdir) if records is not None else None,
+        )
+        if records is not None:
+            records[subdir] = {
+                fn: record
+                for key in ["packages", "packages.conda"]
+                for fn, record in repodata[key].items()
+            }
+        for fn, (name, fp) in new.items():
+            if fn not in old or old[fn][1] != fp:
+                touched_names.add(name)
+                if fn in old:
+                    touched_names.add(old[fn][0])
+        for fn in old.keys() - new.keys():
+            touched_names.add(old[fn][0])
+        new_fingerprints[subdir] = new
+
+    partial_channel_data = {}
+    for subdir, repodata in all_subdir_repodata.items():
+        build_or_update_channeldata(
+            partial_channel_data,
+            _filter_repodata_by_name(repodata, touched_names),
+            subdir,
+            shards_sha=shards_sha,
+        )
+
+    package_data = channel_data.get("packages", {})
+    partial_package_data = partial_channel_data.get("packages", {})
+    for name in touched_names:
+        if name in partial_package_data:
+            package_data[name] = partial_package_data[name]
+        else:
+            package_data.pop(name, None)
+
+    channel_data.update({
+        "channeldata_version": CHANNELDATA_VERSION,
+        "subdirs": partial_channel_data.get("subdirs", []),
+        "packages": package_data,
+    })
+    fingerprints.clear()
+    fingerprints.update(new_fingerprints)
+
+    return touched_names
+
+
 def build_or_update_links_and_repodata(
     repodata,
     links,
@@ -288,6 +555,7 @@ def build_or_update_links_and_repodata(
     override_labels=None,
     fetch_repodata=None,
     removed_shards=None,
+    compact_records=False,
 ):
     removed_shards = removed_shards or []
     if subdir not in repodata:
@@ -297,14 +565,20 @@ def build_or_update_links_and_repodata(
 
     updated_data = set()
 
-    for subdir_pkg in removed_shards:
+    # go over the labels once since they might have to be loaded from disk
+    if removed_shards:
         for label in repodata[subdir]:
-            if subdir_pkg in repodata[subdir][label]["packages"]:
-                del repodata[subdir][label]["packages"][subdir_pkg]
+            for subdir_pkg in removed_shards:
+                if subdir_pkg in repodata[subdir][label]["packages"]:
+                    del repodata[subdir][label]["packages"][subdir_pkg]
+            enforce_label_residency()
+    for subdir_pkg in removed_shards:
         if subdir_pkg in links:
             del links["packages"][subdir_pkg]
 
-    for subdir_pkg, shard in shards.items():
+    for i, (subdir_pkg, shard) in enumerate(shards.items()):
+        if i % 1000 == 999:
+            enforce_label_residency()
         shard["labels"] = override_labels.get(subdir_pkg, shard["labels"])
         for label in shard["labels"]:
             if label not in repodata[subdir]:
@@ -317,14 +591,64 @@ def build_or_update_links_and_repodata(
                     repodata[subdir][label] = copy.deepcopy(INIT_REPODATA)
 
                 repodata[subdir][label]["info"]["subdir"] = subdir
+                if compact_records:
+                    compact_repodata(repodata[subdir][label])
 
-            repodata[subdir][label]["packages"][shard["package"]] \
-                = shard["repodata"]
+            repodata[subdir][label]["packages"][shard["package"]] = (
+                compact_record(shard["repodata"])
+                if compact_records
+                else shard["repodata"]
+            )
             links["packages"][subdir_pkg] = shard["url"]
             updated_data.add((subdir, label))
 
     return updated_data
 
 
-def build_current_repodata(subdir, repodata):
-    return _build_current_repodata(subdir, repodata, None)
+def build_current_repodata(subdir, repodata, fn=None):
+    """Make the current repodata of repodata.
+
+    Parameters
+    ----------
+    subdir : str
+        The subdir of the repodata.
+    repodata : dict
+        The repodata. It is not changed.
+    fn : str, optional
+        The name of the current repodata file. If given, the current repodata
+        is made incrementally from the index of the last build of the same
+        file. Otherwise or if the index cannot handle the repodata,
+        conda-build is used.
+
+    Returns
+    -------
+    current_repodata : dict
+        The current repodata.
+    """
+    if fn is not None:
+        try:
+            return get_current_repodata_store().build(fn, repodata)
+        except UnsupportedRepodataError as e:
+            print(
+                "could not build %s incrementally, using conda-build: %s" % (
+                    fn, repr(e),
+                ),
+                flush=True,
+            )
+
+    # conda-build adds legacy_bz2_md5 to the .conda records it keeps in
+    # place, so it gets a copy - the repodata has to stay as it was written
+    # and the records that did not change are shared with it
+    compact = has_compact_records(repodata)
+    current_repodata = _build_current_repodata(
+        subdir, copy_repodata(repodata), None
+    )
+    for key in ["packages", "packages.conda"]:
+        for fn, record in current_repodata[key].items():
+            if record == repodata[key][fn]:
+                current_repodata[key][fn] = repodata[key][fn]
+            elif compact:
+                current_repodata[key][fn] = compact_record(
+                    record, base=repodata[key][fn]
+                )
+    return current_repodata
@@ -0,0 +1,340 @@
+"""JSON-Lines-Patch (.jlap) logs of incremental repodata updates.
+
+A .jlap file lets conda update its cached repodata.json with small patches
+instead of downloading the whole file again. The format (see conda's
+`conda.gateways.repodata.jlap`) is a set of lines separated by newlines
+
+    <initialization vector as 64 hex characters>
+    {"from": <hash>, "to": <hash>, "patch": <RFC 6902 JSON patch>}
+    ...
+    {"url": "repodata.json", "latest": <hash>}
+    <checksum as 64 hex characters>
+
+The hashes are the hex blake2b-256 digests of the bytes of repodata.json. Each
+line is chained to the previous one with a keyed blake2b-256 hash starting
+from the initialization vector, and the checksum is the chained hash of the
+line before it. Logs are trimmed from the front by moving the initialization
+vector forward to the chained hash of the last dropped line.
+"""
+import os
+import copy
+import hashlib
+import threading
+
+import rapidjson as json
+
+from .records import CompactRecord, encode_record
+
+DIGEST_SIZE = 32
+ZERO_IV = "0" * (2 * DIGEST_SIZE)
+
+# the maximum size of a .jlap file
+MAX_JLAP_BYTES = 10 * 1000**2
+
+RECORD_KEYS = ("packages", "packages.conda")
+
+JLAP_CONTENT_TYPE = "text/plain"
+
+
+def hash_segments(segments):
+    """Compute the hex blake2b-256 hash of data given as a list of bytes."""
+    hasher = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    for segment in segments:
+        hasher.update(segment)
+    return hasher.hexdigest()
+
+
+def _keyed_hash(line, key):
+    return hashlib.blake2b(
+        line.encode("utf-8"), key=bytes.fromhex(key), digest_size=DIGEST_SIZE,
+    ).hexdigest()
+
+
+def _escape_pointer(key):
+    return key.replace("~", "~0").replace("/", "~1")
+
+
+def _snapshot_record(record):
+    # compact records cannot be changed, so only dictionaries are copied
+    return record if isinstance(record, CompactRecord) else dict(record)
+
+
+def snapshot_repodata(repodata):
+    """Make a copy of repodata to diff against later.
+
+    Records that are dictionaries are copied shallowly, so a record that is
+    changed in place shows up in the next diff as long as one of its fields
+    is set to a new value.
+    """
+    return {
+        k: (
+            {fn: _snapshot_record(record) for fn, record in v.items()}
+            if k in RECORD_KEYS
+            else copy.deepcopy(v)
+        )
+        for k, v in repodata.items()
+    }
+
+
+def diff_repodata(old, new):
+    """Make a JSON patch (RFC 6902) that turns `old` repodata into `new`.
+
+    Returns
+    -------
+    patch : list of dict
+        The patch operations.
+    """
+    patch = []
+    for key in sorted(set(old) | set(new)):
+        path = "/" + _escape_pointer(key)
+        if key not in new:
+            patch.append({"op": "remove", "path": path})
+        elif (
+            key in RECORD_KEYS
+            and isinstance(old.get(key), dict)
+            and isinstance(new[key], dict)
+        ):
+            old_records = old[key]
+            new_records = new[key]
+            for fn in sorted(old_records.keys() - new_records.keys()):
+                patch.append({
+                    "op": "remove", "path": path + "/" + _escape_pointer(fn),
+                })
+            # only compact records can be the same objects as in the snapshot
+            changed = [
+                fn
+                for fn, record in new_records.items()
+                if (
+                    fn not in old_records
+                    or (old_records[fn] is not record and old_records[fn] != record)
+                )
+            ]
+            for fn in sorted(changed):
+                # add replaces the value if it exists
+                patch.append({
+                    "op": "add",
+                    "path": path + "/" + _escape_pointer(fn),
+                    "value": new_records[fn],
+                })
+        elif key not in old or old[key] != new[key]:
+            patch.append({"op": "add", "path": path, "value": new[key]})
+    return patch
+
+
+class JLAPLog:
+    """A .jlap log of patches for one repodata.json.
+
+    Parameters
+    ----------
+    iv : str, optional
+        The hex initialization vector of the log.
+
+    Attributes
+    ----------
+    latest : str or None
+        The hash of the latest repodata.json.
+    """
+    def __init__(self, iv=ZERO_IV):
+        self.iv = iv
+        self.latest = None
+        # tuples of the patch line and the chained hash up to that line
+        self._lines = []
+
+    @classmethod
+    def from_text(cls, text):
+        """Read a .jlap file, checking its checksum.
+
+        Raises
+        ------
+        ValueError
+            If the file is not a valid .jlap file.
+        """
+        lines = text.split("\n")
+        if len(lines) < 3:
+            raise ValueError("a .jlap file needs at least three lines!")
+
+        log = cls(iv=lines[0])
+        chained = [lines[0]]
+        for line in lines[1:-1]:
+            chained.append(_keyed_hash(line, chained[-1]))
+        if chained[-1] != lines[-1]:
+            raise ValueError("the .jlap checksum does not match!")
+
+        log._lines = list(zip(lines[1:-2], chained[1:-1]))
+        log.latest = json.loads(lines[-2])["latest"]
+        return log
+
+    def __len__(self):
+        return len(self._lines)
+
+    def add(self, from_hash, to_hash, patch):
+        """Add a patch to the log and make `to_hash` the latest hash."""
+        line = json.dumps(
+            {"from": from_hash, "to": to_hash, "patch": patch},
+            sort_keys=True,
+            default=encode_record,
+        )
+        prev = self._lines[-1][1] if self._lines else self.iv
+        self._lines.append((line, _keyed_hash(line, prev)))
+        self.latest = to_hash
+
+    def trim(self, max_bytes=MAX_JLAP_BYTES):
+        """Drop the oldest patches until the log fits in `max_bytes`."""
+        # the iv, metadata and checksum lines take about this much space
+        size = 3 * (2 * DIGEST_SIZE + 1) + 128
+        n_keep = 0
+        for line, _ in reversed(self._lines):
+            size += len(line) + 1
+            if size > max_bytes:
+                break
+            n_keep += 1
+
+        n_drop = len(self._lines) - n_keep
+        if n_drop > 0:
+            self.iv = self._lines[n_drop - 1][1]
+            self._lines = self._lines[n_drop:]
+
+    def to_text(self):
+        """Write the log as the contents of a .jlap file."""
+        lines = [self.iv] + [line for line, _ in self._lines]
+        prev = self._lines[-1][1] if self._lines else self.iv
+        metadata = json.dumps(
+            {"url": "repodata.json", "latest": self.latest}, sort_keys=True,
+        )
+        prev = _keyed_hash(metadata, prev)
+        lines.append(metadata)
+        lines.append(prev)
+        return "\n".join(lines)
+
+
+class JLAPStore:
+    """The .jlap logs of a set of repodata files along with a snapshot of the
+    repodata each log was last updated with.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The maximum size of each .jlap file.
+    """
+    def __init__(self, max_bytes=MAX_JLAP_BYTES):
+        self.max_bytes = max_bytes
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._files
+
+    def start(self, name, repodata, repodata_hash, text=None):
+        """Start tracking the .jlap log of a repodata file.
+
+        Parameters
+        ----------
+        name : str
+            The name of the .jlap file.
+        repodata : dict
+            The repodata as it was when the log was last written.
+        repodata_hash : str
+            The hash of the repodata as it was when the log was last written.
+        text : str, optional
+            The contents of the last .jlap file. If it is invalid or does not
+            end at `repodata_hash`, a new log is started.
+        """
+        log = None
+        if text is not None:
+            try:
+                log = JLAPLog.from_text(text)
+            except (ValueError, KeyError) as e:
+                print(
+                    "could not read the .jlap file %s: %s" % (name, repr(e)),
+                    flush=True,
+                )
+            else:
+                if log.latest != repodata_hash:
+                    log = None
+
+        if log is None:
+            log = JLAPLog()
+            log.latest = repodata_hash
+
+        with self._lock:
+            self._files[name] = (log, snapshot_repodata(repodata))
+
+    def update(self, name, repodata, repodata_hash):
+        """Add the patch from the last repodata to the new one to a log.
+
+        Parameters
+        ----------
+        name : str
+            The name of the .jlap file.
+        repodata : dict
+            The new repodata.
+        repodata_hash : str
+            The hash of the new repodata.
+
+        Returns
+        -------
+        text : str
+            The contents of the new .jlap file.
+        """
+        with self._lock:
+            log, snapshot = self._files[name]
+
+        if repodata_hash != log.latest:
+            log.add(log.latest, repodata_hash, diff_repodata(snapshot, repodata))
+            log.trim(max_bytes=self.max_bytes)
+            snapshot = snapshot_repodata(repodata)
+
+        with self._lock:
+            self._files[name] = (log, snapshot)
+        return log.to_text()
+
+    def get_files(self, names):
+        """Get the logs and snapshots for a set of files so that they can be
+        sent to another process along with the records they refer to."""
+        with self._lock:
+            return {
+                name: self._files[name]
+                for name in names
+                if name in self._files
+            }
+
+    def update_files(self, files):
+        """Add the output of `get_files` from another process."""
+        with self._lock:
+            self._files.update(files)
+
+    def drop_snapshots(self, names):
+        """Drop the snapshots of a set of files, keeping their logs.
+
+        A dropped snapshot has to be restored with `restore_snapshot` before
+        the log is updated again.
+        """
+        with self._lock:
+            for name in names:
+                if name in self._files:
+                    self._files[name] = (self._files[name][0], None)
+
+    def needs_snapshot(self, name):
+        with self._lock:
+            return name in self._files and self._files[name][1] is None
+
+    def restore_snapshot(self, name, repodata):
+        """Restore a dropped snapshot from the repodata the log was last
+        updated with."""
+        with self._lock:
+            self._files[name] = (self._files[name][0], snapshot_repodata(repodata))
+
+
+JLAP_STORE = JLAPStore()
+
+
+def _reset_jlap_store_lock_in_child():
+    JLAP_STORE._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_jlap_store_lock_in_child)
+
+
+def get_jlap_store():
+    return JLAP_STORE
@@ -0,0 +1,415 @@
+"""Native indexing of single conda packages.
+
+This module reproduces the parts of `conda index` (conda_build.index.ChannelIndex)
+that we need to build a repodata shard for one package without spawning a
+subprocess or indexing a whole channel on disk. The logic below mirrors
+
+    - ChannelIndex._extract_to_cache (repodata record)
+    - ChannelIndex._load_all_from_cache (merged package metadata)
+    - ChannelIndex._update_channeldata (channeldata entry)
+
+so that the `repodata` and `channeldata` fields of the shards are the same as
+those produced by `conda index`.
+"""
+import os
+import copy
+import fnmatch
+import hashlib
+import tarfile
+import zipfile
+
+import rapidjson as json
+import yaml
+import zstandard
+
+from .fetch import HTTPRangeFile
+
+CHANNELDATA_VERSION = 1
+REPODATA_VERSION = 1
+
+# conda_build.index drops these keys from index.json
+INDEX_FILTER_FIELDS = {
+    "arch",
+    "has_prefix",
+    "mtime",
+    "platform",
+    "ucs",
+    "requires_features",
+    "binstar",
+    "target-triplet",
+    "machine",
+    "operatingsystem",
+}
+
+RECIPE_PATH_SEARCH_ORDER = (
+    "info/recipe/meta.yaml.rendered",
+    "info/recipe/meta.yaml",
+    "info/meta.yaml",
+)
+
+CHANNELDATA_NEWER_KEYS = (
+    'description', 'dev_url', 'doc_url', 'doc_source_url', 'home',
+    'license',
+    'source_url', 'source_git_url', 'summary', 'icon_url', 'icon_hash',
+    'tags',
+    'identifiers', 'keywords', 'recipe_origin', 'version'
+)
+
+CHANNELDATA_ANY_KEYS = (
+    "binary_prefix", "text_prefix", "activate.d", "deactivate.d",
+    "pre_link", "post_link", "pre_unlink"
+)
+
+
+def _read_info_tar(fp, mode):
+    info_files = {}
+    with tarfile.open(fileobj=fp, mode=mode) as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            name = member.name
+            if name.startswith("./"):
+                name = name[2:]
+            if not name.startswith("info/"):
+                continue
+            info_files[name] = tf.extractfile(member).read()
+    return info_files
+
+
+def _read_info_zst(fp):
+    dctx = zstandard.ZstdDecompressor()
+    with dctx.stream_reader(fp) as reader:
+        return _read_info_tar(reader, "r|")
+
+
+def _get_conda_info_zipinfo(zf, pth):
+    for zinfo in zf.infolist():
+        if (
+            zinfo.filename.startswith("info-")
+            and zinfo.filename.endswith(".tar.zst")
+        ):
+            return zinfo
+    raise RuntimeError("Could not find the info tarball in %s!" % pth)
+
+
+def _read_conda_info(zf, pth):
+    with zf.open(_get_conda_info_zipinfo(zf, pth)) as fp:
+        return _read_info_zst(fp)
+
+
+def read_remote_conda_info_files(url):
+    """Read all of the files in `info/` for a remote .conda package.
+
+    Only the zip central directory and the `info-*.tar.zst` member of the
+    package are downloaded, using HTTP Range requests.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the package. The server must honor Range requests.
+
+    Returns
+    -------
+    info_files : dict
+        A dictionary mapping the path of each file in the package (e.g.,
+        "info/index.json") to its contents as bytes.
+    """
+    with HTTPRangeFile(url) as fp, zipfile.ZipFile(fp) as zf:
+        zinfo = _get_conda_info_zipinfo(zf, url)
+
+        # get the local header and the whole member in one request
+        fp.prefetch(
+            zinfo.header_offset,
+            (
+                zipfile.sizeFileHeader
+                + len(zinfo.filename.encode("utf-8"))
+                + len(zinfo.extra)
+                + zinfo.compress_size
+                + 1024
+            ),
+        )
+
+        info_files = _read_conda_info(zf, url)
+
+    print(
+        "read info for %s w/ %d requests and %d bytes" % (
+            url, fp.n_requests, fp.bytes_fetched
+        ),
+        flush=True,
+    )
+
+    return info_files
+
+
+def read_package_info_files(pth):
+    """Read all of the files in `info/` for a .tar.bz2 or .conda package.
+
+    Parameters
+    ----------
+    pth : str
+        The path to the package.
+
+    Returns
+    -------
+    info_files : dict
+        A dictionary mapping the path of each file in the package (e.g.,
+        "info/index.json") to its contents as bytes.
+    """
+    if pth.endswith(".tar.bz2"):
+        with open(pth, "rb") as fp:
+            return _read_info_tar(fp, "r|bz2")
+    elif pth.endswith(".conda"):
+        with zipfile.ZipFile(pth) as zf:
+            return _read_conda_info(zf, pth)
+    else:
+        raise RuntimeError("Can only process packages that end in .tar.bz2 or .conda!")
+
+
+def _load_json_file(info_files, name, default=None):
+    if name in info_files:
+        return json.loads(info_files[name].decode("utf-8"))
+    else:
+        return default
+
+
+def _make_recipe_json(info_files):
+    for name in RECIPE_PATH_SEARCH_ORDER:
+        if name in info_files:
+            break
+    else:
+        return {}
+
+    try:
+        recipe_json = yaml.safe_load(info_files[name])
+    except yaml.YAMLError:
+        return {}
+    if not recipe_json:
+        return {}
+
+    # conda-build stores the recipe as JSON in its cache and reads it back
+    try:
+        recipe_json_str = json.dumps(recipe_json)
+    except TypeError:
+        recipe_json.get('requirements', {}).pop('build')
+        recipe_json_str = json.dumps(recipe_json)
+    return json.loads(recipe_json_str)
+
+
+def _make_run_exports(info_files):
+    if "info/run_exports.json" in info_files:
+        return _load_json_file(info_files, "info/run_exports.json")
+    elif "info/run_exports.yaml" in info_files:
+        return yaml.safe_load(info_files["info/run_exports.yaml"])
+    else:
+        return {}
+
+
+def _make_post_install_details(info_files):
+    post_install_details = {
+        'binary_prefix': False, 'text_prefix': False,
+        'activate.d': False, 'deactivate.d': False,
+        'pre_link': False, 'post_link': False, 'pre_unlink': False,
+    }
+
+    paths = _load_json_file(info_files, "info/paths.json", default={})
+    for f in paths.get('paths', []):
+        if f.get('prefix_placeholder'):
+            if f.get('file_mode') == 'binary':
+                post_install_details['binary_prefix'] = True
+            elif f.get('file_mode') == 'text':
+                post_install_details['text_prefix'] = True
+        for k in ('activate.d', 'deactivate.d'):
+            if (
+                not post_install_details.get(k)
+                and f['_path'].startswith('etc/conda/%s' % k)
+            ):
+                post_install_details[k] = True
+        for pat in ('pre-link', 'post-link', 'pre-unlink'):
+            if (
+                not post_install_details.get(pat)
+                and fnmatch.fnmatch(f['_path'], '*/.*-%s.*' % pat)
+            ):
+                post_install_details[pat.replace("-", "_")] = True
+
+    return post_install_details
+
+
+def _make_icon_data(info_files, recipe_json, name):
+    app_icon_path = (recipe_json.get('app') or {}).get('icon')
+    if not app_icon_path:
+        return {}
+
+    icon_name = os.path.normpath(os.path.join("info", "recipe", app_icon_path))
+    if icon_name not in info_files:
+        icon_name = "info/icon.png"
+    if icon_name not in info_files:
+        return {}
+
+    icon_data = info_files[icon_name]
+    icon_ext = os.path.splitext(app_icon_path)[-1].rsplit('.', 1)[-1]
+    return {
+        "icon_hash": "md5:%s:%s" % (
+            hashlib.md5(icon_data).hexdigest(), len(icon_data)
+        ),
+        "icon_url": "icons/%s.%s" % (name, icon_ext),
+    }
+
+
+def _clear_newline_chars(record, field_name):
+    if field_name in record:
+        try:
+            record[field_name] = record[field_name].strip().replace('\n', ' ')
+        except AttributeError:
+            # sometimes description gets added as a list instead of just a string
+            record[field_name] = record[field_name][0].strip().replace('\n', ' ')
+
+
+def _make_seconds(timestamp):
+    timestamp = int(timestamp)
+    if timestamp > 253402300799:  # 9999-12-31
+        timestamp //= 1000
+        # convert milliseconds to seconds; see conda/conda-build#1988
+    return timestamp
+
+
+def make_repodata_record(info_files, size, md5, sha256):
+    """Make the repodata record for a package from its `info/` files.
+
+    Parameters
+    ----------
+    info_files : dict
+        The output of `read_package_info_files`.
+    size : int
+        The size of the package in bytes.
+    md5 : str
+        The hex md5 checksum of the package.
+    sha256 : str
+        The hex sha256 checksum of the package.
+
+    Returns
+    -------
+    record : dict
+        The repodata record.
+    """
+    record = _load_json_file(info_files, "info/index.json")
+    if record is None:
+        raise RuntimeError("Package does not have an info/index.json file!")
+
+    for field_name in INDEX_FILTER_FIELDS & set(record):
+        del record[field_name]
+
+    record["md5"] = md5
+    record["sha256"] = sha256
+    record["size"] = size
+    return record
+
+
+def make_channeldata_entry(info_files, record, subdir):
+    """Make the channeldata entry for a package from its `info/` files.
+
+    Parameters
+    ----------
+    info_files : dict
+        The output of `read_package_info_files`.
+    record : dict
+        The repodata record of the package.
+    subdir : str
+        The subdir of the package.
+
+    Returns
+    -------
+    entry : dict
+        The channeldata entry for the package's name.
+    """
+    recipe_json = _make_recipe_json(info_files)
+
+    # the same order as conda_build.index's _load_all_from_cache so that keys
+    # in more than one of them get the same value
+    data = {}
+    data.update(recipe_json)
+    data.update(_load_json_file(info_files, "info/about.json", default={}) or {})
+    data.update(_load_json_file(info_files, "info/index.json"))
+    data.update(_make_post_install_details(info_files))
+    data.update(_make_icon_data(info_files, recipe_json, data["name"]))
+    source = data.get("source", {})
+    try:
+        data.update({"source_" + k: v for k, v in source.items()})
+    except AttributeError:
+        # sometimes source is a list instead of a dict
+        pass
+    _clear_newline_chars(data, 'description')
+    _clear_newline_chars(data, 'summary')
+    data["run_exports"] = _make_run_exports(info_files)
+
+    data.update(copy.deepcopy(record))
+
+    entry = {}
+    for k in CHANNELDATA_NEWER_KEYS:
+        entry[k] = data[k] if data.get(k) else None
+    for k in CHANNELDATA_ANY_KEYS:
+        entry[k] = bool(data.get(k))
+    entry["subdirs"] = [subdir]
+    entry["run_exports"] = {}
+    if data.get("run_exports"):
+        entry["run_exports"][data.get("version", "0")] = data["run_exports"]
+    entry["timestamp"] = _make_seconds(max(data.get("timestamp", 0), 0))
+
+    return entry
+
+
+def index_package(pth, subdir, size, md5, sha256):
+    """Index a single package without calling `conda index`.
+
+    Parameters
+    ----------
+    pth : str
+        The path to the package.
+    subdir : str
+        The subdir of the package.
+    size : int
+        The size of the package in bytes.
+    md5 : str
+        The hex md5 checksum of the package.
+    sha256 : str
+        The hex sha256 checksum of the package.
+
+    Returns
+    -------
+    rd : dict
+        The repodata record for the package.
+    cd : dict
+        The channeldata entry for the package.
+    """
+    info_files = read_package_info_files(pth)
+    rd = make_repodata_record(info_files, size, md5, sha256)
+    cd = make_channeldata_entry(info_files, rd, subdir)
+    return rd, cd
+
+
+def index_remote_conda_package(url, subdir, size, md5, sha256):
+    """Index a single remote .conda package without downloading all of it.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the package. The server must honor Range requests.
+    subdir : str
+        The subdir of the package.
+    size : int
+        The size of the package in bytes.
+    md5 : str
+        The hex md5 checksum of the package.
+    sha256 : str
+        The hex sha256 checksum of the package.
+
+    Returns
+    -------
+    rd : dict
+        The repodata record for the package.
+    cd : dict
+        The channeldata entry for the package.
+    """
+    info_files = read_remote_conda_info_files(url)
+    rd = make_repodata_record(info_files, size, md5, sha256)
+    cd = make_channeldata_entry(info_files, rd, subdir)
+    return rd, cd
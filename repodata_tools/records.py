@@ -0,0 +1,350 @@
+"""Compact, immutable package records.
+
+A repodata record is a small dictionary with the same set of keys as most
+other records and highly repetitive values (e.g., `license`, `subdir` or
+`depends` entries like `python >=3.8`). Stored as dictionaries, every record
+pays for its own hash table and its own copy of every string.
+
+A `CompactRecord` stores the keys once per distinct set of keys in a shared
+layout and the values in a tuple, with repetitive strings interned and lists
+packed into tuples. Hex digests are kept as bytes, which never appear in
+records otherwise since records are JSON data.
+
+It is a read-only mapping that compares equal to the dictionary it was made
+from and encodes to exactly the same JSON, so it can be used wherever the code
+reads records. Code that modifies records (e.g., the repodata patches) has to
+work on a copy from `copy_record`.
+
+Records are hash-consed: making a record equal to one that is already in use
+returns the existing record, so the same package in many labels, or in the raw
+and patched repodata, is stored once. Records that are no longer used are
+dropped from the pool by `sweep_records`. A record made with a `base` record
+(e.g., a patched record from its raw record) shares the values of every field
+the patch did not change with the base, so only the changed fields take new
+memory. Since `1 == 1.0 == True` in Python, only records and values made of
+strings, integers and nulls are shared this way, so that the JSON types of the
+values never change.
+"""
+import sys
+import threading
+from collections.abc import Mapping
+
+# the values of these keys are unique to each record so interning them only
+# costs memory
+UNIQUE_KEYS = frozenset(["md5", "sha256", "legacy_bz2_md5", "timestamp", "size"])
+
+# the values of these keys are hex digests that are stored as bytes
+DIGEST_KEYS = frozenset(["md5", "sha256", "legacy_bz2_md5"])
+
+_LAYOUTS = {}
+
+# all of the records made so far, mapping each record to itself
+_RECORDS = {}
+_RECORDS_LOCK = threading.Lock()
+_RECORD_STATS = {"hits": 0, "misses": 0}
+
+_intern = sys.intern
+
+
+class _Layout:
+    __slots__ = ("keys", "index")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = {k: i for i, k in enumerate(keys)}
+
+
+def _get_layout(keys):
+    layout = _LAYOUTS.get(keys)
+    if layout is None:
+        keys = tuple(sys.intern(k) for k in keys)
+        layout = _LAYOUTS.setdefault(keys, _Layout(keys))
+    return layout
+
+
+def _freeze(value, intern=True):
+    if isinstance(value, str):
+        return sys.intern(value) if intern else value
+    elif isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    elif isinstance(value, dict):
+        return compact_record(value)
+    else:
+        return value
+
+
+def _freeze_digest(value):
+    if isinstance(value, str):
+        try:
+            digest = bytes.fromhex(value)
+        except ValueError:
+            return value
+        # only lowercase hex without whitespace comes back the same
+        if digest.hex() == value:
+            return digest
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    elif isinstance(value, bytes):
+        return value.hex()
+    elif isinstance(value, CompactRecord):
+        return value.to_dict()
+    else:
+        return value
+
+
+class CompactRecord(Mapping):
+    """An immutable package record with a compact memory layout.
+
+    Values are read back as they were given (lists come back as new lists),
+    so a `CompactRecord` compares equal to the dictionary it was made from.
+    Use `compact_record` to make one.
+    """
+    __slots__ = ("_layout", "_values")
+
+    def __init__(self, layout, values):
+        self._layout = layout
+        self._values = values
+
+    def __getitem__(self, key):
+        value = self._values[self._layout.index[key]]
+        if isinstance(value, (tuple, bytes)):
+            return _thaw(value)
+        return value
+
+    def get(self, key, default=None):
+        i = self._layout.index.get(key)
+        if i is None:
+            return default
+        value = self._values[i]
+        if isinstance(value, (tuple, bytes)):
+            return _thaw(value)
+        return value
+
+    def __contains__(self, key):
+        return key in self._layout.index
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._layout.keys)
+
+    def __eq__(self, other):
+        # the keys of a layout are sorted so equal records have the same one
+        if isinstance(other, CompactRecord):
+            return self is other or (
+                self._layout is other._layout and self._values == other._values
+            )
+        return Mapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._values)
+
+    def __repr__(self):
+        return "CompactRecord(%r)" % self.to_dict()
+
+    def to_dict(self):
+        """Make a new dictionary with the contents of the record."""
+        return {
+            k: _thaw(v) for k, v in zip(self._layout.keys, self._values)
+        }
+
+    # the record is immutable so copies can share it
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        # the strings are interned again when the record is loaded
+        return (_load_record, (self._layout.keys, self._values))
+
+
+def _is_exact(value):
+    # values that only compare equal to values of the same JSON type
+    if type(value) is str or type(value) is int or value is None:
+        return True
+    elif type(value) is tuple:
+        return all(_is_exact(v) for v in value)
+    elif type(value) is bytes:
+        return True
+    elif type(value) is CompactRecord:
+        return all(_is_exact(v) for v in value._values)
+    else:
+        return False
+
+
+def _make_record(layout, values):
+    record = CompactRecord(layout, values)
+    if not all(_is_exact(v) for v in values):
+        # it could be equal to a record with values of other types
+        with _RECORDS_LOCK:
+            _RECORD_STATS["misses"] += 1
+        return record
+    with _RECORDS_LOCK:
+        pooled = _RECORDS.setdefault(record, record)
+        if pooled is record:
+            _RECORD_STATS["misses"] += 1
+        else:
+            _RECORD_STATS["hits"] += 1
+    return pooled
+
+
+def sweep_records():
+    """Drop the records that are only referred to by the pool.
+
+    Returns
+    -------
+    n_dropped : int
+        The number of records dropped.
+    """
+    with _RECORDS_LOCK:
+        # the references are the key and value in the pool, the loop variable
+        # and the argument of getrefcount
+        unused = [r for r in _RECORDS if sys.getrefcount(r) <= 4]
+        for record in unused:
+            del _RECORDS[record]
+        return len(unused)
+
+
+def get_record_stats():
+    """Get the number of distinct records in the pool and the number of
+    records made so far that were already in the pool (hits) or new
+    (misses)."""
+    with _RECORDS_LOCK:
+        return len(_RECORDS), _RECORD_STATS["hits"], _RECORD_STATS["misses"]
+
+
+def _load_record(keys, values):
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    return _make_record(
+        _get_layout(tuple(keys[i] for i in order)),
+        tuple(_refreeze(values[i], keys[i] not in UNIQUE_KEYS) for i in order),
+    )
+
+
+def _refreeze(value, intern):
+    if isinstance(value, str):
+        return sys.intern(value) if intern else value
+    elif isinstance(value, tuple):
+        return tuple(_refreeze(v, True) for v in value)
+    else:
+        return value
+
+
+def compact_record(record, base=None):
+    """Make a `CompactRecord` from a record dictionary.
+
+    Parameters
+    ----------
+    record : dict or CompactRecord
+        The record. Records that are already compact are returned as is.
+    base : CompactRecord, optional
+        A record to share the values of unchanged fields with, e.g., the raw
+        record a patched record was made from.
+
+    Returns
+    -------
+    record : CompactRecord
+        The compact record. It is the record already in use if there is an
+        equal one.
+    """
+    if isinstance(record, CompactRecord):
+        return record
+    keys = tuple(sorted(record))
+    layout = _LAYOUTS.get(keys) or _get_layout(keys)
+    if isinstance(base, CompactRecord):
+        base_index = base._layout.index
+        base_values = base._values
+    else:
+        base_index = None
+    values = []
+    for k in keys:
+        v = record[k]
+        if type(v) is str:
+            if k in DIGEST_KEYS:
+                v = _freeze_digest(v)
+            elif k not in UNIQUE_KEYS:
+                v = _intern(v)
+        elif type(v) is list:
+            v = tuple([_intern(x) if type(x) is str else _freeze(x) for x in v])
+        elif v is not None and not isinstance(v, (int, float)):
+            v = _freeze(v)
+        if base_index is not None:
+            i = base_index.get(k)
+            if (
+                i is not None
+                and base_values[i] == v
+                and _is_exact(v)
+                and _is_exact(base_values[i])
+            ):
+                v = base_values[i]
+        values.append(v)
+    return _make_record(layout, tuple(values))
+
+
+def compact_repodata(repodata, base=None, record_keys=("packages", "packages.conda")):
+    """Replace the records of repodata by `CompactRecord`s in place.
+
+    If `base` repodata is given, each record shares the values of unchanged
+    fields with the record of the same file in `base`.
+    """
+    for key in record_keys:
+        if key in repodata:
+            base_records = base.get(key, {}) if base is not None else {}
+            repodata[key] = {
+                fn: compact_record(record, base=base_records.get(fn))
+                for fn, record in repodata[key].items()
+            }
+    return repodata
+
+
+def copy_record(record):
+    """Make a mutable deep copy of a record."""
+    if isinstance(record, CompactRecord):
+        return record.to_dict()
+    return {k: _copy_value(v) for k, v in record.items()}
+
+
+def _copy_value(value):
+    if isinstance(value, list):
+        return [_copy_value(v) for v in value]
+    elif isinstance(value, Mapping):
+        return copy_record(value)
+    else:
+        return value
+
+
+def copy_repodata(repodata, record_keys=("packages", "packages.conda")):
+    """Make a mutable deep copy of repodata, e.g., to patch it."""
+    return {
+        k: (
+            {fn: copy_record(record) for fn, record in v.items()}
+            if k in record_keys
+            else _copy_value(v)
+        )
+        for k, v in repodata.items()
+    }
+
+
+def has_compact_records(repodata, record_keys=("packages", "packages.conda")):
+    for key in record_keys:
+        for record in repodata.get(key, {}).values():
+            return isinstance(record, CompactRecord)
+    return False
+
+
+def encode_record(value):
+    """Encode `CompactRecord`s for JSON, e.g., as the `default` of
+    `rapidjson.dumps`."""
+    if isinstance(value, CompactRecord):
+        return value.to_dict()
+    raise TypeError("%r is not JSON serializable" % value)
@@ -133,6 +133,12 @@ def main():
     feedstock = event_data['client_payload']["feedstock"]
     add_shard = event_data['client_payload'].get("add_shard", True)
     md5_val = event_data['client_payload']["md5"]
+    # newer events send the size and sha256 too, which lets us skip downloading
+    # the full package for .conda artifacts
+    upstream_record = {
+        k: event_data['client_payload'].get(k)
+        for k in ["size", "md5", "sha256"]
+    }
     print("subdir/package: %s/%s" % (subdir, pkg), flush=True)
     print("url:", url, flush=True)
     print("add shard:", add_shard, flush=True)
@@ -166,6 +172,8 @@ def main():
             url,
             tmpdir,
             md5_checksum=md5_val,
+            upstream_record=upstream_record,
+            metadata_only=not upload_pkg,
         )
 
         if upload_pkg:
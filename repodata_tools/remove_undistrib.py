@@ -219,7 +219,7 @@ def main(rank, n_ranks, time_limit):
     print("reading all shards", flush=True)
     for subdir in CONDA_FORGE_SUBIDRS:
         old_len = len(all_shards)
-        read_subdir_shards(".", subdir, all_shards)
+        read_subdir_shards(".", subdir, all_shards, use_pack=True)
         print(
             "found %d repodata shards for subdir %s" % (
                 len(all_shards) - old_len, subdir
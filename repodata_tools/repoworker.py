@@ -1,31 +1,73 @@
 import sys
 import time
 import os
+import re
 import io
 import bz2
+import hashlib
 import importlib
 import subprocess
+import threading
 import copy
+import shutil
 from datetime import datetime
+import multiprocessing
 import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 import pytz
 
 import github
 import tenacity
-import requests
 import rapidjson as json
 import click
 
 from .shards import read_subdir_shards
 from .metadata import CONDA_FORGE_SUBIDRS
 from .utils import timer
+from .git_objects import get_repo_sha, diff_tree_paths
+from .compress import (
+    compress_to_file,
+    get_segment_cache,
+    shutdown_compression_executors,
+    submit_compression,
+    CONTENT_TYPES,
+)
+from .serialize import get_json_cache, REPODATA_RECORD_KEYS, LINKS_RECORD_KEYS
+from .jlap import get_jlap_store, hash_segments, JLAP_CONTENT_TYPE
+from .current_repodata import get_current_repodata_store
+from .sharded_repodata import (
+    get_sharded_repodata_store,
+    get_shard_index_fn,
+    is_shard_fn,
+)
+from .upload_scheduler import UploadScheduler
+from .asset_cache import fetch_url, init_asset_cache, get_asset_cache
+from .checkpoint import write_checkpoint, read_checkpoint
+from .records import (
+    compact_repodata,
+    copy_record,
+    copy_repodata,
+    get_record_stats,
+    sweep_records,
+)
+from .versions import get_version_key_stats
+from .residency import (
+    init_label_residency,
+    get_label_residency,
+    enforce_label_residency,
+    make_label_store,
+    adopt_label_stores,
+    LabelStore,
+)
 
 from .links import get_latest_links
 from repodata_tools.index import (
     upload_repodata_asset,
+    get_github_rate_limit,
     delete_old_repodata_releases,
-    build_or_update_channeldata,
+    update_channeldata,
+    init_channeldata_cache,
+    get_channeldata_cache,
     build_or_update_links_and_repodata,
     INIT_REPODATA,
     build_current_repodata,
@@ -39,33 +81,227 @@ WORKDIR = "repodata_products"
 MIN_UPDATE_TIME = 30
 HEAD = "REPO WORKER: "
 DEBUG = False
+# if True, the records of the repodata are kept as CompactRecords
+COMPACT_RECORDS = False
 
+# the state shared with forked subdir workers, see _rebuild_subdirs_in_parallel
+SUBDIR_WORKER_STATE = {}
 
-def _write_compress_and_start_upload(
-    data, fn, rel, exec, no_compress=False, only_compress=False
+# the records the channeldata fingerprints of each label were made from
+CHANNELDATA_RECORDS = {}
+
+
+def _compress_and_report(segments, pth, fmt):
+    start = time.time()
+    size, digest = compress_to_file(segments, pth, fmt)
+    print(
+        f"{HEAD}    compressed {os.path.basename(pth)} "
+        f"({sum(len(segment) for segment in segments)} -> {size} bytes) "
+        f"in {time.time() - start:0.2f} seconds",
+        flush=True,
+    )
+    return pth, digest
+
+
+def _sha256_segments(segments):
+    hasher = hashlib.sha256()
+    for segment in segments:
+        hasher.update(segment)
+    return hasher.hexdigest()
+
+
+def _write_and_compress(
+    data, fn, no_compress=False, only_compress=False, formats=("bz2", "zst"),
+    record_keys=REPODATA_RECORD_KEYS, jlap_fn=None,
 ):
     pth = os.path.join(WORKDIR, fn)
-    with open(pth, "w") as fp:
-        json.dump(data, fp, indent=2, sort_keys=True)
-    futs = []
+    # only the records that changed since the last time we wrote this file
+    # are encoded again and only the segments of the file with changed
+    # records are compressed again
+    segments = get_json_cache().dumps_segments(fn, data, record_keys=record_keys)
+    with open(pth, "wb") as fp:
+        fp.writelines(segments)
+    # the uploads carry the hashes of the bytes written so that the files
+    # do not have to be read again to see if an older release has them
+    uploads = []
     if not only_compress:
-        futs.append(exec.submit(upload_repodata_asset, rel, pth, "application/json"))
+        uploads.append((pth, "application/json", _sha256_segments(segments)))
+    if jlap_fn is not None:
+        # the patch from the last version of the file is added to its .jlap
+        # log so that clients can update their copy without downloading it
+        jlap_pth = os.path.join(WORKDIR, jlap_fn)
+        jlap_data = get_jlap_store().update(
+            jlap_fn, data, hash_segments(segments)
+        ).encode("utf-8")
+        with open(jlap_pth, "wb") as fp:
+            fp.write(jlap_data)
+        uploads.append((
+            jlap_pth, JLAP_CONTENT_TYPE, hashlib.sha256(jlap_data).hexdigest()
+        ))
     if not no_compress:
-        subprocess.run(
-            f"cd {WORKDIR} && "
-            f"rm -f {fn}.bz2 && "
-            f"bzip2 --keep {fn}",
-            shell=True,
-            check=True,
-        )
-        futs.append(
-            exec.submit(
-                upload_repodata_asset, rel, pth + ".bz2", "application/x-bzip2"
-            )
+        # compression runs in the background so the next file can be
+        # serialized in the meantime - the paths and hashes are a future
+        # until then and this waits while too many files are waiting to be
+        # compressed
+        for fmt in formats:
+            uploads.append((
+                submit_compression(
+                    _compress_and_report, segments, f"{pth}.{fmt}", fmt,
+                ),
+                CONTENT_TYPES[fmt],
+                None,
+            ))
+    return uploads
+
+
+def _write_sharded_repodata(repodata, subdir, label, links, written_shards):
+    index_fn = get_shard_index_fn(subdir, label)
+    index, shards = get_sharded_repodata_store().update(index_fn, repodata)
+    # the shards an index refers to are kept so that the links to the shards
+    # no index refers to anymore can be removed
+    links.setdefault("shard-indexes", {})[index_fn] = sorted(shards)
+
+    # shards are named by their contents so the ones in an older release do
+    # not need to be uploaded again
+    uploads = []
+    os.makedirs(os.path.join(WORKDIR, "shards"), exist_ok=True)
+    for shard_fn, data in shards.items():
+        if shard_fn in links["serverdata"] or shard_fn in written_shards:
+            continue
+        pth = os.path.join(WORKDIR, "shards", shard_fn)
+        with open(pth, "wb") as fp:
+            fp.write(data)
+        uploads.append((
+            pth, CONTENT_TYPES["zst"], hashlib.sha256(data).hexdigest()
+        ))
+        written_shards.add(shard_fn)
+
+    pth = os.path.join(WORKDIR, index_fn)
+    with open(pth, "wb") as fp:
+        fp.write(index)
+    uploads.append((pth, CONTENT_TYPES["zst"], hashlib.sha256(index).hexdigest()))
+
+    print(
+        f"{HEAD}    wrote {len(uploads) - 1} of {len(shards)} repodata shards "
+        f"for {label}/{subdir}",
+        flush=True,
+    )
+    return uploads
+
+
+def _prune_shard_links(links):
+    # shards are named by their contents, so without this the links would
+    # keep every shard ever uploaded and the releases they are in
+    shard_indexes = links.get("shard-indexes", {})
+    n_unknown = sum(
+        1
+        for fn in links["serverdata"]
+        if fn.startswith("repodata_shards_") and fn not in shard_indexes
+    )
+    if n_unknown > 0:
+        print(
+            f"{HEAD}not removing the links to old repodata shards since the "
+            f"shards of {n_unknown} shard indexes are not known",
+            flush=True,
         )
+        return 0
+
+    live_shards = set()
+    for shard_fns in shard_indexes.values():
+        live_shards.update(shard_fns)
+    dead_shards = [
+        fn
+        for fn in links["serverdata"]
+        if is_shard_fn(fn) and fn not in live_shards
+    ]
+    for fn in dead_shards:
+        del links["serverdata"][fn]
+        links.get("serverdata-hashes", {}).pop(fn, None)
+    return len(dead_shards)
+
+
+def _wait_for_path(pth, digest):
+    # files still being compressed are a future of their path and hash
+    if isinstance(pth, concurrent.futures.Future):
+        return pth.result()
+    else:
+        return pth, digest
+
+
+def _upload_when_written(rel, pth, content_type, digest, links=None):
+    pth, digest = _wait_for_path(pth, digest)
+    fn = os.path.basename(pth)
+    # an asset with the same bytes is already in an older release
+    if (
+        links is not None
+        and links["serverdata"].get(fn)
+        and links.get("serverdata-hashes", {}).get(fn) == digest
+    ):
+        return fn, links["serverdata"][fn][-1], digest
+    fn, url = upload_repodata_asset(rel, pth, content_type)
+    return fn, url, digest
+
+
+def _get_subdirs_by_size(links):
+    n_pkgs = {subdir: 0 for subdir in CONDA_FORGE_SUBIDRS}
+    for subdir_pkg in links["packages"]:
+        subdir = subdir_pkg.split("/", 1)[0]
+        if subdir in n_pkgs:
+            n_pkgs[subdir] += 1
+    return sorted(CONDA_FORGE_SUBIDRS, key=lambda x: -n_pkgs[x])
+
+
+def _get_upload_priority(fn, subdirs):
+    # the main label goes first and then the biggest subdirs
+    label_rank = 0 if re.search(r"(^|_)main\.", fn) else 1
+    for subdir_rank, subdir in enumerate(subdirs):
+        if f"_{subdir}_" in fn:
+            return (label_rank, subdir_rank)
+    return (label_rank, len(subdirs))
+
+
+def _start_uploads(uploads, rel, exec, links=None):
+    subdirs = (
+        _get_subdirs_by_size(links) if links is not None else CONDA_FORGE_SUBIDRS
+    )
+    futs = []
+    priority = (1, len(subdirs))
+    for pth, content_type, digest in uploads:
+        # the compressed files are still being written, but they come after
+        # the file they were made from
+        if not isinstance(pth, concurrent.futures.Future):
+            priority = _get_upload_priority(os.path.basename(pth), subdirs)
+        futs.append(exec.submit(
+            _upload_when_written,
+            rel,
+            pth,
+            content_type,
+            digest,
+            links=links,
+            priority=priority,
+        ))
     return futs
 
 
+def _write_compress_and_start_upload(
+    data, fn, rel, exec, no_compress=False, only_compress=False,
+    formats=("bz2", "zst"), record_keys=REPODATA_RECORD_KEYS, links=None,
+):
+    return _start_uploads(
+        _write_and_compress(
+            data,
+            fn,
+            no_compress=no_compress,
+            only_compress=only_compress,
+            formats=formats,
+            record_keys=record_keys,
+        ),
+        rel,
+        exec,
+        links=links,
+    )
+
+
 @tenacity.retry(
     wait=tenacity.wait_random_exponential(multiplier=1, max=10),
     stop=tenacity.stop_after_attempt(5),
@@ -81,8 +317,12 @@ def _fetch_repodata(links, subdir, label):
             f"{HEAD}    fetching {url}",
             flush=True,
         )
-        r = requests.get(url)
-        return json.load(io.StringIO(bz2.decompress(r.content).decode("utf-8")))
+        rd = json.load(
+            io.StringIO(bz2.decompress(fetch_url(url)).decode("utf-8"))
+        )
+        if COMPACT_RECORDS:
+            compact_repodata(rd)
+        return rd
     else:
         rd = copy.deepcopy(INIT_REPODATA)
         rd["info"]["subdir"] = subdir
@@ -104,17 +344,79 @@ def _fetch_patched_repodata(links, subdir, label):
             f"{HEAD}    fetching {url}",
             flush=True,
         )
-        r = requests.get(url)
-        return json.load(io.StringIO(bz2.decompress(r.content).decode("utf-8")))
+        rd = json.load(
+            io.StringIO(bz2.decompress(fetch_url(url)).decode("utf-8"))
+        )
+        if COMPACT_RECORDS:
+            compact_repodata(rd)
+        return rd
     else:
         rd = copy.deepcopy(INIT_REPODATA)
         rd["info"]["subdir"] = subdir
         return rd
 
 
-def _update_repodata_from_shards(repodata, links, new_shards, removed_shards, subdir):
+@tenacity.retry(
+    wait=tenacity.wait_random_exponential(multiplier=1, max=10),
+    stop=tenacity.stop_after_attempt(5),
+    reraise=True,
+)
+def _fetch_jlap(links, subdir, label):
+    fn = f"repodata_{subdir}_{label}.jlap"
+    if fn in links["serverdata"]:
+        url = links["serverdata"][fn][-1]
+        print(
+            f"{HEAD}    fetching {url}",
+            flush=True,
+        )
+        return fetch_url(url).decode("utf-8")
+    else:
+        return None
+
+
+def _start_jlap(links, patched_repodata, subdir, label):
+    # the log has to start from the repodata we published last, which is
+    # the patched repodata before we patch it again
+    get_jlap_store().start(
+        f"repodata_{subdir}_{label}.jlap",
+        patched_repodata,
+        hash_segments(get_json_cache().dumps_segments(
+            f"repodata_{subdir}_{label}.json", patched_repodata,
+        )),
+        text=None if DEBUG else _fetch_jlap(links, subdir, label),
+    )
+
+
+def _drop_label_caches(kind, subdir, label):
+    # the caches refer to the records of a label, so they would keep them in
+    # memory after the label is spilled to disk
+    if kind == "patched":
+        get_json_cache().drop_files([
+            f"repodata_{subdir}_{label}.json",
+            f"current_repodata_{subdir}_{label}.json",
+        ])
+        get_jlap_store().drop_snapshots([f"repodata_{subdir}_{label}.jlap"])
+        get_current_repodata_store().drop_files(
+            [f"current_repodata_{subdir}_{label}.json"]
+        )
+        get_sharded_repodata_store().drop_files([get_shard_index_fn(subdir, label)])
+        CHANNELDATA_RECORDS.get(label, {}).pop(subdir, None)
+    else:
+        get_json_cache().drop_files([f"repodata_from_packages_{subdir}_{label}.json"])
+
+
+def _update_repodata_from_shards(
+    repodata, links, new_shards, removed_shards, subdir, shards_sha
+):
     all_shards = {}
-    read_subdir_shards("repodata-shards", subdir, all_shards, shard_paths=new_shards)
+    read_subdir_shards(
+        "repodata-shards",
+        subdir,
+        all_shards,
+        shard_paths=new_shards,
+        use_pack=True,
+        sha=shards_sha,
+    )
     print(
         f"{HEAD}    found {len(all_shards)} repodata shards for subdir {subdir}",
         flush=True,
@@ -122,6 +424,16 @@ def _update_repodata_from_shards(repodata, links, new_shards, removed_shards, su
     if new_shards is not None:
         assert len(all_shards) == len(new_shards)
 
+    # keep the channeldata of the shards so we do not read them again when
+    # building channeldata
+    channeldata_cache = get_channeldata_cache()
+    channeldata_cache.update_from_shards(all_shards)
+    if removed_shards:
+        channeldata_cache.remove(
+            os.path.join(subdir, os.path.basename(pth)[:-len(".json")])
+            for pth in removed_shards
+        )
+
     return build_or_update_links_and_repodata(
         repodata,
         links,
@@ -129,9 +441,15 @@ def _update_repodata_from_shards(repodata, links, new_shards, removed_shards, su
         all_shards,
         fetch_repodata=None if DEBUG else _fetch_repodata,
         removed_shards=removed_shards,
+        compact_records=COMPACT_RECORDS,
     )
 
 
+def _encode_any(value):
+    # label stores and compact records are mappings
+    return dict(value)
+
+
 def _clean_nones(data):
     for k in list(data.keys()):
         if isinstance(data[k], dict):
@@ -152,16 +470,22 @@ def _patch_repodata(repodata, patched_repodata, subdir, patch_fns, do_all=False)
             - set(patched_repodata["packages"])
         )
         for fn in add_fn:
-            data_to_patch["packages"][fn] = copy.deepcopy(repodata["packages"][fn])
+            data_to_patch["packages"][fn] = copy_record(repodata["packages"][fn])
 
         new_index = patch_fns["gen_new_index"](data_to_patch, subdir)
         _clean_nones(new_index)
+        if COMPACT_RECORDS:
+            # unchanged records and fields are shared with the raw repodata
+            compact_repodata(new_index, base=repodata)
 
         for index_key in ["packages", "packages.conda"]:
             patched_repodata[index_key].update(new_index[index_key])
     else:
-        new_index = patch_fns["gen_new_index"](copy.deepcopy(repodata), subdir)
+        new_index = patch_fns["gen_new_index"](copy_repodata(repodata), subdir)
         _clean_nones(new_index)
+        if COMPACT_RECORDS:
+            # unchanged records and fields are shared with the raw repodata
+            compact_repodata(new_index, base=repodata)
 
         for index_key in ["packages", "packages.conda"]:
             patched_repodata[index_key] = new_index[index_key]
@@ -183,6 +507,7 @@ def _patch_repodata(repodata, patched_repodata, subdir, patch_fns, do_all=False)
 
 def _build_channel_data(
     all_channeldata,
+    all_channeldata_fingerprints,
     all_links,
     all_patched_repodata,
     all_labels,
@@ -192,6 +517,7 @@ def _build_channel_data(
     *,
     make_releases,
     main_only,
+    shards_sha,
 ):
     futs = []
 
@@ -202,29 +528,39 @@ def _build_channel_data(
             continue
 
         with timer(HEAD, f"processing label {label}", indent=1):
-            # reset since some package in the channel has been updated
-            all_channeldata[label] = {}
-
+            all_subdir_repodata = {}
             for subdir in CONDA_FORGE_SUBIDRS:
-                with timer(HEAD, f"processing subdir {subdir}", indent=2):
-                    if label not in all_patched_repodata[subdir]:
-                        with timer(
-                            HEAD,
-                            f"fetching patched repodata for {label}/{subdir}",
-                            indent=3,
-                        ):
-                            all_patched_repodata[subdir][label] = \
-                                _fetch_patched_repodata(
-                                    all_links, subdir, label
-                                )
-
-                    channel_data = all_channeldata.get(label, {})
-                    build_or_update_channeldata(
-                        channel_data,
-                        all_patched_repodata[subdir][label],
-                        subdir,
-                    )
-                    all_channeldata[label] = channel_data
+                if label not in all_patched_repodata[subdir]:
+                    with timer(
+                        HEAD,
+                        f"fetching patched repodata for {label}/{subdir}",
+                        indent=2,
+                    ):
+                        all_patched_repodata[subdir][label] = \
+                            _fetch_patched_repodata(
+                                all_links, subdir, label
+                            )
+                all_subdir_repodata[subdir] = all_patched_repodata[subdir][label]
+
+            # only the entries for package names with new, changed or removed
+            # records are recomputed
+            if label not in all_channeldata:
+                all_channeldata[label] = {}
+                all_channeldata_fingerprints[label] = {}
+            touched_names = update_channeldata(
+                all_channeldata[label],
+                all_channeldata_fingerprints[label],
+                all_subdir_repodata,
+                shards_sha=shards_sha,
+                records=CHANNELDATA_RECORDS.setdefault(label, {}),
+            )
+            channeldata_cache = get_channeldata_cache()
+            print(
+                f"{HEAD}    recomputed channeldata for "
+                f"{len(touched_names)} package names - cache "
+                f"hits|misses: {channeldata_cache.hits}|{channeldata_cache.misses}",
+                flush=True,
+            )
 
             if make_releases:
                 futs.extend(_write_compress_and_start_upload(
@@ -233,41 +569,42 @@ def _build_channel_data(
                     rel,
                     exec,
                     no_compress=True,
+                    record_keys=(),
+                    links=all_links,
                 ))
 
+        del all_subdir_repodata
+        enforce_label_residency()
+
     return futs
 
 
-def _get_new_shards_from_repo(old_sha):
+def _fetch_repodata_shards():
+    # we read the shards straight from the git objects so we only fetch
+    # and never update the working tree
     subprocess.run(
-        "cd repodata-shards && git pull",
+        "cd repodata-shards && git fetch --quiet",
         shell=True,
     )
-    new_sha = subprocess.run(
-        "cd repodata-shards && git rev-parse --verify HEAD",
-        shell=True,
-        check=True,
-        capture_output=True,
-    ).stdout.decode("utf-8").strip()
+    return get_repo_sha("repodata-shards", "@{upstream}")
+
+
+def _get_new_shards_from_repo(old_sha):
+    new_sha = _fetch_repodata_shards()
     print(f"{HEAD}old shards sha={old_sha}", flush=True)
     print(f"{HEAD}new shards sha={new_sha}", flush=True)
-    new_shards_output = subprocess.run(
-        "cd repodata-shards && git diff --name-status %s %s" % (old_sha, new_sha),
-        shell=True,
-        check=True,
-        capture_output=True,
-    ).stdout.decode("utf-8")
+    new_or_modified, removed = diff_tree_paths(
+        "repodata-shards", old_sha, new_sha, "shards/"
+    )
     new_shards = [
-        os.path.join("repodata-shards", line.strip().split()[1].strip())
-        for line in new_shards_output.splitlines()
-        if line.strip().split()[0].strip() != "D"
+        os.path.join("repodata-shards", pth)
+        for pth in new_or_modified
     ]
     print(f"{HEAD}found {len(new_shards)} new or modified shards", flush=True)
 
     removed_shards = [
-        os.path.join("repodata-shards", line.strip().split()[1].strip())
-        for line in new_shards_output.splitlines()
-        if line.strip().split()[0].strip() == "D"
+        os.path.join("repodata-shards", pth)
+        for pth in removed
     ]
     print(f"{HEAD}found {len(removed_shards)} removed shards", flush=True)
 
@@ -279,12 +616,7 @@ def _get_new_shards(old_sha):
         print(f"{HEAD}doing a full rebuild of repodata products", flush=True)
         new_shards = None
         removed_shards = None
-        new_sha = subprocess.run(
-            "cd repodata-shards && git rev-parse --verify HEAD",
-            shell=True,
-            check=True,
-            capture_output=True,
-        ).stdout.decode("utf-8").strip()
+        new_sha = _fetch_repodata_shards()
     else:
         with timer(HEAD, "pulling new shards"):
             old_sha, new_sha, new_shards, removed_shards = _get_new_shards_from_repo(
@@ -340,6 +672,7 @@ def _load_current_data(make_releases, allow_unsafe):
     all_links = {
         "packages": {},
         "serverdata": {},
+        "serverdata-hashes": {},
         "current-shas": {},
         "labels": [],
     }
@@ -421,9 +754,9 @@ def _clone_and_init_repodata_patches():
 
 
 def _rebuild_subdir(
-    *, subdir, new_shards, removed_shards, repatch_all_pkgs,
+    *, subdir, new_shards, removed_shards, shards_sha, repatch_all_pkgs,
     all_repodata, all_patched_repodata, all_links, updated_data,
-    make_releases, main_only, patch_fns, futures, rel, exec,
+    make_releases, main_only, patch_fns, start_uploads, sharded_repodata=False,
 ):
     if new_shards is not None:
         new_subdir_shards = [
@@ -446,9 +779,9 @@ def _rebuild_subdir(
         removed_subdir_shards = None
 
     if subdir not in all_repodata:
-        all_repodata[subdir] = {}
+        all_repodata[subdir] = make_label_store("raw", subdir)
     if subdir not in all_patched_repodata:
-        all_patched_repodata[subdir] = {}
+        all_patched_repodata[subdir] = make_label_store("patched", subdir)
 
     subdir_updated_data = set()
 
@@ -466,6 +799,7 @@ def _rebuild_subdir(
                     new_subdir_shards,
                     removed_subdir_shards,
                     subdir,
+                    shards_sha,
                 )
                 updated_data |= subdir_updated_data
                 all_labels = set(all_links["labels"])
@@ -476,6 +810,7 @@ def _rebuild_subdir(
                 all_links["labels"] = sorted(all_labels)
 
         if make_releases and (subdir_updated_data or repatch_all_pkgs):
+            written_shards = set()
             with timer(HEAD, "patching and writing repodata", indent=1):
                 for label in all_links["labels"]:
                     if (
@@ -496,6 +831,20 @@ def _rebuild_subdir(
                                 all_links, subdir, label
                             )
 
+                    jlap_fn = f"repodata_{subdir}_{label}.jlap"
+                    if jlap_fn not in get_jlap_store():
+                        _start_jlap(
+                            all_links,
+                            all_patched_repodata[subdir][label],
+                            subdir,
+                            label,
+                        )
+                    elif get_jlap_store().needs_snapshot(jlap_fn):
+                        # the label was spilled to disk as it was last written
+                        get_jlap_store().restore_snapshot(
+                            jlap_fn, all_patched_repodata[subdir][label],
+                        )
+
                     if label == "broken":
                         all_patched_repodata[subdir][label] = copy.deepcopy(
                             all_repodata[subdir][label]
@@ -509,13 +858,23 @@ def _rebuild_subdir(
                             do_all=repatch_all_pkgs,
                         )
 
-                    futures.extend(_write_compress_and_start_upload(
+                    start_uploads(_write_and_compress(
                         all_patched_repodata[subdir][label],
                         f"repodata_{subdir}_{label}.json",
-                        rel,
-                        exec,
+                        jlap_fn=jlap_fn,
                     ))
 
+                    if sharded_repodata:
+                        start_uploads(_write_sharded_repodata(
+                            all_patched_repodata[subdir][label],
+                            subdir,
+                            label,
+                            all_links,
+                            written_shards,
+                        ))
+
+                    enforce_label_residency()
+
             with timer(
                 HEAD, "building and writing current repodata", indent=1
             ):
@@ -543,14 +902,16 @@ def _rebuild_subdir(
                     crd = build_current_repodata(
                         subdir,
                         all_patched_repodata[subdir][label],
-                        )
+                        fn=f"current_repodata_{subdir}_{label}.json",
+                    )
 
-                    futures.extend(_write_compress_and_start_upload(
+                    start_uploads(_write_and_compress(
                         crd,
                         f"current_repodata_{subdir}_{label}.json",
-                        rel,
-                        exec,
                     ))
+                    del crd
+
+                    enforce_label_residency()
 
             with timer(
                 HEAD, "writing repodata from packages", indent=1
@@ -561,13 +922,249 @@ def _rebuild_subdir(
                     if main_only and label != "main":
                         continue
 
-                    futures.extend(_write_compress_and_start_upload(
+                    start_uploads(_write_and_compress(
                         all_repodata[subdir][label],
                         f"repodata_from_packages_{subdir}_{label}.json",
-                        rel,
-                        exec,
                     ))
 
+                    enforce_label_residency()
+
+
+def _rebuild_subdir_in_worker(subdir, **kwargs):
+    # the big data structures are inherited from the parent when the worker
+    # is forked so we only send back the parts for this subdir
+    all_repodata = SUBDIR_WORKER_STATE["all_repodata"]
+    all_patched_repodata = SUBDIR_WORKER_STATE["all_patched_repodata"]
+    all_links = SUBDIR_WORKER_STATE["all_links"]
+    updated_data = set()
+    uploads = []
+    get_channeldata_cache().track_changes()
+    residency = get_label_residency()
+    if residency is not None:
+        # the labels of the other subdirs are shared with the parent
+        n_procs = SUBDIR_WORKER_STATE["n_procs"]
+        residency.restrict_to(subdir, residency.max_bytes // n_procs)
+        get_json_cache().max_bytes //= n_procs
+        get_segment_cache().max_bytes //= n_procs
+
+    _rebuild_subdir(
+        subdir=subdir,
+        all_repodata=all_repodata,
+        all_patched_repodata=all_patched_repodata,
+        all_links=all_links,
+        updated_data=updated_data,
+        patch_fns=SUBDIR_WORKER_STATE["patch_fns"],
+        start_uploads=uploads.extend,
+        **kwargs,
+    )
+
+    uploads = [
+        (pth, ct, digest)
+        for (pth, digest), ct in (
+            (_wait_for_path(pth, digest), ct) for pth, ct, digest in uploads
+        )
+    ]
+
+    if residency is not None:
+        print(f"{HEAD}{subdir}: {residency.report()}", flush=True)
+
+    # only the labels this worker changed are sent back - the parent still
+    # has the others
+    labels = {label for _, label in updated_data}
+    if kwargs["make_releases"] and kwargs["repatch_all_pkgs"]:
+        labels |= {
+            label
+            for label in all_links["labels"]
+            if not kwargs["main_only"] or label == "main"
+        }
+    if kwargs["removed_shards"] is None or any(
+        pth.startswith(f"repodata-shards/shards/{subdir}/")
+        for pth in kwargs["removed_shards"]
+    ):
+        # removed packages are removed from every label
+        labels |= set(all_repodata[subdir])
+
+    # the fragments are sent in the same pickle as the records so that they
+    # still refer to the same objects in the parent
+    result = {
+        "repodata": _get_labels(all_repodata[subdir], labels),
+        "patched_repodata": _get_labels(all_patched_repodata[subdir], labels),
+        "packages": {
+            k: v
+            for k, v in all_links["packages"].items()
+            if k.startswith(f"{subdir}/")
+        },
+        "labels": all_links["labels"],
+        "shard_indexes": {
+            k: v
+            for k, v in all_links.get("shard-indexes", {}).items()
+            if k.startswith(f"repodata_shards_{subdir}_")
+        },
+        "updated_data": updated_data,
+        "uploads": uploads,
+        "json_fragments": get_json_cache().get_files(
+            os.path.basename(pth)
+            for pth, ct, _ in uploads
+            if ct == "application/json"
+        ),
+        "compressed_segments": get_segment_cache().get_files(
+            os.path.basename(pth)
+            for pth, ct, _ in uploads
+            if ct == CONTENT_TYPES["bz2"]
+        ),
+        "jlap_logs": get_jlap_store().get_files(
+            os.path.basename(pth)
+            for pth, ct, _ in uploads
+            if ct == JLAP_CONTENT_TYPE
+        ),
+        "repodata_shards": get_sharded_repodata_store().get_files(
+            os.path.basename(pth)
+            for pth, ct, _ in uploads
+            if os.path.basename(pth).startswith("repodata_shards_")
+        ),
+        "current_repodata_indexes": get_current_repodata_store().get_files(
+            os.path.basename(pth)
+            for pth, ct, _ in uploads
+            if os.path.basename(pth).startswith("current_repodata_")
+        ),
+        "channeldata_changes": get_channeldata_cache().pop_changes(),
+    }
+
+    if residency is not None:
+        # remove the files the labels were spilled to in this worker
+        all_repodata[subdir].close()
+        all_patched_repodata[subdir].close()
+
+    return result
+
+
+def _get_labels(labels_store, labels):
+    if isinstance(labels_store, LabelStore):
+        return labels_store.get_labels(labels)
+    return {label: labels_store[label] for label in labels if label in labels_store}
+
+
+def _update_labels(all_repodata, kind, subdir, labels):
+    if subdir not in all_repodata:
+        all_repodata[subdir] = make_label_store(kind, subdir)
+    if isinstance(all_repodata[subdir], LabelStore):
+        all_repodata[subdir].update_labels(labels)
+    else:
+        all_repodata[subdir].update(labels)
+
+
+def _merge_subdir_result(
+    subdir, result, all_repodata, all_patched_repodata, all_links, updated_data,
+):
+    _update_labels(all_repodata, "raw", subdir, result["repodata"])
+    _update_labels(all_patched_repodata, "patched", subdir, result["patched_repodata"])
+    for k in [k for k in all_links["packages"] if k.startswith(f"{subdir}/")]:
+        del all_links["packages"][k]
+    all_links["packages"].update(result["packages"])
+    all_links["labels"] = sorted(set(all_links["labels"]) | set(result["labels"]))
+    if result["shard_indexes"]:
+        all_links.setdefault("shard-indexes", {}).update(result["shard_indexes"])
+    updated_data |= result["updated_data"]
+    get_json_cache().update_files(result["json_fragments"])
+    get_segment_cache().update_files(result["compressed_segments"])
+    get_jlap_store().update_files(result["jlap_logs"])
+    get_sharded_repodata_store().update_files(result["repodata_shards"])
+    get_current_repodata_store().update_files(result["current_repodata_indexes"])
+    channeldata_entries, removed_channeldata = result["channeldata_changes"]
+    get_channeldata_cache().remove(removed_channeldata)
+    get_channeldata_cache().update(channeldata_entries)
+
+
+def _rebuild_subdirs_in_parallel(
+    *, n_procs, all_repodata, all_patched_repodata, all_links, updated_data,
+    patch_fns, start_uploads, **kwargs,
+):
+    """Rebuild all of the subdirs at once in forked worker processes.
+
+    Each worker rebuilds, patches, writes and compresses one subdir and sends
+    back the labels it changed. As soon as a worker is done, the uploads of
+    its subdir are started and its labels are merged back into
+    `all_repodata`, `all_patched_repodata`, `all_links` and `updated_data`.
+    The subdirs do not share any state, so the results do not depend on
+    which worker finishes first.
+
+    The workers are forked before any threads of this process are started
+    (the upload threads start with the first upload and the idle compression
+    pools are shut down) so that no lock is held by a thread that does not
+    exist in the workers.
+
+    Returns
+    -------
+    failed_subdirs : list of str
+        The subdirs whose workers raised an error. Their state is not merged.
+    """
+    # start the biggest subdirs first so the cycle takes about as long as
+    # the biggest one
+    subdirs = _get_subdirs_by_size(all_links)
+
+    SUBDIR_WORKER_STATE.update({
+        "all_repodata": all_repodata,
+        "all_patched_repodata": all_patched_repodata,
+        "all_links": all_links,
+        "patch_fns": patch_fns,
+        "n_procs": n_procs,
+    })
+    shutdown_compression_executors()
+    n_threads = threading.active_count()
+    if n_threads > 1:
+        print(
+            f"{HEAD}WARNING: forking subdir workers with {n_threads - 1} "
+            "other threads running",
+            flush=True,
+        )
+
+    merged_subdirs = set()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_procs,
+            mp_context=multiprocessing.get_context("fork"),
+        ) as pool:
+            # all of the workers are forked on the first submit
+            futs = {
+                pool.submit(_rebuild_subdir_in_worker, subdir, **kwargs): subdir
+                for subdir in subdirs
+            }
+            for fut in concurrent.futures.as_completed(futs):
+                subdir = futs.pop(fut)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    print(
+                        f"{HEAD}rebuilding subdir {subdir} failed: {repr(e)}",
+                        flush=True,
+                    )
+                    continue
+
+                start_uploads(result["uploads"])
+                with timer(HEAD, f"merging data for subdir {subdir}"):
+                    _merge_subdir_result(
+                        subdir,
+                        result,
+                        all_repodata,
+                        all_patched_repodata,
+                        all_links,
+                        updated_data,
+                    )
+                    # only the result being merged is held on to
+                    del fut, result
+                    merged_subdirs.add(subdir)
+                    residency = get_label_residency()
+                    if residency is not None:
+                        # the spilled labels of the worker come back in memory
+                        residency.flush()
+                        residency.enforce()
+    finally:
+        SUBDIR_WORKER_STATE.clear()
+
+    return [
+        subdir for subdir in CONDA_FORGE_SUBIDRS if subdir not in merged_subdirs
+    ]
+
 
 @click.command()
 @click.argument("time_limit", type=int)
@@ -579,12 +1176,73 @@ def _rebuild_subdir(
     "--debug", is_flag=True, help="write data locally for debugging")
 @click.option(
     "--allow-unsafe", is_flag=True, help="allow unsafe operation when making releases")
-def main(time_limit, make_releases, main_only, debug, allow_unsafe):
+@click.option(
+    "--n-procs",
+    default=4,
+    type=int,
+    help="the number of subdirs to rebuild in parallel (1 rebuilds them in serial)",
+)
+@click.option(
+    "--channeldata-cache-dir",
+    default=None,
+    type=str,
+    help="if given, keep the shard channeldata cache on disk in this directory",
+)
+@click.option(
+    "--channeldata-cache-gb",
+    default=2.0,
+    type=float,
+    help="the maximum size of the on-disk shard channeldata cache in GB",
+)
+@click.option(
+    "--asset-cache-dir",
+    default=None,
+    type=str,
+    help="if given, keep the fetched release assets on disk in this directory",
+)
+@click.option(
+    "--asset-cache-gb",
+    default=5.0,
+    type=float,
+    help="the maximum size of the on-disk release asset cache in GB",
+)
+@click.option(
+    "--checkpoint-path",
+    default=None,
+    type=str,
+    help="if given, save the worker state here after each release and resume from it",
+)
+@click.option(
+    "--sharded-repodata",
+    is_flag=True,
+    help="also release repodata sharded by package name (CEP-16)",
+)
+@click.option(
+    "--compact-records",
+    is_flag=True,
+    help="keep the package records in a compact, immutable form to save memory",
+)
+@click.option(
+    "--max-label-memory-gb",
+    default=None,
+    type=float,
+    help=(
+        "if given, spill the repodata of the least recently used labels to disk "
+        "to keep it and the caches of the files made from it under this size in GB"
+    ),
+)
+def main(
+    time_limit, make_releases, main_only, debug, allow_unsafe, n_procs,
+    channeldata_cache_dir, channeldata_cache_gb, asset_cache_dir, asset_cache_gb,
+    sharded_repodata, checkpoint_path, max_label_memory_gb, compact_records,
+):
     """Worker process for continuously building repodata for a maximum
     number of TIME_LIMIT seconds.
     """
     global DEBUG
+    global COMPACT_RECORDS
     DEBUG = debug
+    COMPACT_RECORDS = compact_records
 
     start_time = time.time()
 
@@ -600,11 +1258,58 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
         if not os.path.exists("conda-forge-repodata-patches-feedstock"):
             _clone_and_init_repodata_patches()
 
+    if channeldata_cache_dir is not None:
+        init_channeldata_cache(
+            cache_dir=channeldata_cache_dir,
+            max_disk_bytes=int(channeldata_cache_gb * 1000**3),
+        )
+
+    if asset_cache_dir is not None:
+        init_asset_cache(asset_cache_dir, max_bytes=int(asset_cache_gb * 1000**3))
+
+    if max_label_memory_gb is not None:
+        # the caches of the encoded and compressed files count against the cap
+        max_label_bytes = int(max_label_memory_gb * 1000**3)
+        json_cache = get_json_cache()
+        json_cache.max_bytes = min(json_cache.max_bytes, max_label_bytes // 4)
+        segment_cache = get_segment_cache()
+        segment_cache.max_bytes = min(segment_cache.max_bytes, max_label_bytes // 8)
+        spill_dir = os.path.join(WORKDIR, "spilled_labels")
+        shutil.rmtree(spill_dir, ignore_errors=True)
+        init_label_residency(
+            max_label_bytes - json_cache.max_bytes - segment_cache.max_bytes,
+            spill_dir,
+            on_evict=_drop_label_caches,
+        )
+
     with timer(HEAD, "loading local data"):
         all_repodata, all_links = _load_current_data(make_releases, allow_unsafe)
         all_channeldata = {}
+        all_channeldata_fingerprints = {}
         all_patched_repodata = {}
 
+    if checkpoint_path is not None and not DEBUG:
+        with timer(HEAD, "loading checkpoint"):
+            state = read_checkpoint(checkpoint_path, all_links)
+            if state is not None:
+                all_repodata = state["all_repodata"]
+                all_patched_repodata = state["all_patched_repodata"]
+                all_channeldata = state["all_channeldata"]
+                all_channeldata_fingerprints = state["all_channeldata_fingerprints"]
+                all_links = state["all_links"]
+            del state
+
+    if COMPACT_RECORDS:
+        for _all_repodata in [all_repodata, all_patched_repodata]:
+            for subdir_repodata in _all_repodata.values():
+                for label in subdir_repodata:
+                    compact_repodata(subdir_repodata[label])
+                    enforce_label_residency()
+
+    adopt_label_stores(all_repodata, "raw")
+    adopt_label_stores(all_patched_repodata, "patched")
+    enforce_label_residency()
+
     while time.time() - start_time < time_limit:
         __dt = time.time() - start_time
         print("===================================================", flush=True)
@@ -622,7 +1327,10 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
 
         refresh_github_token_and_client()
 
-        with timer(HEAD, "doing repodata products rebuild"), ThreadPoolExecutor(max_workers=8) as exec:  # noqa
+        # the shards of the last cycle have been uploaded
+        shutil.rmtree(os.path.join(WORKDIR, "shards"), ignore_errors=True)
+
+        with timer(HEAD, "doing repodata products rebuild"), UploadScheduler(max_workers=8, get_rate_limit=get_github_rate_limit) as exec:  # noqa
             old_sha, new_sha, new_shards, removed_shards = _get_new_shards(
                 all_links["current-shas"].get("repodata-shards-sha", None)
             )
@@ -658,19 +1366,69 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
                     "commit",
                     draft=True,
                 )
+                if "releases" in all_links:
+                    all_links["releases"][rel.tag_name] = rel.id
                 futures = []
             else:
                 # do this to catch errors
                 futures = None
                 rel = None
 
-            for subdir in CONDA_FORGE_SUBIDRS:
-                try:
+            def _start_subdir_uploads(uploads):
+                futures.extend(_start_uploads(uploads, rel, exec, links=all_links))
+
+            rebuild_kwargs = dict(
+                new_shards=new_shards,
+                removed_shards=removed_shards,
+                shards_sha=new_sha,
+                repatch_all_pkgs=repatch_all_pkgs,
+                make_releases=make_releases,
+                main_only=main_only,
+                sharded_repodata=sharded_repodata,
+            )
+            if n_procs > 1:
+                failed_subdirs = _rebuild_subdirs_in_parallel(
+                    n_procs=n_procs,
+                    all_repodata=all_repodata,
+                    all_patched_repodata=all_patched_repodata,
+                    all_links=all_links,
+                    updated_data=updated_data,
+                    patch_fns=patch_fns,
+                    start_uploads=_start_subdir_uploads,
+                    **rebuild_kwargs,
+                )
+            else:
+                failed_subdirs = []
+                for subdir in CONDA_FORGE_SUBIDRS:
+                    try:
+                        _rebuild_subdir(
+                            subdir=subdir,
+                            all_repodata=all_repodata,
+                            all_patched_repodata=all_patched_repodata,
+                            all_links=all_links,
+                            updated_data=updated_data,
+                            patch_fns=patch_fns,
+                            start_uploads=_start_subdir_uploads,
+                            **rebuild_kwargs,
+                        )
+                    except Exception:
+                        failed_subdirs.append(subdir)
+
+            for subdir in failed_subdirs:
+                if rel is not None and futures is not None:
+                    for fn in list(all_links["serverdata"]):
+                        if f"_{subdir}" in fn:
+                            del all_links["serverdata"][fn]
+                            all_links.get("serverdata-hashes", {}).pop(fn, None)
+                            all_links.get("shard-indexes", {}).pop(fn, None)
+
+                    # rebuild it all if we error
                     _rebuild_subdir(
                         subdir=subdir,
-                        new_shards=new_shards,
-                        removed_shards=removed_shards,
-                        repatch_all_pkgs=repatch_all_pkgs,
+                        new_shards=None,
+                        removed_shards=None,
+                        shards_sha=new_sha,
+                        repatch_all_pkgs=True,
                         all_repodata=all_repodata,
                         all_patched_repodata=all_patched_repodata,
                         all_links=all_links,
@@ -678,33 +1436,9 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
                         make_releases=make_releases,
                         main_only=main_only,
                         patch_fns=patch_fns,
-                        futures=futures,
-                        rel=rel,
-                        exec=exec,
+                        start_uploads=_start_subdir_uploads,
+                        sharded_repodata=sharded_repodata,
                     )
-                except Exception:
-                    if rel is not None and futures is not None:
-                        for fn in list(all_links["serverdata"]):
-                            if f"_{subdir}" in fn:
-                                del all_links["serverdata"][fn]
-
-                        # rebuild it all if we error
-                        _rebuild_subdir(
-                            subdir=subdir,
-                            new_shards=None,
-                            removed_shards=None,
-                            repatch_all_pkgs=True,
-                            all_repodata=all_repodata,
-                            all_patched_repodata=all_patched_repodata,
-                            all_links=all_links,
-                            updated_data=updated_data,
-                            make_releases=make_releases,
-                            main_only=main_only,
-                            patch_fns=patch_fns,
-                            futures=futures,
-                            rel=rel,
-                            exec=exec,
-                        )
 
             all_links["current-shas"]["repodata-shards-sha"] = new_sha
             all_links["current-shas"]["repodata-patches-sha"] = new_patch_sha
@@ -713,6 +1447,7 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
                 with timer(HEAD, "(re)building channel data"):
                     futures.extend(_build_channel_data(
                         all_channeldata,
+                        all_channeldata_fingerprints,
                         all_links,
                         all_patched_repodata,
                         all_links["labels"],
@@ -721,22 +1456,45 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
                         exec,
                         make_releases=make_releases,
                         main_only=main_only,
+                        shards_sha=new_sha,
                     ))
 
             if updated_data and make_releases:
                 with timer(HEAD, "waiting for repo/channel data uploads to finish"):
+                    if "serverdata-hashes" not in all_links:
+                        all_links["serverdata-hashes"] = {}
+                    n_reused = 0
                     for fut in concurrent.futures.as_completed(futures):
-                        fname, url = fut.result()
+                        fname, url, digest = fut.result()
+                        all_links["serverdata-hashes"][fname] = digest
                         if fname not in all_links["serverdata"]:
                             all_links["serverdata"][fname] = []
+                        if all_links["serverdata"][fname][-1:] == [url]:
+                            n_reused += 1
+                            continue
                         all_links["serverdata"][fname].append(url)
                         if len(all_links["serverdata"][fname]) > 3:
                             all_links["serverdata"][fname] = \
                                 all_links["serverdata"][fname][-3:]
+                    print(
+                        f"{HEAD}reused {n_reused} of {len(futures)} assets "
+                        "from older releases",
+                        flush=True,
+                    )
+                    n_pruned = _prune_shard_links(all_links)
+                    if n_pruned > 0:
+                        print(
+                            f"{HEAD}removed the links to {n_pruned} repodata "
+                            "shards no index refers to",
+                            flush=True,
+                        )
+                    print(f"{HEAD}{exec.report()}", flush=True)
                     futures = []
 
                 with timer(HEAD, "writing and uploading links"):
                     all_links["updated_at"] = utcnow.strftime("%Y-%m-%d %H:%M:%S %Z%z")
+                    # this release may have no other assets in the links
+                    all_links["links-release-tag"] = rel.tag_name
                     futures.extend(
                         _write_compress_and_start_upload(
                             all_links,
@@ -744,6 +1502,8 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
                             rel,
                             exec,
                             only_compress=True,
+                            formats=("bz2",),
+                            record_keys=LINKS_RECORD_KEYS,
                         )
                     )
                     concurrent.futures.wait(futures)
@@ -753,10 +1513,64 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
 
             if make_releases:
                 with timer(HEAD, "deleting old releases"):
-                    tags = delete_old_repodata_releases(all_links)
+                    tags = delete_old_repodata_releases(
+                        all_links,
+                        keep_tags=[
+                            tag
+                            for tag in [
+                                all_links.get("links-release-tag"),
+                                rel.tag_name if rel is not None else None,
+                            ]
+                            if tag is not None
+                        ],
+                        exec=exec,
+                    )
                     for tag in tags:
                         print(f"{HEAD}deleted release {tag}", flush=True)
 
+            if checkpoint_path is not None and updated_data and make_releases:
+                with timer(HEAD, "writing checkpoint"):
+                    write_checkpoint(
+                        checkpoint_path,
+                        {
+                            "all_repodata": all_repodata,
+                            "all_patched_repodata": all_patched_repodata,
+                            "all_channeldata": all_channeldata,
+                            "all_channeldata_fingerprints": (
+                                all_channeldata_fingerprints
+                            ),
+                            "all_links": all_links,
+                        },
+                    )
+
+        residency = get_label_residency()
+        if residency is not None:
+            print(f"{HEAD}{residency.report()}", flush=True)
+
+        if COMPACT_RECORDS:
+            sweep_records()
+            n_records, hits, misses = get_record_stats()
+            print(
+                f"{HEAD}distinct records in use: {n_records} - records "
+                f"shared|new: {hits}|{misses}",
+                flush=True,
+            )
+
+        n_version_keys, hits, misses = get_version_key_stats()
+        print(
+            f"{HEAD}version keys cached: {n_version_keys} - version keys "
+            f"hit|missed: {hits}|{misses}",
+            flush=True,
+        )
+
+        asset_cache = get_asset_cache()
+        if asset_cache is not None:
+            print(
+                f"{HEAD}asset cache hits|revalidated|misses: "
+                f"{asset_cache.hits}|{asset_cache.revalidated}|{asset_cache.misses}",
+                flush=True,
+            )
+
         dt = int(time.time() - build_start_time)
 
         if dt < MIN_UPDATE_TIME:
@@ -770,9 +1584,17 @@ def main(time_limit, make_releases, main_only, debug, allow_unsafe):
     if DEBUG:
         with timer(HEAD, "dumping all data to JSON"):
             with open(f"{WORKDIR}/all_repodata.json", "w") as fp:
-                json.dump(all_repodata, fp, indent=2, sort_keys=True)
+                json.dump(
+                    all_repodata, fp, indent=2, sort_keys=True, default=_encode_any,
+                )
             with open(f"{WORKDIR}/all_patched_repodata.json", "w") as fp:
-                json.dump(all_patched_repodata, fp, indent=2, sort_keys=True)
+                json.dump(
+                    all_patched_repodata,
+                    fp,
+                    indent=2,
+                    sort_keys=True,
+                    default=_encode_any,
+                )
             with open(f"{WORKDIR}/all_links.json", "w") as fp:
                 json.dump(all_links, fp, indent=2, sort_keys=True)
             with open(f"{WORKDIR}/all_channeldata.json", "w") as fp:
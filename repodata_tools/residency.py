@@ -0,0 +1,445 @@
+"""Memory-bounded residency of the repodata of each (subdir, label).
+
+The repo worker keeps the raw and patched repodata of every (subdir, label) it
+has touched. With hundreds of labels, that does not fit in a small amount of
+memory. Here the repodata of a subdir is kept in a `LabelStore`, a mapping
+from label to repodata that can spill the repodata of a label to disk as a
+zstd-compressed pickle and reload it when it is used again.
+
+A `LabelResidency` tracks the estimated size of the resident labels of all of
+the stores and evicts the labels that were used the longest time ago when
+they take more than a memory cap. Evictions only happen when `enforce` is
+called so that the repodata of a label is never spilled while the caller
+still holds a reference to it. Callers must call `enforce` at points where
+they do not hold on to any repodata.
+"""
+import os
+import sys
+import pickle
+import random
+import itertools
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import zstandard
+
+from .records import CompactRecord
+
+# the number of records used to estimate the size of the repodata of a label
+N_SIZE_SAMPLES = 32
+
+ZSTD_LEVEL = 1
+
+RESIDENCY = None
+
+_FILE_COUNTER = itertools.count()
+
+
+def _deep_sizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += _deep_sizeof(k) + _deep_sizeof(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            size += _deep_sizeof(v)
+    elif isinstance(obj, CompactRecord):
+        size += _deep_sizeof(obj._values)
+    return size
+
+
+def estimate_repodata_size(repodata):
+    """Estimate the memory used by repodata from a sample of its records."""
+    size = 0
+    for key, value in repodata.items():
+        if isinstance(value, dict) and len(value) > N_SIZE_SAMPLES:
+            keys = random.sample(list(value), N_SIZE_SAMPLES)
+            size += sys.getsizeof(value) + int(
+                len(value)
+                * sum(_deep_sizeof(k) + _deep_sizeof(value[k]) for k in keys)
+                / N_SIZE_SAMPLES
+            )
+        else:
+            size += _deep_sizeof(value)
+    return size
+
+
+def _dumps(repodata):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(
+        pickle.dumps(repodata, protocol=pickle.HIGHEST_PROTOCOL)
+    )
+
+
+def _loads(blob):
+    return pickle.loads(zstandard.ZstdDecompressor().decompress(blob))
+
+
+class LabelStore(MutableMapping):
+    """A mapping from label to the repodata of one subdir that can spill
+    labels to disk.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of repodata in the store (e.g., "raw" or "patched").
+    subdir : str
+        The subdir of the repodata.
+    residency : LabelResidency, optional
+        The residency manager. Defaults to the global one.
+    """
+    def __init__(self, kind, subdir, residency=None):
+        self.kind = kind
+        self.subdir = subdir
+        self._resident = {}
+        # spilled labels map to the path of their file or to the compressed
+        # repodata if it is not on disk
+        self._spilled = {}
+        self._labels = {}
+        self._residency = residency or RESIDENCY
+        if self._residency is not None:
+            self._residency.register(self)
+
+    def __getitem__(self, label):
+        if label in self._resident:
+            value = self._resident[label]
+        elif label in self._spilled:
+            spilled = self._spilled.pop(label)
+            if isinstance(spilled, bytes):
+                value = _loads(spilled)
+            else:
+                with open(spilled, "rb") as fp:
+                    value = _loads(fp.read())
+                self._remove_file(spilled)
+            self._resident[label] = value
+        else:
+            raise KeyError(label)
+        if self._residency is not None:
+            self._residency.touch(self, label)
+        return value
+
+    def __setitem__(self, label, value):
+        spilled = self._spilled.pop(label, None)
+        if isinstance(spilled, str):
+            self._remove_file(spilled)
+        self._resident[label] = value
+        self._labels[label] = None
+        if self._residency is not None:
+            self._residency.touch(self, label)
+
+    def __delitem__(self, label):
+        if label not in self._labels:
+            raise KeyError(label)
+        spilled = self._spilled.pop(label, None)
+        if isinstance(spilled, str):
+            self._remove_file(spilled)
+        self._resident.pop(label, None)
+        del self._labels[label]
+        if self._residency is not None:
+            self._residency.discard(self, label)
+
+    def __contains__(self, label):
+        return label in self._labels
+
+    def __iter__(self):
+        return iter(list(self._labels))
+
+    def __len__(self):
+        return len(self._labels)
+
+    def is_resident(self, label):
+        return label in self._resident
+
+    def close(self):
+        """Stop tracking the store and remove the files this process made for
+        it, e.g., when it is replaced by a store from another process."""
+        if self._residency is not None:
+            self._residency.unregister(self)
+        for pth in self._file_paths():
+            self._remove_file(pth)
+
+    def _remove_file(self, pth):
+        # files made by another process (e.g., our parent before a fork) are
+        # still used there
+        if os.path.basename(pth).startswith(f"{os.getpid()}-"):
+            try:
+                os.remove(pth)
+            except FileNotFoundError:
+                pass
+
+    def _file_paths(self):
+        return {v for v in self._spilled.values() if isinstance(v, str)}
+
+    def spill(self, label, spill_dir=None):
+        """Move the repodata of a label out of memory.
+
+        The repodata is written to a file in `spill_dir` if given and
+        otherwise kept in memory in compressed form.
+        """
+        self._spilled[label] = _dumps(self._resident.pop(label))
+        if spill_dir is not None:
+            self._write_file(label, spill_dir)
+        if self._residency is not None:
+            self._residency.discard(self, label)
+
+    def _write_file(self, label, spill_dir):
+        pth = os.path.join(
+            spill_dir,
+            f"{os.getpid()}-{next(_FILE_COUNTER)}-{self.kind}-{self.subdir}.pkl.zst",
+        )
+        with open(pth, "wb") as fp:
+            fp.write(self._spilled[label])
+        self._spilled[label] = pth
+
+    def flush(self, spill_dir):
+        """Write spilled labels that are only in memory to disk."""
+        for label, spilled in list(self._spilled.items()):
+            if isinstance(spilled, bytes):
+                self._write_file(label, spill_dir)
+
+    def get_labels(self, labels):
+        """Get the repodata of some labels to send to another process.
+
+        Spilled labels are sent in compressed form.
+        """
+        resident = {}
+        spilled = {}
+        for label in labels:
+            if label in self._resident:
+                resident[label] = self._resident[label]
+            elif label in self._spilled:
+                value = self._spilled[label]
+                if isinstance(value, str):
+                    with open(value, "rb") as fp:
+                        value = fp.read()
+                spilled[label] = value
+        return {"resident": resident, "spilled": spilled}
+
+    def update_labels(self, labels):
+        """Set the repodata of labels from `get_labels` of another store."""
+        for label, value in labels["resident"].items():
+            self[label] = value
+        for label, value in labels["spilled"].items():
+            if label in self._labels:
+                del self[label]
+            self._spilled[label] = value
+            self._labels[label] = None
+
+    def __getstate__(self):
+        spilled = {}
+        for label, value in self._spilled.items():
+            if isinstance(value, str):
+                with open(value, "rb") as fp:
+                    value = fp.read()
+            spilled[label] = value
+        return {
+            "kind": self.kind,
+            "subdir": self.subdir,
+            "resident": self._resident,
+            "spilled": spilled,
+            "labels": self._labels,
+        }
+
+    def __setstate__(self, state):
+        self.kind = state["kind"]
+        self.subdir = state["subdir"]
+        self._resident = state["resident"]
+        self._spilled = state["spilled"]
+        self._labels = state["labels"]
+        self._residency = RESIDENCY
+        if self._residency is not None:
+            self._residency.register(self)
+
+
+class LabelResidency:
+    """Keeps the resident repodata of a set of `LabelStore`s under a memory
+    cap by spilling the labels used the longest time ago.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The maximum estimated size of the resident repodata.
+    spill_dir : str
+        The directory to spill labels to.
+    on_evict : callable, optional
+        Called with the kind, subdir and label of each spilled label, e.g.
+        to drop caches that refer to its records.
+
+    Attributes
+    ----------
+    n_evictions : int
+        The number of labels spilled so far.
+    """
+    def __init__(self, max_bytes, spill_dir, on_evict=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.on_evict = on_evict
+        self.n_evictions = 0
+        self._subdir = None
+        self._stores = {}
+        # (id of the store, label) -> estimated size or None if it needs to be
+        # estimated again
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def register(self, store):
+        """Track the labels of a store."""
+        with self._lock:
+            self._stores[id(store)] = store
+            for label in store._resident:
+                self._lru[(id(store), label)] = None
+
+    def unregister(self, store):
+        with self._lock:
+            for key in [k for k in self._lru if k[0] == id(store)]:
+                del self._lru[key]
+            self._stores.pop(id(store), None)
+
+    def touch(self, store, label):
+        with self._lock:
+            key = (id(store), label)
+            self._lru.pop(key, None)
+            self._lru[key] = None
+
+    def discard(self, store, label):
+        with self._lock:
+            self._lru.pop((id(store), label), None)
+
+    def restrict_to(self, subdir, max_bytes):
+        """Only count and evict the labels of one subdir, e.g., in a forked
+        worker for that subdir."""
+        self._subdir = subdir
+        self.max_bytes = max_bytes
+
+    def resident_bytes(self):
+        """Get the estimated size of the resident repodata of each label.
+
+        Returns
+        -------
+        sizes : dict
+            A dictionary mapping (kind, subdir, label) to the estimated size
+            in bytes.
+        """
+        return {
+            (self._stores[store_id].kind, self._stores[store_id].subdir, label): size
+            for (store_id, label), size in self._get_sizes().items()
+        }
+
+    def _get_sizes(self):
+        with self._lock:
+            for (store_id, label), size in self._lru.items():
+                if size is None:
+                    self._lru[(store_id, label)] = estimate_repodata_size(
+                        self._stores[store_id]._resident[label]
+                    )
+            return {
+                key: size
+                for key, size in self._lru.items()
+                if self._subdir is None
+                or self._stores[key[0]].subdir == self._subdir
+            }
+
+    def enforce(self):
+        """Spill labels until the resident repodata fits in the memory cap.
+
+        Returns
+        -------
+        evicted : list of tuple
+            The (kind, subdir, label) of each spilled label.
+        """
+        sizes = self._get_sizes()
+        total = sum(sizes.values())
+        evicted = []
+        for store_id, label in list(sizes):
+            # always keep the label used last
+            if total <= self.max_bytes or len(sizes) - len(evicted) <= 1:
+                break
+            store = self._stores[store_id]
+            store.spill(label, spill_dir=self.spill_dir)
+            total -= sizes[(store_id, label)]
+            evicted.append((store.kind, store.subdir, label))
+            if self.on_evict is not None:
+                self.on_evict(store.kind, store.subdir, label)
+        self.n_evictions += len(evicted)
+        return evicted
+
+    def flush(self):
+        """Write spilled labels that are only in memory to disk."""
+        for store in list(self._stores.values()):
+            store.flush(self.spill_dir)
+
+    def report(self):
+        sizes = self.resident_bytes()
+        n_spilled = sum(
+            len(store._spilled)
+            for store in self._stores.values()
+            if self._subdir is None or store.subdir == self._subdir
+        )
+        top = sorted(sizes.items(), key=lambda x: -x[1])[:5]
+        return (
+            "resident labels: %d (%0.1f MB of %0.1f MB) - spilled labels: %d - "
+            "evictions: %d - largest: %s" % (
+                len(sizes),
+                sum(sizes.values()) / 1000**2,
+                self.max_bytes / 1000**2,
+                n_spilled,
+                self.n_evictions,
+                ", ".join(
+                    "%s %s/%s %0.1f MB" % (kind, subdir, label, size / 1000**2)
+                    for (kind, subdir, label), size in top
+                ),
+            )
+        )
+
+
+def init_label_residency(max_bytes, spill_dir, on_evict=None):
+    """Start keeping the repodata of new `LabelStore`s under a memory cap."""
+    global RESIDENCY
+    RESIDENCY = LabelResidency(max_bytes, spill_dir, on_evict=on_evict)
+    return RESIDENCY
+
+
+def get_label_residency():
+    return RESIDENCY
+
+
+def enforce_label_residency():
+    """Spill labels to fit in the memory cap if label residency is enabled.
+
+    Only call this where no repodata of a label is held on to.
+    """
+    if RESIDENCY is not None:
+        RESIDENCY.enforce()
+
+
+def _reset_residency_lock_in_child():
+    if RESIDENCY is not None:
+        RESIDENCY._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_residency_lock_in_child)
+
+
+def make_label_store(kind, subdir):
+    """Make an empty mapping from label to repodata for a subdir.
+
+    This is a `LabelStore` if label residency is enabled and a plain
+    dictionary otherwise.
+    """
+    if RESIDENCY is None:
+        return {}
+    return LabelStore(kind, subdir)
+
+
+def adopt_label_stores(all_repodata, kind):
+    """Move plain dictionaries of repodata by label into `LabelStore`s if
+    label residency is enabled."""
+    if RESIDENCY is None:
+        return
+    for subdir, labels in list(all_repodata.items()):
+        if not isinstance(labels, LabelStore):
+            store = LabelStore(kind, subdir)
+            for label, repodata in labels.items():
+                store[label] = repodata
+            all_repodata[subdir] = store
@@ -0,0 +1,230 @@
+"""Incremental JSON serialization of repodata products.
+
+Most of the time only a few records of a repodata file change between two
+builds. Here we cache the encoded bytes of every record of a file and only
+encode the records that changed, splicing the cached fragments together into
+output that is byte-for-byte the same as
+
+    json.dumps(data, indent=2, sort_keys=True)
+
+with rapidjson. Cached fragments are keyed by the key of the record and
+validated by the identity of the record object, so records must not be
+modified in place after they have been serialized. The repo worker always
+replaces a record that changes, and the current repodata sets
+`legacy_bz2_md5` on copies of the records of the repodata it is made from
+(see `index.build_current_repodata`).
+"""
+import os
+import zlib
+import threading
+from collections import OrderedDict
+
+import rapidjson as json
+
+from .records import encode_record
+
+# the maximum size of the cached fragments over all files
+MAX_CACHE_BYTES = 2 * 1000**3
+
+# the keys holding the records for each kind of file
+REPODATA_RECORD_KEYS = ("packages", "packages.conda")
+LINKS_RECORD_KEYS = ("packages", "serverdata-hashes", "shard-indexes")
+
+# on average, a segment of the output ends every this many records
+SEGMENT_RECORDS = 4096
+
+_NOT_CACHED = (object(), None, False)
+
+
+def _indent(encoded, n_spaces):
+    # newlines only appear between tokens in the output since rapidjson
+    # escapes them in strings
+    return encoded.replace("\n", "\n" + " " * n_spaces)
+
+
+def _dumps_value(value, n_spaces):
+    return _indent(
+        json.dumps(value, indent=2, sort_keys=True, default=encode_record),
+        n_spaces,
+    ).encode("utf-8")
+
+
+def _dumps_key(key):
+    return json.dumps(key).encode("utf-8")
+
+
+def _is_segment_boundary(key):
+    # this only depends on the key so that the segments of a file stay the
+    # same when records are added or removed elsewhere
+    return zlib.crc32(key.encode("utf-8")) % SEGMENT_RECORDS == 0
+
+
+class JSONFragmentCache:
+    """An LRU cache of the encoded records of a set of JSON files.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        The maximum size of the cached fragments over all files. Files that
+        have not been serialized for the longest time are dropped first.
+
+    Attributes
+    ----------
+    hits : int
+        The number of records whose encoding was reused.
+    misses : int
+        The number of records that had to be encoded.
+    """
+    def __init__(self, max_bytes=MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_file(self, name):
+        with self._lock:
+            entry = self._files.pop(name, None)
+        return entry[0] if entry is not None else {}
+
+    def _put_file(self, name, fragments, size):
+        with self._lock:
+            self._files[name] = (fragments, size)
+            total = sum(size for _, size in self._files.values())
+            while total > self.max_bytes and len(self._files) > 1:
+                _, (_, _size) = self._files.popitem(last=False)
+                total -= _size
+
+    def get_files(self, names):
+        """Get the cached fragments for a set of files so that they can be
+        sent to another process along with the records they refer to."""
+        with self._lock:
+            return {
+                name: self._files[name]
+                for name in names
+                if name in self._files
+            }
+
+    def update_files(self, files):
+        """Add the output of `get_files` from another process."""
+        for name, (fragments, size) in files.items():
+            self._put_file(name, fragments, size)
+
+    def drop_files(self, names):
+        """Drop the cached fragments for a set of files."""
+        with self._lock:
+            for name in names:
+                self._files.pop(name, None)
+
+    def _dumps_records(self, records, fragments, n_spaces, pieces, boundaries):
+        if not records:
+            pieces.append(b"{}")
+            return {}
+
+        # the cached fragments are updated in place
+        changed = [
+            key
+            for key, record in records.items()
+            if fragments.get(key, _NOT_CACHED)[0] is not record
+        ]
+        for key in changed:
+            record = records[key]
+            fragments[key] = (
+                record,
+                b" " * (n_spaces + 2)
+                + _dumps_key(key)
+                + b": "
+                + _dumps_value(record, n_spaces + 2),
+                _is_segment_boundary(key),
+            )
+        if len(fragments) != len(records):
+            for key in fragments.keys() - records.keys():
+                del fragments[key]
+
+        self.hits += len(records) - len(changed)
+        self.misses += len(changed)
+
+        pieces.append(b"{\n")
+        for key in sorted(records):
+            _, fragment, is_boundary = fragments[key]
+            pieces.append(fragment)
+            pieces.append(b",\n")
+            if is_boundary:
+                boundaries.append(len(pieces))
+        pieces[-1] = b"\n" + b" " * n_spaces + b"}"
+        return fragments
+
+    def dumps_segments(self, name, data, record_keys=REPODATA_RECORD_KEYS):
+        """Serialize a JSON file, reusing the encoded records from the last
+        time a file with the same name was serialized.
+
+        Parameters
+        ----------
+        name : str
+            The name of the file, used to find the cached fragments.
+        data : dict
+            The data to serialize.
+        record_keys : tuple of str, optional
+            The top-level keys of `data` that map names to records. The
+            encoded records under these keys are cached.
+
+        Returns
+        -------
+        segments : list of bytes
+            The encoded file split into segments that end after records whose
+            keys were chosen by a hash of the key. Joined together, they are
+            the same as `json.dumps(data, indent=2, sort_keys=True)` encoded to
+            UTF-8.
+        """
+        if not data:
+            return [b"{}"]
+
+        old_fragments = self._get_file(name)
+        fragments = {}
+        size = 0
+        pieces = [b"{\n"]
+        boundaries = []
+        for key in sorted(data):
+            value = data[key]
+            pieces.append(b"  " + _dumps_key(key) + b": ")
+            if key in record_keys and isinstance(value, dict):
+                start = len(pieces)
+                fragments[key] = self._dumps_records(
+                    value, old_fragments.get(key, {}), 2, pieces, boundaries,
+                )
+                size += sum(len(piece) for piece in pieces[start:])
+            else:
+                pieces.append(_dumps_value(value, 2))
+            pieces.append(b",\n")
+        pieces[-1] = b"\n}"
+
+        self._put_file(name, fragments, size)
+
+        # we join each segment once since copying the big strings around
+        # costs as much as encoding them
+        segments = []
+        start = 0
+        for end in boundaries + [len(pieces)]:
+            if end > start:
+                segments.append(b"".join(pieces[start:end]))
+            start = end
+        return segments
+
+    def dumps(self, name, data, record_keys=REPODATA_RECORD_KEYS):
+        """Serialize a JSON file like `dumps_segments`, returning the whole
+        file as bytes."""
+        return b"".join(self.dumps_segments(name, data, record_keys=record_keys))
+
+
+JSON_CACHE = JSONFragmentCache()
+
+
+def _reset_json_cache_lock_in_child():
+    JSON_CACHE._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_json_cache_lock_in_child)
+
+
+def get_json_cache():
+    return JSON_CACHE
@@ -0,0 +1,349 @@
+"""Packed, append-only storage for repodata shards.
+
+Reading every shard from the `shards/<subdir>/<h>/<h>/<h>/<pkg>.json` tree takes
+hundreds of thousands of small file reads. A shard pack stores all of the
+shards of a subdir in one file, one record per line,
+
+    <subdir>/<pkg>\\t<shard json>\\n
+
+with an offset index stored next to it. New or changed shards are appended to
+the end of the pack and removed shards are recorded with a `null` shard. The
+index always points at the latest record for each shard. Packs are kept in
+the `.git` directory of the shards repo so that they are never committed.
+"""
+import os
+import mmap
+import subprocess
+from collections.abc import Mapping
+
+import click
+import rapidjson as json
+
+from .metadata import CONDA_FORGE_SUBIDRS
+from .utils import chunk_iterable
+from .git_objects import (
+    get_repo_sha,
+    list_tree_paths,
+    diff_tree_paths,
+    read_json_blobs,
+)
+
+PACK_VERSION = 1
+
+# compact the pack when more than this fraction of it is stale records
+MAX_DEAD_FRACTION = 0.5
+
+# the number of shards to read from git at once
+READ_CHUNK_SIZE = 4096
+
+
+def get_shard_pack_paths(shards_repo, subdir):
+    pack_dir = os.path.join(shards_repo, ".git", "shard-packs")
+    return (
+        os.path.join(pack_dir, f"{subdir}.pack"),
+        os.path.join(pack_dir, f"{subdir}.idx.json"),
+    )
+
+
+def _shard_path_to_key(shard_pth):
+    # shards/<subdir>/<h>/<h>/<h>/<pkg>.json
+    parts = shard_pth.split("/")
+    return parts[1] + "/" + parts[-1][:-len(".json")]
+
+
+def _is_shard_path(pth, n_dirs=3):
+    return pth.endswith(".json") and len(pth.split("/")) == n_dirs + 3
+
+
+def _read_shards_at(shards_repo, sha, shard_pths):
+    shards = {}
+    for pth_chunk in chunk_iterable(shard_pths, READ_CHUNK_SIZE):
+        for shard in read_json_blobs(shards_repo, sha, pth_chunk):
+            shards[os.path.join(shard["subdir"], shard["package"])] = shard
+    return shards
+
+
+class ShardPack(Mapping):
+    """A read/append view of the shard pack for one subdir.
+
+    Shards are decoded lazily when they are accessed. The pack is read
+    through mmap.
+
+    Parameters
+    ----------
+    shards_repo : str
+        The path to the shards repo.
+    subdir : str
+        The subdir of the pack.
+
+    Attributes
+    ----------
+    sha : str or None
+        The commit of the shards repo the pack is in sync with.
+    """
+    def __init__(self, shards_repo, subdir):
+        self.shards_repo = shards_repo
+        self.subdir = subdir
+        self.pack_pth, self.idx_pth = get_shard_pack_paths(shards_repo, subdir)
+        self._mm = None
+        self._load_index()
+
+    def _load_index(self):
+        idx = None
+        if os.path.exists(self.idx_pth):
+            with open(self.idx_pth, "r") as fp:
+                idx = json.load(fp)
+
+        if (
+            idx is not None
+            and idx["version"] == PACK_VERSION
+            and os.path.exists(self.pack_pth)
+            and os.path.getsize(self.pack_pth) == idx["size"]
+        ):
+            self.sha = idx["sha"]
+            self._size = idx["size"]
+            self._dead_bytes = idx["dead_bytes"]
+            self._records = idx["records"]
+        else:
+            # the pack and index are out of sync (e.g., we crashed before
+            # writing the index) so we do not trust the pack anymore
+            self.sha = None
+            self._size = 0
+            self._dead_bytes = 0
+            self._records = {}
+            if os.path.exists(self.pack_pth):
+                os.remove(self.pack_pth)
+
+    def _write_index(self):
+        tmp_pth = self.idx_pth + ".tmp"
+        with open(tmp_pth, "w") as fp:
+            json.dump(
+                {
+                    "version": PACK_VERSION,
+                    "sha": self.sha,
+                    "size": self._size,
+                    "dead_bytes": self._dead_bytes,
+                    "records": self._records,
+                },
+                fp,
+            )
+        os.replace(tmp_pth, self.idx_pth)
+
+    def _get_mmap(self):
+        if self._mm is None and self._size > 0:
+            with open(self.pack_pth, "rb") as fp:
+                self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mm
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, subdir_pkg):
+        offset, length = self._records[subdir_pkg]
+        return json.loads(self._get_mmap()[offset:offset + length])
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, subdir_pkg):
+        return subdir_pkg in self._records
+
+    def load_all(self, all_shards):
+        """Decode all of the shards into `all_shards`, reading the pack
+        sequentially."""
+        mm = self._get_mmap()
+        for subdir_pkg, (offset, length) in sorted(
+            self._records.items(), key=lambda x: x[1][0]
+        ):
+            all_shards[subdir_pkg] = json.loads(mm[offset:offset + length])
+
+    def update(self, shards, sha):
+        """Append new, changed or removed shards to the pack.
+
+        Parameters
+        ----------
+        shards : dict
+            A dictionary mapping "<subdir>/<pkg>" to the shard or to None if
+            the shard was removed.
+        sha : str
+            The commit of the shards repo the pack is now in sync with.
+        """
+        self.close()
+        os.makedirs(os.path.dirname(self.pack_pth), exist_ok=True)
+
+        with open(self.pack_pth, "ab") as fp:
+            for subdir_pkg, shard in shards.items():
+                key = subdir_pkg.encode("utf-8") + b"\t"
+                value = json.dumps(shard, sort_keys=True).encode("utf-8")
+                fp.write(key + value + b"\n")
+
+                if subdir_pkg in self._records:
+                    self._dead_bytes += len(key) + self._records[subdir_pkg][1] + 1
+                if shard is None:
+                    self._records.pop(subdir_pkg, None)
+                    self._dead_bytes += len(key) + len(value) + 1
+                else:
+                    self._records[subdir_pkg] = [self._size + len(key), len(value)]
+                self._size += len(key) + len(value) + 1
+
+        self.sha = sha
+        self._write_index()
+
+        if self._size > 0 and self._dead_bytes / self._size > MAX_DEAD_FRACTION:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the pack with only the latest record of each shard."""
+        tmp_pth = self.pack_pth + ".tmp"
+        records = {}
+        size = 0
+        mm = self._get_mmap()
+        with open(tmp_pth, "wb") as fp:
+            for subdir_pkg, (offset, length) in sorted(
+                self._records.items(), key=lambda x: x[1][0]
+            ):
+                key = subdir_pkg.encode("utf-8") + b"\t"
+                fp.write(key + mm[offset:offset + length] + b"\n")
+                records[subdir_pkg] = [size + len(key), length]
+                size += len(key) + length + 1
+
+        self.close()
+        os.replace(tmp_pth, self.pack_pth)
+        self._records = records
+        self._size = size
+        self._dead_bytes = 0
+        self._write_index()
+
+
+def build_shard_pack(shards_repo, subdir, sha=None):
+    """Build the shard pack for a subdir from the shards at a commit.
+
+    Parameters
+    ----------
+    shards_repo : str
+        The path to the shards repo.
+    subdir : str
+        The subdir of the pack.
+    sha : str, optional
+        The commit to build the pack from. Defaults to HEAD.
+
+    Returns
+    -------
+    pack : ShardPack
+        The shard pack.
+    """
+    pack_pth, idx_pth = get_shard_pack_paths(shards_repo, subdir)
+    for pth in [pack_pth, idx_pth]:
+        if os.path.exists(pth):
+            os.remove(pth)
+
+    sha = sha or get_repo_sha(shards_repo)
+    shard_pths = [
+        pth
+        for pth in list_tree_paths(shards_repo, sha, f"shards/{subdir}/")
+        if _is_shard_path(pth)
+    ]
+
+    pack = ShardPack(shards_repo, subdir)
+    pack.update(_read_shards_at(shards_repo, sha, shard_pths), sha)
+    return pack
+
+
+def sync_shard_pack(shards_repo, subdir, sha=None):
+    """Bring the shard pack for a subdir in sync with a commit of the shards
+    repo.
+
+    If the pack does not exist, it is built from scratch. Otherwise only the
+    shards in the git diff between the commit the pack was synced to and the
+    new commit are read and appended. Shards are read from the git objects, so
+    the commit does not need to be checked out.
+
+    Parameters
+    ----------
+    shards_repo : str
+        The path to the shards repo.
+    subdir : str
+        The subdir of the pack.
+    sha : str, optional
+        The commit to sync the pack to. Defaults to HEAD.
+
+    Returns
+    -------
+    pack : ShardPack
+        The shard pack.
+    """
+    sha = sha or get_repo_sha(shards_repo)
+    pack = ShardPack(shards_repo, subdir)
+    if pack.sha is None:
+        pack.close()
+        return build_shard_pack(shards_repo, subdir, sha=sha)
+
+    if sha == pack.sha:
+        return pack
+
+    try:
+        new_or_modified, removed = diff_tree_paths(
+            shards_repo, pack.sha, sha, f"shards/{subdir}/"
+        )
+    except subprocess.CalledProcessError:
+        # the old commit is gone (e.g., the repo history was squashed)
+        pack.close()
+        return build_shard_pack(shards_repo, subdir, sha=sha)
+
+    shards = {
+        _shard_path_to_key(pth): None
+        for pth in removed
+        if _is_shard_path(pth)
+    }
+    shards.update(_read_shards_at(
+        shards_repo, sha, [pth for pth in new_or_modified if _is_shard_path(pth)]
+    ))
+
+    pack.update(shards, sha)
+    return pack
+
+
+@click.command()
+@click.option(
+    "--shards-repo",
+    default=".",
+    type=str,
+    help="The path to the repodata shards repo.",
+)
+@click.option(
+    "--sha",
+    default=None,
+    type=str,
+    help="The commit to sync the packs to. Defaults to HEAD.",
+)
+@click.option(
+    "--rebuild",
+    is_flag=True,
+    help="Rebuild the packs from scratch instead of syncing them.",
+)
+def main(shards_repo, sha, rebuild):
+    """Build or sync the packed shard stores of a repodata shards repo.
+    """
+    for subdir in CONDA_FORGE_SUBIDRS:
+        if rebuild:
+            pack = build_shard_pack(shards_repo, subdir, sha=sha)
+        else:
+            pack = sync_shard_pack(shards_repo, subdir, sha=sha)
+        with pack:
+            print(
+                "synced %d shards for subdir %s to %s" % (
+                    len(pack), subdir, pack.sha
+                ),
+                flush=True,
+            )
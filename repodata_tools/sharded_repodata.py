@@ -0,0 +1,240 @@
+"""Sharded repodata in the style of CEP-16.
+
+Next to the monolithic repodata.json, the records of each (subdir, label) are
+published as one shard per package name plus a small index mapping each name
+to the hash of its shard,
+
+    repodata_shards.msgpack.zst
+        {
+            "version": 1,
+            "info": {"base_url": ..., "shards_base_url": ..., "subdir": ...},
+            "shards": {<name>: <sha256 of the shard as bytes>, ...},
+        }
+
+    shards/<sha256 of the shard as hex>.msgpack.zst
+        {"packages": {<fn>: <record>, ...}, "packages.conda": {...}}
+
+Both are msgpack documents compressed with zstd. In the shards, the `sha256`
+and `md5` fields of the records are stored as bytes. Since shards are named by
+the hash of their contents, a shard that did not change does not need to be
+uploaded again.
+
+The URLs of the shards and packages in the index are relative to the URL of
+the index. The app serves the index itself instead of redirecting to the
+release asset so that they resolve to its routes.
+
+A shard is encoded again only if the records of its package name changed.
+Compact records are compared by identity and records that are dictionaries
+are compared to a shallow copy made when the shard was encoded.
+"""
+import os
+import re
+import hashlib
+import threading
+from collections.abc import Mapping
+
+import msgpack
+import zstandard
+
+from .compress import ZSTD_LEVEL
+from .records import CompactRecord
+
+SHARDS_VERSION = 1
+
+RECORD_KEYS = ("packages", "packages.conda")
+
+# the record fields holding hex digests that are stored as bytes
+BINARY_FIELDS = ("sha256", "md5")
+
+
+def get_shard_index_fn(subdir, label):
+    return f"repodata_shards_{subdir}_{label}.msgpack.zst"
+
+
+def get_shard_fn(digest):
+    return f"{digest.hex()}.msgpack.zst"
+
+
+def is_shard_fn(fn):
+    return re.fullmatch(r"[0-9a-f]{64}\.msgpack\.zst", fn) is not None
+
+
+def _sorted(value):
+    # the encoding has to be the same from one build to the next for the
+    # shards to keep their names
+    if isinstance(value, Mapping):
+        return {k: _sorted(value[k]) for k in sorted(value)}
+    elif isinstance(value, list):
+        return [_sorted(v) for v in value]
+    else:
+        return value
+
+
+def _pack_record(record):
+    record = _sorted(record)
+    for field in BINARY_FIELDS:
+        if isinstance(record.get(field), str):
+            try:
+                record[field] = bytes.fromhex(record[field])
+            except ValueError:
+                pass
+    return record
+
+
+def _pack_shard(records):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(
+        msgpack.packb(
+            {
+                key: {fn: _pack_record(records[key][fn]) for fn in sorted(records[key])}
+                for key in RECORD_KEYS
+            },
+            use_bin_type=True,
+        )
+    )
+
+
+def _snapshot_records(records):
+    # compact records cannot be changed, so only dictionaries are copied
+    return {
+        key: {
+            fn: record if isinstance(record, CompactRecord) else dict(record)
+            for fn, record in records[key].items()
+        }
+        for key in RECORD_KEYS
+    }
+
+
+def _same_records(old_records, records):
+    for key in RECORD_KEYS:
+        old = old_records[key]
+        new = records[key]
+        if len(old) != len(new):
+            return False
+        for fn, record in new.items():
+            old_record = old.get(fn)
+            if old_record is not record and old_record != record:
+                return False
+    return True
+
+
+class ShardedRepodataStore:
+    """The encoded shards of a set of sharded repodata indexes.
+
+    Parameters
+    ----------
+    base_url : str, optional
+        The URL of the packages, relative to the URL of the index.
+    shards_base_url : str, optional
+        The URL of the shards, relative to the URL of the index.
+
+    Attributes
+    ----------
+    hits : int
+        The number of shards that were reused.
+    misses : int
+        The number of shards that had to be encoded.
+    """
+    def __init__(self, base_url="./", shards_base_url="./shards/"):
+        self.base_url = base_url
+        self.shards_base_url = shards_base_url
+        self.hits = 0
+        self.misses = 0
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def update(self, index_fn, repodata):
+        """Shard repodata, reusing the shards of package names whose records
+        are the same as the last time an index with the same name was made.
+
+        Parameters
+        ----------
+        index_fn : str
+            The name of the index.
+        repodata : dict
+            The repodata to shard.
+
+        Returns
+        -------
+        index : bytes
+            The compressed index.
+        shards : dict
+            A dictionary mapping the file name of every shard in the index to
+            the compressed shard.
+        """
+        with self._lock:
+            old_shards = self._files.get(index_fn, {})
+
+        records_by_name = {}
+        for key in RECORD_KEYS:
+            for fn, record in repodata.get(key, {}).items():
+                if record["name"] not in records_by_name:
+                    records_by_name[record["name"]] = {k: {} for k in RECORD_KEYS}
+                records_by_name[record["name"]][key][fn] = record
+
+        shards = {}
+        for name, records in records_by_name.items():
+            if name in old_shards and _same_records(old_shards[name][0], records):
+                shards[name] = old_shards[name]
+                self.hits += 1
+            else:
+                data = _pack_shard(records)
+                shards[name] = (
+                    _snapshot_records(records), hashlib.sha256(data).digest(), data,
+                )
+                self.misses += 1
+
+        with self._lock:
+            self._files[index_fn] = shards
+
+        index = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(
+            msgpack.packb(
+                {
+                    "version": SHARDS_VERSION,
+                    "info": {
+                        "base_url": self.base_url,
+                        "shards_base_url": self.shards_base_url,
+                        "subdir": repodata["info"]["subdir"],
+                    },
+                    "shards": {name: shards[name][1] for name in sorted(shards)},
+                },
+                use_bin_type=True,
+            )
+        )
+        return index, {
+            get_shard_fn(digest): data for _, digest, data in shards.values()
+        }
+
+    def get_files(self, names):
+        """Get the shards for a set of indexes so that they can be sent to
+        another process along with the records they refer to."""
+        with self._lock:
+            return {
+                name: self._files[name]
+                for name in names
+                if name in self._files
+            }
+
+    def update_files(self, files):
+        """Add the output of `get_files` from another process."""
+        with self._lock:
+            self._files.update(files)
+
+    def drop_files(self, names):
+        """Drop the shards for a set of indexes."""
+        with self._lock:
+            for name in names:
+                self._files.pop(name, None)
+
+
+SHARDED_REPODATA_STORE = ShardedRepodataStore()
+
+
+def _reset_store_lock_in_child():
+    SHARDED_REPODATA_STORE._lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_store_lock_in_child)
+
+
+def get_sharded_repodata_store():
+    return SHARDED_REPODATA_STORE
@@ -11,8 +11,17 @@ import joblib
 import tenacity
 import requests
 
-from .utils import chunk_iterable, compute_md5, split_pkg
+from .utils import chunk_iterable
 from .metadata import UNINDEXABLE
+from .package_index import (
+    index_package,
+    index_remote_conda_package,
+    REPODATA_VERSION,
+    CHANNELDATA_VERSION,
+)
+from .fetch import download_package, get_package_urls
+from .shard_pack import sync_shard_pack
+from .git_objects import list_tree_paths, read_json_blobs
 
 
 def get_old_shard_path(subdir, pkg, n_dirs=12):
@@ -60,7 +69,52 @@ def _read_shard_chunk(shard_pths):
     return shards
 
 
-def read_subdir_shards(shards_repo, subdir, all_shards, shard_paths=None):
+def read_subdir_shards(
+    shards_repo, subdir, all_shards, shard_paths=None, use_pack=False, sha=None,
+):
+    """Read the shards of a subdir into `all_shards`.
+
+    Parameters
+    ----------
+    shards_repo : str
+        The path to the shards repo.
+    subdir : str
+        The subdir to read.
+    all_shards : dict
+        The shards are put in this dict, keyed by "<subdir>/<pkg>".
+    shard_paths : list of str, optional
+        If given, only these paths (prefixed by `shards_repo`) are read.
+        Otherwise all of the shards of the subdir are read.
+    use_pack : bool, optional
+        If True, full reads go through the packed shard store.
+    sha : str, optional
+        If given, the shards are read from the git objects of this commit
+        instead of the working tree.
+    """
+    if shard_paths is None and use_pack:
+        # a full read is much faster from the packed shards
+        with sync_shard_pack(shards_repo, subdir, sha=sha) as pack:
+            pack.load_all(all_shards)
+        return
+
+    if sha is not None:
+        if shard_paths is None:
+            # only shards/<subdir>/<h>/<h>/<h>/<pkg>.json like glob_shards
+            _shard_paths = [
+                pth
+                for pth in list_tree_paths(shards_repo, sha, f"shards/{subdir}/")
+                if pth.endswith(".json") and pth.count("/") == 5
+            ]
+        else:
+            _shard_paths = [
+                os.path.relpath(s, shards_repo) for s in shard_paths
+                if s.startswith(f"{shards_repo}/shards/{subdir}/")
+            ]
+        for shard in read_json_blobs(shards_repo, sha, _shard_paths):
+            subdir_pkg = os.path.join(shard["subdir"], shard["package"])
+            all_shards[subdir_pkg] = shard
+        return
+
     if shard_paths is None:
         _shard_paths = glob_shards(shards_repo, subdir)
     else:
@@ -85,34 +139,7 @@ def read_subdir_shards(shards_repo, subdir, all_shards, shard_paths=None):
             all_shards[subdir_pkg] = shard
 
 
-def make_repodata_shard_noretry(
-    subdir, pkg, label, feedstock, url, tmpdir, md5_checksum=None
-):
-    os.makedirs(f"{tmpdir}/noarch", exist_ok=True)
-    os.makedirs(f"{tmpdir}/{subdir}", exist_ok=True)
-
-    # sometimes the urls fail, so we try the one you get out of the web UI
-    r = requests.head(url)
-    if r.status_code != 200:
-        _, name, ver, _ = split_pkg(os.path.join(subdir, pkg))
-        url = f"https://anaconda.org/conda-forge/{name}/{ver}/download/{subdir}/{pkg}"
-
-    subprocess.run(
-        f"curl  --no-progress-meter -L {url} > {tmpdir}/{subdir}/{pkg}",
-        shell=True,
-        check=True,
-    )
-
-    if md5_checksum is not None:
-        local_md5 = compute_md5(f"{tmpdir}/{subdir}/{pkg}")
-        if not hmac.compare_digest(local_md5, md5_checksum):
-            raise RuntimeError(
-                "md5 chechsum is incorrect: "
-                "download=%s sent=%s exiting!" % (
-                    local_md5, md5_checksum
-                )
-            )
-
+def _conda_index_package(subdir, pkg, tmpdir):
     try:
         subprocess.run(
             f"conda index --no-progress {tmpdir}",
@@ -121,16 +148,142 @@ def make_repodata_shard_noretry(
         )
     except subprocess.CalledProcessError as e:
         if os.path.join(subdir, pkg) in UNINDEXABLE:
-            cd = None
-            rd = None
+            return None, None
         else:
             raise e
+
+    with open(f"{tmpdir}/channeldata.json", "r") as fp:
+        cd = json.load(fp)
+
+    with open(f"{tmpdir}/{subdir}/repodata.json", "r") as fp:
+        rd = json.load(fp)
+
+    rd_pkg = copy.deepcopy(rd["packages"][pkg])
+    return rd_pkg, copy.deepcopy(cd["packages"][rd_pkg["name"]])
+
+
+def _download_and_index_package(subdir, pkg, url, tmpdir, md5_checksum):
+    os.makedirs(f"{tmpdir}/noarch", exist_ok=True)
+    os.makedirs(f"{tmpdir}/{subdir}", exist_ok=True)
+
+    info = download_package(
+        url, f"{tmpdir}/{subdir}/{pkg}", subdir, pkg, md5_checksum=md5_checksum,
+    )
+
+    subdir_pkg = os.path.join(subdir, pkg)
+    if subdir_pkg in UNINDEXABLE:
+        rd, cd = _conda_index_package(subdir, pkg, tmpdir)
     else:
-        with open(f"{tmpdir}/channeldata.json", "r") as fp:
-            cd = json.load(fp)
+        try:
+            rd, cd = index_package(
+                f"{tmpdir}/{subdir}/{pkg}",
+                subdir,
+                info["size"],
+                info["md5"],
+                info["sha256"],
+            )
+        except Exception as e:
+            print(
+                "native indexing of %s failed - falling back to conda index: %s" % (
+                    subdir_pkg, repr(e)
+                ),
+                flush=True,
+            )
+            rd, cd = _conda_index_package(subdir, pkg, tmpdir)
+
+    return rd, cd, info["url"]
+
+
+def can_index_remote_package(subdir, pkg, upstream_record, md5_checksum):
+    return (
+        pkg.endswith(".conda")
+        and os.path.join(subdir, pkg) not in UNINDEXABLE
+        and upstream_record is not None
+        and all(upstream_record.get(k) for k in ["size", "md5", "sha256"])
+        and (
+            md5_checksum is None
+            or hmac.compare_digest(upstream_record["md5"], md5_checksum)
+        )
+    )
+
+
+def _index_remote_package(subdir, pkg, url, upstream_record):
+    urls = get_package_urls(url, subdir, pkg)
+    for i, _url in enumerate(urls):
+        try:
+            rd, cd = index_remote_conda_package(
+                _url,
+                subdir,
+                upstream_record["size"],
+                upstream_record["md5"],
+                upstream_record["sha256"],
+            )
+        except requests.exceptions.HTTPError as e:
+            if i == len(urls) - 1:
+                raise e
+        else:
+            return rd, cd, _url
 
-        with open(f"{tmpdir}/{subdir}/repodata.json", "r") as fp:
-            rd = json.load(fp)
+
+def make_repodata_shard_noretry(
+    subdir, pkg, label, feedstock, url, tmpdir, md5_checksum=None,
+    upstream_record=None, metadata_only=False,
+):
+    """Make a repodata shard for a package.
+
+    Parameters
+    ----------
+    subdir : str
+        The subdir of the package.
+    pkg : str
+        The package filename.
+    label : str
+        The label of the package.
+    feedstock : str
+        The feedstock that built the package.
+    url : str
+        The URL of the package.
+    tmpdir : str
+        A directory to download the package to.
+    md5_checksum : str, optional
+        If given, the md5 checksum the package must have.
+    upstream_record : dict, optional
+        The repodata record for the package from anaconda.org or the event
+        payload. Only the "size", "md5" and "sha256" keys are used.
+    metadata_only : bool, optional
+        If True and the package is a .conda artifact with a complete
+        `upstream_record`, only the info member of the package is downloaded
+        using HTTP Range requests. The size and checksums in the shard are
+        then taken from `upstream_record`. Any failure falls back to
+        downloading the full package.
+
+    Returns
+    -------
+    shard : dict
+        The repodata shard.
+    """
+    rd = None
+    cd = None
+    indexed = False
+    if metadata_only and can_index_remote_package(
+        subdir, pkg, upstream_record, md5_checksum
+    ):
+        try:
+            rd, cd, url = _index_remote_package(subdir, pkg, url, upstream_record)
+            indexed = True
+        except Exception as e:
+            print(
+                "metadata only indexing of %s failed - "
+                "downloading the full package: %s" % (
+                    os.path.join(subdir, pkg), repr(e)
+                ),
+                flush=True,
+            )
+
+    if not indexed:
+        rd, cd, url = _download_and_index_package(
+            subdir, pkg, url, tmpdir, md5_checksum
+        )
 
     shard = {}
     shard["labels"] = [label]
@@ -140,17 +293,15 @@ def make_repodata_shard_noretry(
     shard["feedstock"] = feedstock
 
     if rd is not None:
-        shard["repodata_version"] = rd["repodata_version"]
-        shard["repodata"] = copy.deepcopy(rd["packages"][pkg])
+        shard["repodata_version"] = REPODATA_VERSION
+        shard["repodata"] = rd
     else:
         shard["repodata_version"] = None
         shard["repodata"] = None
 
     if cd is not None:
-        shard["channeldata_version"] = cd["channeldata_version"]
-        shard["channeldata"] = copy.deepcopy(
-            cd["packages"][rd["packages"][pkg]["name"]]
-        )
+        shard["channeldata_version"] = CHANNELDATA_VERSION
+        shard["channeldata"] = cd
     else:
         shard["channeldata_version"] = None
         shard["channeldata"] = None
@@ -163,9 +314,13 @@ def make_repodata_shard_noretry(
     stop=tenacity.stop_after_attempt(5),
     reraise=True,
 )
-def make_repodata_shard(subdir, pkg, label, feedstock, url, tmpdir, md5_checksum=None):
+def make_repodata_shard(
+    subdir, pkg, label, feedstock, url, tmpdir, md5_checksum=None,
+    upstream_record=None, metadata_only=False,
+):
     return make_repodata_shard_noretry(
-        subdir, pkg, label, feedstock, url, tmpdir, md5_checksum=md5_checksum)
+        subdir, pkg, label, feedstock, url, tmpdir, md5_checksum=md5_checksum,
+        upstream_record=upstream_record, metadata_only=metadata_only)
 
 
 @tenacity.retry(
@@ -0,0 +1,309 @@
+"""A prioritized, rate-limit-aware scheduler for release asset uploads.
+
+Uploads are queued by priority and run on a fixed set of threads. The number
+of uploads allowed to run at once adapts to the GitHub rate limits: it grows
+by one as uploads succeed and is halved when GitHub tells us to slow down
+(a secondary rate limit or an exhausted primary limit), in which case all
+uploads are paused until GitHub says we can go again. When the primary rate
+limit runs low, uploads are paused until it resets.
+
+Submitting blocks while too many uploads are waiting so that finished files do
+not pile up on disk faster than they can be uploaded.
+"""
+import time
+import heapq
+import random
+import itertools
+import threading
+from concurrent.futures import Future
+
+import github
+
+# the default pause if GitHub does not say how long to wait
+DEFAULT_THROTTLE_SECONDS = 60
+
+# stop making requests when fewer than this many are left until the reset
+MIN_REMAINING_REQUESTS = 100
+
+
+def get_throttle_seconds(e):
+    """Get the number of seconds GitHub asked us to wait for in an error or
+    None if the error is not a rate limit."""
+    if not isinstance(e, github.GithubException):
+        return None
+    headers = {k.lower(): v for k, v in (e.headers or {}).items()}
+    is_rate_limit = (
+        isinstance(e, github.RateLimitExceededException)
+        or e.status == 429
+        or (e.status == 403 and "rate limit" in str(e.data).lower())
+    )
+    if not is_rate_limit:
+        return None
+
+    if "retry-after" in headers:
+        return float(headers["retry-after"])
+    if headers.get("x-ratelimit-remaining") == "0" and "x-ratelimit-reset" in headers:
+        return max(float(headers["x-ratelimit-reset"]) - time.time(), 0) + 1
+    return DEFAULT_THROTTLE_SECONDS
+
+
+class _Job:
+    def __init__(self, fn, args, kwargs, priority):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.submitted = time.monotonic()
+        self.attempts = 0
+        self.started = False
+
+
+class UploadScheduler:
+    """A prioritized thread pool for uploads that adapts to rate limits.
+
+    It can be used in place of a `concurrent.futures.ThreadPoolExecutor`.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        The maximum number of uploads to run at once.
+    max_pending : int, optional
+        `submit` blocks while this many uploads are waiting to run.
+    max_attempts : int, optional
+        The number of times to try an upload that fails for a reason other
+        than a rate limit.
+    get_rate_limit : callable, optional
+        A function returning the remaining requests, the request limit and
+        the reset time in seconds since the epoch of the primary rate limit.
+
+    Attributes
+    ----------
+    concurrency : int
+        The number of uploads currently allowed to run at once.
+    """
+    def __init__(
+        self, max_workers=8, max_pending=256, max_attempts=5, get_rate_limit=None,
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.get_rate_limit = get_rate_limit
+        self.concurrency = max_workers
+
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._n_running = 0
+        self._paused_until = 0
+        self._n_since_decrease = 0
+        self._shutdown = False
+
+        self._latencies = []
+        self._waits = []
+        self._n_failed = 0
+        self._n_retries = 0
+        self._n_throttles = 0
+        self._max_queue_depth = 0
+
+        # the threads are started on the first upload so that processes can
+        # be forked safely before then
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown(wait=True)
+
+    @property
+    def queue_depth(self):
+        with self._cond:
+            return len(self._queue)
+
+    def submit(self, fn, *args, priority=0, **kwargs):
+        """Queue a call to `fn(*args, **kwargs)`.
+
+        Calls with lower priorities run first and calls with the same priority
+        run in the order they were submitted.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            The future for the result of the call.
+        """
+        job = _Job(fn, args, kwargs, priority)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("cannot submit uploads after shutdown")
+            if not self._threads:
+                self._threads = [
+                    threading.Thread(target=self._work, daemon=True)
+                    for _ in range(self.max_workers)
+                ]
+                for thread in self._threads:
+                    thread.start()
+            if len(self._queue) >= self.max_pending:
+                print(
+                    "waiting for %d queued uploads to start before "
+                    "queueing more" % len(self._queue),
+                    flush=True,
+                )
+                while len(self._queue) >= self.max_pending:
+                    self._cond.wait()
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+            self._cond.notify_all()
+        return job.future
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                if self._shutdown and not self._queue:
+                    return None
+                timeout = None
+                if self._queue and self._n_running < self.concurrency:
+                    timeout = self._paused_until - time.monotonic()
+                    if timeout <= 0:
+                        _, _, job = heapq.heappop(self._queue)
+                        self._n_running += 1
+                        self._cond.notify_all()
+                        return job
+                self._cond.wait(timeout=timeout)
+
+    def _throttle(self, job, seconds):
+        with self._cond:
+            self._n_throttles += 1
+            self.concurrency = max(self.concurrency // 2, 1)
+            self._n_since_decrease = 0
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + seconds
+            )
+            # the job goes back to the front of its priority
+            heapq.heappush(self._queue, (job.priority, -next(self._seq), job))
+            self._cond.notify_all()
+        print(
+            "uploads hit a GitHub rate limit - pausing for %0.1f seconds "
+            "with at most %d uploads at once" % (seconds, self.concurrency),
+            flush=True,
+        )
+
+    def _adapt_to_rate_limit(self):
+        try:
+            remaining, limit, reset = self.get_rate_limit()
+        except Exception:
+            return
+
+        with self._cond:
+            if remaining >= 0 and remaining < MIN_REMAINING_REQUESTS:
+                pause = max(reset - time.time(), 0) + 1
+                self._paused_until = max(
+                    self._paused_until, time.monotonic() + pause
+                )
+                print(
+                    "only %d GitHub API requests left - pausing uploads for "
+                    "%0.1f seconds" % (remaining, pause),
+                    flush=True,
+                )
+            elif limit > 0 and remaining < 0.1 * limit:
+                self.concurrency = max(self.concurrency - 1, 1)
+                self._n_since_decrease = 0
+            else:
+                # increase by one after a full round of uploads succeeds
+                self._n_since_decrease += 1
+                if (
+                    self._n_since_decrease >= self.concurrency
+                    and self.concurrency < self.max_workers
+                ):
+                    self.concurrency += 1
+                    self._n_since_decrease = 0
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            if not job.started:
+                job.started = True
+                if not job.future.set_running_or_notify_cancel():
+                    with self._cond:
+                        self._n_running -= 1
+                        self._cond.notify_all()
+                    continue
+
+            start = time.monotonic()
+            job.attempts += 1
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except Exception as e:
+                with self._cond:
+                    self._n_running -= 1
+                    self._cond.notify_all()
+
+                seconds = get_throttle_seconds(e)
+                if seconds is not None:
+                    job.attempts -= 1
+                    self._throttle(job, seconds)
+                elif job.attempts < self.max_attempts:
+                    with self._cond:
+                        self._n_retries += 1
+                    time.sleep(random.uniform(0, min(2**job.attempts, 10)))
+                    with self._cond:
+                        heapq.heappush(
+                            self._queue, (job.priority, -next(self._seq), job)
+                        )
+                        self._cond.notify_all()
+                else:
+                    with self._cond:
+                        self._n_failed += 1
+                    job.future.set_exception(e)
+            else:
+                with self._cond:
+                    self._n_running -= 1
+                    self._latencies.append(time.monotonic() - start)
+                    self._waits.append(time.monotonic() - job.submitted)
+                    self._cond.notify_all()
+                if self.get_rate_limit is not None:
+                    self._adapt_to_rate_limit()
+                job.future.set_result(result)
+
+    def report(self):
+        """Make a summary of the uploads done so far."""
+        with self._cond:
+            latencies = sorted(self._latencies)
+            waits = self._waits
+            n_done = len(latencies)
+            msg = (
+                "uploads done|failed|retried|throttled: %d|%d|%d|%d - "
+                "queue depth now|max: %d|%d - concurrency: %d" % (
+                    n_done,
+                    self._n_failed,
+                    self._n_retries,
+                    self._n_throttles,
+                    len(self._queue),
+                    self._max_queue_depth,
+                    self.concurrency,
+                )
+            )
+        if n_done > 0:
+            msg += (
+                " - upload latency mean|p95|max: %0.2f|%0.2f|%0.2f seconds "
+                "- time from submit to done mean: %0.2f seconds" % (
+                    sum(latencies) / n_done,
+                    latencies[min(int(0.95 * n_done), n_done - 1)],
+                    latencies[-1],
+                    sum(waits) / n_done,
+                )
+            )
+        return msg
+
+    def shutdown(self, wait=True):
+        """Stop accepting uploads, optionally waiting for the queued ones."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
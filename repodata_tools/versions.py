@@ -0,0 +1,94 @@
+"""Precomputed sort keys for conda versions.
+
+Comparing two `VersionOrder`s walks their parsed components in Python each
+time, and the same version strings are compared over and over for every
+subdir and label. `get_version_key` turns a version string into a tuple that
+sorts and compares equal exactly like conda's `VersionOrder` with Python's own
+tuple comparison, and memoizes it by version string.
+
+conda compares the parsed components of two versions lexicographically,
+treating missing components as the integer 0 (so '1.1' == '1.1.0') and
+strings as smaller than integers (so '1.1a1' < '1.1'). A plain tuple of the
+components would sort a shorter version first instead. In the key, each run
+of zeros is folded into the component after it, as
+
+    (0, number of zeros before it, string) for strings, which are below zero
+    (1, -number of zeros before it, number) for numbers above zero
+
+and the components end with `_END`, which sorts above every string and below
+every number, i.e., like the zeros that pad the shorter version. The parts of
+a version (split at '.' and '_') are folded the same way with the key of a
+part of only zeros as the zero.
+"""
+import functools
+
+from conda.models.version import VersionOrder
+
+# the number of version strings whose keys are kept
+MAX_VERSION_KEYS = 100_000
+
+_END = (1, float("-inf"))
+
+# the key of a part of a version with only zeros, e.g. '0'
+_ZERO = (_END,)
+
+
+def _part_key(components):
+    # the components are ints, strings and inf for 'post'
+    key = []
+    n_zeros = 0
+    for c in components:
+        if isinstance(c, str):
+            key.append((0, n_zeros, c))
+        elif c:
+            key.append((1, -n_zeros, c))
+        else:
+            n_zeros += 1
+            continue
+        n_zeros = 0
+    key.append(_END)
+    return tuple(key)
+
+
+def _parts_key(parts):
+    key = []
+    n_zeros = 0
+    for part in parts:
+        part_key = _part_key(part)
+        if part_key == _ZERO:
+            n_zeros += 1
+            continue
+        if part_key < _ZERO:
+            key.append((0, n_zeros, part_key))
+        else:
+            key.append((1, -n_zeros, part_key))
+        n_zeros = 0
+    key.append(_END)
+    return tuple(key)
+
+
+@functools.lru_cache(maxsize=MAX_VERSION_KEYS)
+def get_version_key(version):
+    """Get a key for a version string that compares like conda's
+    `VersionOrder`.
+
+    Parameters
+    ----------
+    version : str
+        The version. Invalid versions raise conda's `InvalidVersionSpec`.
+
+    Returns
+    -------
+    key : tuple
+        The key. Keys of versions that conda considers equal are equal.
+    """
+    vo = VersionOrder(version)
+    # the local version is only compared if the versions are equal
+    return (_parts_key(vo.version), _parts_key(vo.local))
+
+
+def get_version_key_stats():
+    """Get the number of version keys kept and the number of lookups that
+    found a key (hits) or made one (misses)."""
+    info = get_version_key.cache_info()
+    return info.currsize, info.hits, info.misses
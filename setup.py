@@ -11,5 +11,6 @@ setup(
         make-github-release=repodata_tools.releases:main
         run-repodata-worker=repodata_tools.repoworker:main
         remove-undistributable=repodata_tools.remove_undistrib:main
+        sync-shard-packs=repodata_tools.shard_pack:main
     """,
 )
@@ -0,0 +1,100 @@
+"""Time building current_repodata with the index against conda-build.
+
+    PYTHONPATH=. python tests/bench_current_repodata.py --names 2000 --packages 40000
+"""
+import copy
+import random
+import time
+
+import click
+from conda_build.index import _build_current_repodata
+
+from repodata_tools.current_repodata import CurrentRepodataIndex
+from repodata_tools.records import CompactRecord, compact_record, compact_repodata
+
+from synthetic_repodata import RECORD_KEYS, add_package, make_repodata
+
+
+def _to_plain(repodata):
+    return {
+        key: {
+            fn: record.to_dict() if isinstance(record, CompactRecord) else record
+            for fn, record in repodata[key].items()
+        }
+        for key in RECORD_KEYS
+    }
+
+
+def _drop_ignored_records(repodata):
+    # conda cannot log the records it ignores since they have no url
+    for key in RECORD_KEYS:
+        for fn in [
+            fn for fn, record in repodata[key].items()
+            if record.get("record_version", 0) > 1
+        ]:
+            del repodata[key][fn]
+
+
+def _time_conda_build(repodata):
+    repodata = copy.deepcopy(dict(repodata, **_to_plain(repodata)))
+    t0 = time.time()
+    current_repodata = _build_current_repodata("linux-64", repodata, None)
+    return time.time() - t0, _to_plain(current_repodata)
+
+
+def _time_index(index, repodata):
+    t0 = time.time()
+    current_repodata = index.build(repodata)
+    return time.time() - t0, _to_plain(current_repodata)
+
+
+@click.command()
+@click.option("--names", default=2000, type=int, help="number of package names")
+@click.option("--packages", default=40000, type=int, help="number of packages")
+@click.option("--new", default=50, type=int, help="number of packages to add")
+@click.option("--compact", is_flag=True, help="use compact records")
+@click.option("--seed", default=0, type=int, help="random seed")
+def main(names, packages, new, compact, seed):
+    """Time building current_repodata with the index against conda-build."""
+    rng = random.Random(seed)
+    repodata, all_names = make_repodata(rng, n_names=names, n_packages=packages)
+    _drop_ignored_records(repodata)
+    if compact:
+        compact_repodata(repodata)
+    n_records = len(repodata["packages"]) + len(repodata["packages.conda"])
+    index = CurrentRepodataIndex()
+
+    t_ref, ref = _time_conda_build(repodata)
+    t_first, out = _time_index(index, repodata)
+    assert out == ref
+    t_same, out = _time_index(index, repodata)
+    assert out == ref
+
+    added = {key: {} for key in RECORD_KEYS}
+    for _ in range(new):
+        add_package(rng, added, rng.choice(all_names), all_names)
+    _drop_ignored_records(added)
+    for key in RECORD_KEYS:
+        for fn, record in added[key].items():
+            repodata[key][fn] = compact_record(record) if compact else record
+    t_ref_new, ref = _time_conda_build(repodata)
+    t_new, out = _time_index(index, repodata)
+    assert out == ref
+
+    print(
+        f"{n_records} records, {sum(map(len, ref.values()))} kept",
+        flush=True,
+    )
+    print(
+        f"conda-build: {t_ref:.2f} s, after {new} new packages {t_ref_new:.2f} s",
+        flush=True,
+    )
+    print(
+        f"index: first build {t_first:.2f} s, unchanged {t_same:.3f} s, "
+        f"after {new} new packages {t_new:.3f} s ({index.n_sorted} names sorted)",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Measure the memory of repodata kept as dictionaries and as compact records.
+
+    PYTHONPATH=. python tests/bench_records.py --names 20000 --packages 140000
+
+The channel is a main label the size of conda-forge's linux-64 plus labels
+holding some of its packages, each with raw and patched repodata like the
+repo worker keeps them. Every label is loaded from its own JSON like the
+worker fetches it, so the dictionaries of the same package in two labels are
+different objects.
+"""
+import copy
+import gc
+import random
+import time
+import tracemalloc
+
+import click
+import rapidjson as json
+
+from repodata_tools.records import (
+    compact_repodata,
+    copy_repodata,
+    encode_record,
+    get_record_stats,
+    sweep_records,
+)
+
+from synthetic_repodata import RECORD_KEYS, make_repodata
+
+
+def _measure(make):
+    """Call `make` and return its output and the memory it holds on to."""
+    gc.collect()
+    tracemalloc.start()
+    data = make()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return data, size
+
+
+def _make_label_blobs(rng, repodata, n_labels, label_fraction):
+    labels = {"main": repodata}
+    for i in range(n_labels):
+        labels[f"label{i}"] = dict(
+            repodata,
+            **{
+                key: {
+                    fn: record
+                    for fn, record in repodata[key].items()
+                    if rng.random() < label_fraction
+                }
+                for key in RECORD_KEYS
+            },
+        )
+    return {label: json.dumps(data) for label, data in labels.items()}
+
+
+def _patch(raw, patched_fns, compact):
+    patched = copy_repodata(raw)
+    for key in RECORD_KEYS:
+        for fn, record in patched[key].items():
+            if fn in patched_fns:
+                record["depends"].append("zlib >=1.2.13,<2.0a0")
+    if compact:
+        compact_repodata(patched, base=raw)
+    return patched
+
+
+def _load_channel(blobs, patched_fns, compact):
+    channel = {}
+    for label, blob in blobs.items():
+        raw = json.loads(blob)
+        if compact:
+            compact_repodata(raw)
+        channel[label] = (raw, _patch(raw, patched_fns, compact))
+    return channel
+
+
+def _count_records(channel):
+    return sum(
+        len(repodata[key])
+        for raw_and_patched in channel.values()
+        for repodata in raw_and_patched
+        for key in RECORD_KEYS
+    )
+
+
+def _time_deepcopy(repodata):
+    t0 = time.time()
+    copy.deepcopy(repodata)
+    return time.time() - t0
+
+
+def _mb(size):
+    return size / 1000**2
+
+
+@click.command()
+@click.option("--names", default=20000, type=int, help="number of package names")
+@click.option("--packages", default=140000, type=int, help="number of packages")
+@click.option("--labels", default=10, type=int, help="number of other labels")
+@click.option(
+    "--label-fraction", default=0.05, type=float,
+    help="fraction of the packages in each other label",
+)
+@click.option(
+    "--patched-fraction", default=0.1, type=float,
+    help="fraction of the packages changed by the patches",
+)
+@click.option("--seed", default=0, type=int, help="random seed")
+def main(names, packages, labels, label_fraction, patched_fraction, seed):
+    """Measure the memory of repodata kept as dictionaries and as compact
+    records."""
+    rng = random.Random(seed)
+    repodata, _ = make_repodata(rng, n_names=names, n_packages=packages)
+    blob = json.dumps(repodata)
+    n_records = sum(len(repodata[key]) for key in RECORD_KEYS)
+
+    # one label
+    dicts, dicts_size = _measure(lambda: json.loads(blob))
+    del dicts
+    sweep_records()
+    compact, compact_size = _measure(lambda: compact_repodata(json.loads(blob)))
+    assert json.dumps(compact, sort_keys=True, default=encode_record) == (
+        json.dumps(json.loads(blob), sort_keys=True)
+    )
+    del compact
+    sweep_records()
+    plain = json.loads(blob)
+    t0 = time.time()
+    compact_repodata(plain)
+    t_compact = time.time() - t0
+    del plain
+    sweep_records()
+
+    print(f"one label of {n_records} records:", flush=True)
+    print(
+        f"  dicts    {_mb(dicts_size):7.1f} MB "
+        f"({dicts_size / n_records:5.0f} B/record)",
+        flush=True,
+    )
+    print(
+        f"  compact  {_mb(compact_size):7.1f} MB "
+        f"({compact_size / n_records:5.0f} B/record), "
+        f"{1e6 * t_compact / n_records:0.1f} us/record to compact",
+        flush=True,
+    )
+
+    # the channel
+    blobs = _make_label_blobs(rng, repodata, labels, label_fraction)
+    patched_fns = {
+        fn
+        for key in RECORD_KEYS
+        for fn in repodata[key]
+        if rng.random() < patched_fraction
+    }
+    del repodata
+
+    dicts, dicts_size = _measure(
+        lambda: _load_channel(blobs, patched_fns, compact=False)
+    )
+    n_channel_records = _count_records(dicts)
+    t_dicts_copy = _time_deepcopy(dicts["main"][1])
+    del dicts
+    sweep_records()
+    n_pooled = get_record_stats()[0]
+    compact, compact_size = _measure(
+        lambda: _load_channel(blobs, patched_fns, compact=True)
+    )
+    n_distinct = get_record_stats()[0] - n_pooled
+    t_compact_copy = _time_deepcopy(compact["main"][1])
+    del compact
+
+    print(
+        f"main and {labels} labels with {label_fraction:.0%} of the packages, "
+        f"raw and patched with {patched_fraction:.0%} of the packages "
+        f"patched ({n_channel_records} records):",
+        flush=True,
+    )
+    print(
+        f"  dicts    {_mb(dicts_size):7.1f} MB, "
+        f"deepcopy of patched main {t_dicts_copy:0.2f} s",
+        flush=True,
+    )
+    print(
+        f"  compact  {_mb(compact_size):7.1f} MB ({n_distinct} distinct records), "
+        f"deepcopy of patched main {t_compact_copy:0.2f} s",
+        flush=True,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Random repodata for testing and benchmarking the current repodata index.
+
+The records look like conda-forge records for a single subdir: python
+packages with python/python_abi pins, dependencies with the usual kinds of
+specs, features, timestamps in seconds and milliseconds, records conda
+ignores and .conda/.tar.bz2 pairs for the same package.
+"""
+import copy
+import hashlib
+
+PYTHONS = ["38", "39", "310", "311", "312"]
+RECORD_KEYS = ("packages", "packages.conda")
+
+
+def _make_dep(rng, name):
+    kind = rng.random()
+    if kind < 0.3:
+        return name
+    elif kind < 0.5:
+        return f"{name} >={rng.randint(0, 3)}"
+    elif kind < 0.7:
+        return f"{name} <{rng.randint(0, 3)}.{rng.randint(0, 5)}"
+    elif kind < 0.8:
+        return f"{name} {rng.randint(0, 3)}.{rng.randint(0, 5)}.*"
+    elif kind < 0.9:
+        return f"{name} >=0.1,<1.0a0 *_1"
+    else:
+        return f"{name} =={rng.randint(0, 3)}.{rng.randint(0, 5)}"
+
+
+def make_record(rng, name, names):
+    version = rng.choice([
+        f"{rng.randint(0, 3)}.{rng.randint(0, 5)}.{rng.randint(0, 4)}",
+        f"{rng.randint(0, 3)}.{rng.randint(0, 5)}",
+        f"{rng.randint(0, 3)}.{rng.randint(0, 5)}.{rng.randint(0, 4)}rc1",
+        f"{rng.randint(2020, 2024)}.{rng.randint(1, 12)}.{rng.randint(1, 28)}",
+    ])
+    py = rng.choice(PYTHONS)
+    build_number = rng.randint(0, 3)
+    sha256 = hashlib.sha256(f"{name}{rng.random()}".encode()).hexdigest()
+    if name == "python":
+        version = f"3.{py[1:]}.{rng.randint(0, 9)}"
+        build = f"h{sha256[:7]}_{build_number}_cpython"
+        depends = ["libgcc-ng >=12", "openssl >=3"]
+    else:
+        build = f"py{py}h{sha256[:7]}_{build_number}"
+        depends = [
+            f"python >={py[0]}.{py[1:]},<{py[0]}.{int(py[1:]) + 1}.0a0",
+            f"python_abi {py[0]}.{py[1:]}.* *_cp{py}",
+        ]
+        for _ in range(rng.randint(0, 4)):
+            dep_name = rng.choice(names)
+            if dep_name != name:
+                depends.append(_make_dep(rng, dep_name))
+
+    record = {
+        "build": build,
+        "build_number": build_number,
+        "depends": depends,
+        "license": "MIT",
+        "md5": hashlib.md5(sha256.encode()).hexdigest(),
+        "name": name,
+        "sha256": sha256,
+        "size": rng.randint(1000, 10**7),
+        "subdir": "linux-64",
+        "version": version,
+    }
+    r = rng.random()
+    if r < 0.8:
+        record["timestamp"] = 1600000000000 + rng.randint(0, 10**11)
+    elif r < 0.9:
+        record["timestamp"] = 1600000000 + rng.randint(0, 10**8)
+    if rng.random() < 0.05:
+        record["track_features"] = rng.choice(["blas_openblas", "a b", "", "x,y", " "])
+    if rng.random() < 0.03:
+        record["features"] = rng.choice(["mkl", "", "vc14"])
+    if rng.random() < 0.005:
+        record["record_version"] = 2
+    return record
+
+
+def add_package(rng, repodata, name, names):
+    """Add a package as a .tar.bz2 file, a .conda file or both."""
+    record = make_record(rng, name, names)
+    stem = f"{name}-{record['version']}-{record['build']}"
+    r = rng.random()
+    if r < 0.4:
+        repodata["packages"][stem + ".tar.bz2"] = record
+    elif r < 0.7:
+        repodata["packages.conda"][stem + ".conda"] = record
+    else:
+        repodata["packages"][stem + ".tar.bz2"] = dict(
+            record, md5=hashlib.md5(stem.encode()).hexdigest(),
+        )
+        repodata["packages.conda"][stem + ".conda"] = copy.deepcopy(record)
+
+
+def make_repodata(rng, n_names, n_packages):
+    """Make random repodata.
+
+    Returns
+    -------
+    repodata : dict
+        The repodata.
+    names : list of str
+        The package names that can be used to add more packages.
+    """
+    names = ["python", "pip", "openssl", "libgcc-ng", "python_abi"] + [
+        f"pkg{i}" for i in range(n_names)
+    ]
+    repodata = {
+        "info": {"subdir": "linux-64"},
+        "packages": {},
+        "packages.conda": {},
+        "removed": [],
+        "repodata_version": 1,
+    }
+    for _ in range(n_packages):
+        add_package(rng, repodata, rng.choice(names[1:] + ["python"] * 3), names)
+    return repodata, names
+
+
+def update_repodata(rng, repodata, names, make_record=lambda record: record):
+    """Add, remove and repatch some records like an update of the worker.
+
+    Records are replaced, never changed in place. `make_record` is applied to
+    new records, e.g., to make `CompactRecord`s.
+    """
+    for _ in range(rng.randint(1, 20)):
+        r = rng.random()
+        if r < 0.05 and repodata["packages"]:
+            # a .conda file for an existing .tar.bz2 file
+            fn = rng.choice(list(repodata["packages"]))
+            record = dict(repodata["packages"][fn], md5="0" * 32)
+            repodata["packages.conda"][fn[:-8] + ".conda"] = make_record(record)
+        elif r < 0.1:
+            # a .conda file with a .tar.bz2 file is removed
+            fns = [
+                fn
+                for fn in repodata["packages.conda"]
+                if fn[:-6] + ".tar.bz2" in repodata["packages"]
+            ]
+            if fns:
+                del repodata["packages.conda"][rng.choice(fns)]
+        elif r < 0.12:
+            # a new md5 for a .tar.bz2 file with a .conda file
+            fns = [
+                fn[:-6] + ".tar.bz2"
+                for fn in repodata["packages.conda"]
+                if fn[:-6] + ".tar.bz2" in repodata["packages"]
+            ]
+            if fns:
+                fn = rng.choice(fns)
+                record = dict(
+                    repodata["packages"][fn],
+                    md5=hashlib.md5(f"{fn}{rng.random()}".encode()).hexdigest(),
+                )
+                repodata["packages"][fn] = make_record(record)
+        elif r < 0.4:
+            new = {k: {} for k in RECORD_KEYS}
+            add_package(rng, new, rng.choice(names), names)
+            for key in RECORD_KEYS:
+                for fn, record in new[key].items():
+                    repodata[key][fn] = make_record(record)
+        elif r < 0.6:
+            key = rng.choice(RECORD_KEYS)
+            if repodata[key]:
+                del repodata[key][rng.choice(list(repodata[key]))]
+        else:
+            key = rng.choice(RECORD_KEYS)
+            if repodata[key]:
+                fn = rng.choice(list(repodata[key]))
+                record = dict(repodata[key][fn])
+                rr = rng.random()
+                if rr < 0.5:
+                    record["depends"] = list(record["depends"][:-1]) + [
+                        f"{rng.choice(names)} <{rng.randint(0, 3)}"
+                    ]
+                elif rr < 0.7:
+                    record["track_features"] = rng.choice(["", "f1", "a b"])
+                elif rr < 0.8:
+                    record["timestamp"] = rng.randint(0, 2 * 10**12)
+                else:
+                    record["license"] = "BSD"
+                repodata[key][fn] = make_record(record)
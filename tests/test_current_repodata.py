@@ -0,0 +1,295 @@
+"""The current repodata index must build exactly what conda-build builds."""
+import copy
+import hashlib
+import pickle
+import random
+
+import pytest
+
+pytest.importorskip("conda")
+
+from repodata_tools.current_repodata import (  # noqa: E402
+    CurrentRepodataIndex,
+    UnsupportedRepodataError,
+)
+from repodata_tools.records import (  # noqa: E402
+    CompactRecord,
+    compact_record,
+    compact_repodata,
+)
+
+from synthetic_repodata import (  # noqa: E402
+    RECORD_KEYS,
+    make_repodata,
+    update_repodata,
+)
+
+
+def _record(name, version, build_number=0, depends=(), **kwargs):
+    record = {
+        "build": f"h0_{build_number}",
+        "build_number": build_number,
+        "depends": list(depends),
+        "md5": hashlib.md5(f"{name}{version}{build_number}".encode()).hexdigest(),
+        "name": name,
+        "subdir": "linux-64",
+        "version": version,
+    }
+    record.update(kwargs)
+    return record
+
+
+def _fn(record, ext=".tar.bz2"):
+    return f"{record['name']}-{record['version']}-{record['build']}{ext}"
+
+
+def _make_repodata(*records, ext=".tar.bz2"):
+    repodata = {
+        "info": {"subdir": "linux-64"},
+        "packages": {},
+        "packages.conda": {},
+        "repodata_version": 1,
+    }
+    for record in records:
+        repodata[RECORD_KEYS[ext == ".conda"]][_fn(record, ext)] = record
+    return repodata
+
+
+def _kept(current_repodata):
+    return set(current_repodata["packages"]) | set(current_repodata["packages.conda"])
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_current_repodata_index_adds_removes_and_replaces_records(compact):
+    make = compact_record if compact else dict
+    a1 = make(_record("a", "1.0"))
+    a2 = make(_record("a", "2.0"))
+    a2_1 = make(_record("a", "2.0", build_number=1))
+    b1 = make(_record("b", "1.0"))
+    repodata = _make_repodata(a1, a2, b1)
+    index = CurrentRepodataIndex()
+
+    assert _kept(index.build(repodata)) == {_fn(a2), _fn(b1)}
+    assert index.n_sorted == 2
+
+    # every build of the newest version is kept
+    repodata["packages"][_fn(a2_1)] = a2_1
+    assert _kept(index.build(repodata)) == {_fn(a2), _fn(a2_1), _fn(b1)}
+    assert index.n_sorted == 1
+
+    # nothing is sorted again if nothing changed
+    assert _kept(index.build(repodata)) == {_fn(a2), _fn(a2_1), _fn(b1)}
+    assert index.n_sorted == 0
+
+    del repodata["packages"][_fn(a2)]
+    del repodata["packages"][_fn(a2_1)]
+    assert _kept(index.build(repodata)) == {_fn(a1), _fn(b1)}
+    assert index.n_sorted == 1
+
+    # a record that is replaced is read again
+    repodata["packages"][_fn(a1)] = make(_record("a", "1.0", track_features="x"))
+    repodata["packages"][_fn(b1)] = make(_record("b", "1.0", depends=["c"]))
+    current_repodata = index.build(repodata)
+    assert _kept(current_repodata) == {_fn(a1), _fn(b1)}
+    assert index.n_sorted == 2
+    assert current_repodata["packages"][_fn(b1)]["depends"] == ["c"]
+    assert current_repodata["packages"][_fn(a1)] is repodata["packages"][_fn(a1)]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_current_repodata_index_prefers_conda_files(compact):
+    make = compact_record if compact else dict
+    a1 = make(_record("a", "1.0"))
+    a1_conda = make(_record("a", "1.0", md5="0" * 32))
+    b1_conda = make(_record("b", "1.0"))
+    repodata = _make_repodata(a1)
+    repodata["packages.conda"][_fn(b1_conda, ".conda")] = b1_conda
+    index = CurrentRepodataIndex()
+
+    current_repodata = index.build(repodata)
+    assert _kept(current_repodata) == {_fn(a1), _fn(b1_conda, ".conda")}
+    # like conda-build, .conda records without a .tar.bz2 record get None
+    assert current_repodata["packages.conda"][_fn(b1_conda, ".conda")] == dict(
+        b1_conda, legacy_bz2_md5=None,
+    )
+
+    # the .conda file shadows the .tar.bz2 file for the same package and gets
+    # its md5 as legacy_bz2_md5
+    repodata["packages.conda"][_fn(a1_conda, ".conda")] = a1_conda
+    current_repodata = index.build(repodata)
+    assert _kept(current_repodata) == {
+        _fn(a1_conda, ".conda"), _fn(b1_conda, ".conda"),
+    }
+    record = current_repodata["packages.conda"][_fn(a1_conda, ".conda")]
+    assert record == dict(a1_conda, legacy_bz2_md5=a1["md5"])
+    assert isinstance(record, CompactRecord) == compact
+    # the repodata is left as it was
+    assert repodata["packages.conda"][_fn(a1_conda, ".conda")] is a1_conda
+    assert "legacy_bz2_md5" not in a1_conda
+
+    # a new .tar.bz2 md5 makes a new copy
+    a1_new = make(_record("a", "1.0", md5="1" * 32))
+    repodata["packages"][_fn(a1)] = a1_new
+    current_repodata = index.build(repodata)
+    assert current_repodata["packages.conda"][_fn(a1_conda, ".conda")] == dict(
+        a1_conda, legacy_bz2_md5="1" * 32,
+    )
+
+    # without the .conda file, the .tar.bz2 file is back
+    del repodata["packages.conda"][_fn(a1_conda, ".conda")]
+    current_repodata = index.build(repodata)
+    assert _kept(current_repodata) == {_fn(a1_new), _fn(b1_conda, ".conda")}
+    assert current_repodata["packages"][_fn(a1_new)] is a1_new
+
+
+def test_current_repodata_index_keeps_a_record_without_features():
+    a1 = _record("a", "1.0")
+    a2 = _record("a", "2.0")
+    a3 = _record("a", "3.0", track_features="mkl")
+    a4 = _record("a", "4.0", features="mkl")
+    repodata = _make_repodata(a1, a2, a3)
+    index = CurrentRepodataIndex()
+
+    # the newest version without features that is not newer than the newest
+    # record kept
+    assert _kept(index.build(repodata)) == {_fn(a3), _fn(a2)}
+
+    repodata["packages"][_fn(a4)] = a4
+    assert _kept(index.build(repodata)) == {_fn(a4), _fn(a2)}
+
+    repodata["packages"][_fn(a2)] = _record("a", "2.0", track_features="a b")
+    assert _kept(index.build(repodata)) == {_fn(a4), _fn(a1)}
+
+    # features that are only spaces and commas do not count
+    repodata["packages"][_fn(a4)] = _record("a", "4.0", track_features=" ,")
+    assert _kept(index.build(repodata)) == {_fn(a4)}
+
+
+def test_current_repodata_index_keeps_the_records_specs_pull_in():
+    a1 = _record("a", "1.0")
+    a1_5 = _record("a", "1.5")
+    a2 = _record("a", "2.0")
+    b1 = _record("b", "1.0", depends=["a <2"])
+    c1 = _record("c", "1.0")
+    repodata = _make_repodata(a1, a2, b1, c1)
+    index = CurrentRepodataIndex()
+
+    # the newest a does not satisfy b, so the newest one that does is kept
+    assert _kept(index.build(repodata)) == {_fn(a1), _fn(a2), _fn(b1), _fn(c1)}
+    assert index._missing["a <2"] == ("a", (index._packages[_fn(a1)],))
+
+    # the spec is matched again when the records of a change
+    repodata["packages"][_fn(a1_5)] = a1_5
+    assert _kept(index.build(repodata)) == {_fn(a1_5), _fn(a2), _fn(b1), _fn(c1)}
+    assert index._missing["a <2"] == ("a", (index._packages[_fn(a1_5)],))
+
+    # and not when the records of another name change
+    missing = index._missing["a <2"]
+    c2 = _record("c", "2.0")
+    repodata["packages"][_fn(c2)] = c2
+    assert _kept(index.build(repodata)) == {_fn(a1_5), _fn(a2), _fn(b1), _fn(c2)}
+    assert index.n_sorted == 1
+    assert index._missing["a <2"] is missing
+
+    # the spec is dropped when no record kept depends on it anymore
+    repodata["packages"][_fn(b1)] = _record("b", "1.0", depends=["a"])
+    assert _kept(index.build(repodata)) == {_fn(a2), _fn(b1), _fn(c2)}
+    assert "a <2" not in index._missing
+    assert "a <2" not in index._spec_counts
+
+    # a newer b that needs an older a
+    b2 = _record("b", "2.0", depends=["a 1.0.*"])
+    repodata["packages"][_fn(b2)] = b2
+    assert _kept(index.build(repodata)) == {_fn(a1), _fn(a2), _fn(b2), _fn(c2)}
+
+
+def test_current_repodata_index_raises_for_specs_it_cannot_match():
+    repodata = _make_repodata(
+        _record("a", "1.0"),
+        _record("b", "1.0", depends=["conda-forge::a"]),
+    )
+    with pytest.raises(UnsupportedRepodataError):
+        CurrentRepodataIndex().build(repodata)
+
+
+def _to_plain(repodata):
+    return copy.deepcopy({
+        key: (
+            {
+                fn: record.to_dict() if isinstance(record, CompactRecord) else record
+                for fn, record in value.items()
+            }
+            if key in RECORD_KEYS
+            else value
+        )
+        for key, value in repodata.items()
+    })
+
+
+def _build_reference(repodata):
+    """Build current_repodata with conda-build from a plain copy of `repodata`."""
+    _build_current_repodata = pytest.importorskip(
+        "conda_build.index"
+    )._build_current_repodata
+    plain = _to_plain(repodata)
+    # conda logs the url of the records it cannot read, which they do not have
+    for key in RECORD_KEYS:
+        for record in plain[key].values():
+            if record.get("record_version", 0) > 1:
+                record["url"] = ""
+    return _to_plain(_build_current_repodata("linux-64", plain, None))
+
+
+def _check_build(index, repodata):
+    records = {key: dict(repodata[key]) for key in RECORD_KEYS}
+    snapshots = {key: _to_plain(repodata)[key] for key in RECORD_KEYS}
+    expected = _build_reference(repodata)
+
+    current_repodata = index.build(repodata)
+
+    assert _to_plain(current_repodata) == expected
+    # the md5 of the .tar.bz2 files is only added to copies of the records
+    for key in RECORD_KEYS:
+        assert repodata[key] == records[key]
+        for fn, record in records[key].items():
+            assert repodata[key][fn] is record
+            plain = record.to_dict() if isinstance(record, CompactRecord) else record
+            assert plain == snapshots[key][fn]
+        for fn, record in current_repodata[key].items():
+            if record == repodata[key][fn]:
+                assert record is repodata[key][fn]
+
+    # the copies are reused as long as the records are the same
+    current_repodata_again = index.build(repodata)
+    for key in RECORD_KEYS:
+        for fn, record in current_repodata[key].items():
+            assert current_repodata_again[key][fn] is record
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("seed", range(4))
+def test_current_repodata_index_matches_conda_build(seed, compact):
+    rng = random.Random(seed)
+    repodata, names = make_repodata(
+        rng, n_names=20 + seed * 20, n_packages=300 + seed * 100,
+    )
+    if compact:
+        compact_repodata(repodata)
+
+        def make_record(record):
+            return compact_record(record)
+    else:
+        def make_record(record):
+            return record
+
+    index = CurrentRepodataIndex()
+    _check_build(index, repodata)
+    for i in range(12):
+        update_repodata(rng, repodata, names, make_record=make_record)
+        if i == 4:
+            # the index is sent to another process along with the records
+            repodata, index = pickle.loads(pickle.dumps((repodata, index)))
+        if i == 8:
+            # labels that are rebuilt from scratch have new records
+            repodata = copy.deepcopy(repodata)
+        _check_build(index, repodata)
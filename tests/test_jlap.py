@@ -0,0 +1,106 @@
+"""The .jlap logs must patch the last published repodata.json into the new one."""
+import random
+
+import pytest
+import rapidjson as json
+
+pytest.importorskip("conda")
+
+from repodata_tools.current_repodata import CurrentRepodataStore  # noqa: E402
+from repodata_tools.jlap import JLAPStore, hash_segments  # noqa: E402
+from repodata_tools.records import compact_record, compact_repodata  # noqa: E402
+from repodata_tools.residency import LabelResidency, LabelStore  # noqa: E402
+from repodata_tools.serialize import JSONFragmentCache  # noqa: E402
+
+from synthetic_repodata import make_repodata, update_repodata  # noqa: E402
+
+FN = "repodata_linux-64_main.json"
+JLAP_FN = "repodata_linux-64_main.jlap"
+CRD_FN = "current_repodata_linux-64_main.json"
+
+
+def _unescape_pointer(key):
+    return key.replace("~1", "/").replace("~0", "~")
+
+
+def _apply_patch(data, patch):
+    # the add and remove operations of RFC 6902, which are all the log uses
+    for op in patch:
+        keys = [_unescape_pointer(key) for key in op["path"].split("/")[1:]]
+        parent = data
+        for key in keys[:-1]:
+            parent = parent[key]
+        if op["op"] == "remove":
+            del parent[keys[-1]]
+        else:
+            assert op["op"] == "add"
+            parent[keys[-1]] = op["value"]
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_jlap_patches_spilled_label_to_written_repodata(tmp_path, compact):
+    rng = random.Random(0)
+    repodata, names = make_repodata(rng, n_names=20, n_packages=300)
+    if compact:
+        compact_repodata(repodata)
+
+        def make_record(record):
+            return compact_record(record)
+    else:
+        def make_record(record):
+            return record
+
+    json_cache = JSONFragmentCache()
+    jlap_store = JLAPStore()
+    current_repodata_store = CurrentRepodataStore()
+
+    def _drop_label_caches(kind, subdir, label):
+        # like the repo worker, the caches referring to the records go too
+        assert (kind, subdir, label) == ("patched", "linux-64", "main")
+        json_cache.drop_files([FN, "current_" + FN])
+        jlap_store.drop_snapshots([JLAP_FN])
+        current_repodata_store.drop_files([CRD_FN])
+
+    residency = LabelResidency(
+        10**12, str(tmp_path), on_evict=_drop_label_caches,
+    )
+    store = LabelStore("patched", "linux-64", residency=residency)
+    store["main"] = repodata
+    store["other"] = {}
+
+    segments = json_cache.dumps_segments(FN, repodata)
+    published = json.loads(b"".join(segments))
+    latest = hash_segments(segments)
+    jlap_store.start(JLAP_FN, repodata, latest)
+    del repodata
+
+    for i in range(12):
+        repodata = store["main"]
+        if jlap_store.needs_snapshot(JLAP_FN):
+            jlap_store.restore_snapshot(JLAP_FN, repodata)
+
+        update_repodata(rng, repodata, names, make_record=make_record)
+        segments = json_cache.dumps_segments(FN, repodata)
+        text = jlap_store.update(JLAP_FN, repodata, hash_segments(segments))
+        # the current repodata is made after the repodata was written
+        json_cache.dumps(
+            "current_" + FN, current_repodata_store.build(CRD_FN, repodata),
+        )
+        del repodata
+
+        if i % 3 != 2:
+            store["other"]
+            residency.max_bytes = 0
+            assert residency.enforce() == [("patched", "linux-64", "main")]
+            residency.max_bytes = 10**12
+
+        lines = text.split("\n")
+        assert json.loads(lines[-2])["latest"] == hash_segments(segments)
+        if hash_segments(segments) != latest:
+            line = json.loads(lines[-3])
+            assert (line["from"], line["to"]) == (latest, hash_segments(segments))
+            _apply_patch(published, line["patch"])
+            latest = line["to"]
+        assert published == json.loads(b"".join(segments))
+
+    store.close()
@@ -0,0 +1,181 @@
+"""Compact records must read, compare and encode like the dictionaries they
+were made from, and equal records must be stored once."""
+import copy
+import pickle
+import random
+
+import pytest
+import rapidjson as json
+
+from repodata_tools.records import (
+    CompactRecord,
+    compact_record,
+    compact_repodata,
+    copy_record,
+    copy_repodata,
+    encode_record,
+    get_record_stats,
+    sweep_records,
+)
+
+from synthetic_repodata import make_record
+
+_NAMES = iter(range(10**9))
+
+
+def _make_record(**kwargs):
+    # the records of each test have a name no other record has, so that they
+    # are not in the pool already
+    rng = random.Random(0)
+    name = f"records-test-{next(_NAMES)}"
+    return dict(make_record(rng, name, [name, "numpy"]), **kwargs)
+
+
+def _count_misses(record):
+    _, _, misses = get_record_stats()
+    compact = compact_record(record)
+    return compact, get_record_stats()[2] - misses
+
+
+def test_compact_record_reads_like_dict():
+    record = _make_record(
+        constrains=["numpy >=1.20"],
+        features="",
+        noarch=None,
+        legacy_bz2_md5="0" * 32,
+        md5="ABCDEF" + "0" * 26,
+        sha256=" " + "0" * 63,
+    )
+    compact = compact_record(record)
+
+    assert isinstance(compact, CompactRecord)
+    assert compact == record
+    assert record == compact
+    assert compact.to_dict() == record
+    assert dict(compact) == record
+    assert sorted(compact) == sorted(record)
+    assert len(compact) == len(record)
+    assert compact["depends"] == record["depends"]
+    assert isinstance(compact["depends"], list)
+    assert compact.get("missing", 1) == 1
+    # digests that do not come back the same from bytes are kept as strings
+    assert compact["md5"] == record["md5"]
+    assert compact["sha256"] == record["sha256"]
+    assert json.dumps(compact, sort_keys=True, default=encode_record) == (
+        json.dumps(record, sort_keys=True)
+    )
+    assert compact_record(compact) is compact
+    assert copy.copy(compact) is compact
+    assert copy.deepcopy(compact) is compact
+
+    mutable = copy_record(compact)
+    mutable["depends"].append("zlib")
+    assert mutable != compact
+    assert compact == record
+
+
+def test_compact_record_is_immutable():
+    compact = compact_record(_make_record())
+    with pytest.raises(TypeError):
+        compact["name"] = "other"
+    with pytest.raises(AttributeError):
+        compact.foo = 1
+
+
+def test_equal_records_are_pooled():
+    record = _make_record()
+    compact, misses = _count_misses(record)
+    assert misses == 1
+
+    # the order of the keys does not matter
+    _, hits, _ = get_record_stats()
+    other, misses = _count_misses(dict(reversed(list(record.items()))))
+    assert other is compact
+    assert misses == 0
+    assert get_record_stats()[1] == hits + 1
+
+    changed, misses = _count_misses(dict(record, build_number=10))
+    assert changed is not compact
+    assert misses == 1
+
+
+def test_records_loaded_from_pickle_are_pooled():
+    compact = compact_record(_make_record())
+    repodata = {"packages": {"a.tar.bz2": compact}}
+    loaded = pickle.loads(pickle.dumps(repodata))
+    assert loaded["packages"]["a.tar.bz2"] is compact
+
+
+@pytest.mark.parametrize("value", [1, 1.0, True])
+def test_values_of_other_types_are_not_shared(value):
+    # 1 == 1.0 == True but the JSON is different
+    record = _make_record(build_number=value)
+    compact = compact_record(record)
+    assert type(compact["build_number"]) is type(value)
+    for other in [1, 1.0, True]:
+        other_compact = compact_record(dict(record, build_number=other))
+        assert type(other_compact["build_number"]) is type(other)
+
+        based = compact_record(dict(record, build_number=other), base=compact)
+        assert type(based["build_number"]) is type(other)
+        assert json.dumps(based, default=encode_record) == (
+            json.dumps(dict(record, build_number=other))
+        )
+
+
+def test_base_record_values_are_shared():
+    raw = compact_record(_make_record(license="MIT license"))
+    patched_record = copy_record(raw)
+    patched_record["depends"] = patched_record["depends"] + ["zlib"]
+    patched_record["license"] = "MIT license"
+    patched = compact_record(patched_record, base=raw)
+
+    assert patched == patched_record
+    for key in ["sha256", "md5", "license", "timestamp", "size"]:
+        if key in raw:
+            assert (
+                patched._values[patched._layout.index[key]]
+                is raw._values[raw._layout.index[key]]
+            )
+    assert patched._layout is raw._layout
+
+
+def test_sweep_drops_only_unused_records():
+    kept_record = _make_record()
+    dropped_record = _make_record()
+    kept = compact_record(kept_record)
+    compact_record(dropped_record)
+
+    n_records = get_record_stats()[0]
+    assert sweep_records() >= 1
+    assert get_record_stats()[0] <= n_records - 1
+
+    # the kept record is still the pooled one, the dropped one is made again
+    other, misses = _count_misses(kept_record)
+    assert other is kept
+    assert misses == 0
+    _, misses = _count_misses(dropped_record)
+    assert misses == 1
+
+
+def test_records_in_repodata_are_not_swept():
+    rng = random.Random(0)
+    repodata = {
+        "info": {"subdir": "linux-64"},
+        "packages": {
+            f"records-test-{i}.tar.bz2": make_record(
+                rng, f"records-test-sweep-{i}", ["numpy"]
+            )
+            for i in range(10)
+        },
+    }
+    plain = copy_repodata(repodata)
+    compact_repodata(repodata)
+    patched = compact_repodata(copy_repodata(repodata), base=repodata)
+
+    sweep_records()
+    assert repodata == plain
+    for fn, record in patched["packages"].items():
+        assert record is repodata["packages"][fn]
+        _, misses = _count_misses(plain["packages"][fn])
+        assert misses == 0